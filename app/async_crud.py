@@ -0,0 +1,106 @@
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.sql import select
+
+from . import cache, crud, models, schemas, search, serialization
+
+# Async versions of the crud.py reads used by the async endpoints, they run
+# the same statements and share the same caches as their crud.py
+# counterparts, only the DB round trips are awaited on an AsyncSession.
+
+
+async def get_user_by_email(
+    db: AsyncSession,
+    email: str
+) -> Optional[models.User]:
+    result = await db.execute(
+        select(models.User).where(models.User.email == email)
+    )
+    return result.scalars().first()
+
+
+async def get_principal(
+    db: AsyncSession,
+    email: str,
+    expires_at: float
+) -> Optional[schemas.UserOut]:
+    principal = cache.principal_cache.get(email)
+    if principal is not cache.MISSING:
+        return principal
+
+    generation = cache.principal_cache.generation
+    result = await db.execute(
+        select(models.User).where(models.User.email == email)
+    )
+    return crud.cache_principal(result.scalars().first(), expires_at,
+                                generation)
+
+
+async def get_products_by_ids(
+    db: AsyncSession,
+    product_ids: List[int]
+) -> List[models.Product]:
+    result = await db.execute(crud.products_by_ids_statement(product_ids))
+    return result.scalars().all()
+
+
+async def get_serialized_products(
+    db: AsyncSession,
+    product_ids: List[int]
+) -> Dict[int, serialization.SerializedProduct]:
+    products, missing = crud.get_cached_products(product_ids)
+    if missing:
+        generation = cache.product_cache.generation
+        products.update(crud.cache_products(
+            await get_products_by_ids(db, missing), generation
+        ))
+    return products
+
+
+async def get_product_details_json(
+    db: AsyncSession,
+    product_id: int
+) -> Optional[bytes]:
+    products = await get_serialized_products(db, [product_id])
+    product = products.get(product_id)
+    return product.details if product else None
+
+
+async def get_product_list_keys(
+    db: AsyncSession,
+    filters: schemas.ProductFilter,
+    after: Optional[tuple],
+    limit: Optional[int]
+) -> List[tuple]:
+    list_cache, cache_key = crud.product_list_cache_key(filters, after,
+                                                        limit)
+    keys = list_cache.get(cache_key)
+    if keys is cache.MISSING:
+        generation = list_cache.generation
+        result = await db.execute(
+            crud.product_list_statement(filters, after, limit)
+        )
+        keys = crud.product_keys(result)
+        list_cache.set(cache_key, keys, generation=generation)
+    return keys
+
+
+async def get_product_list_json(
+    db: AsyncSession,
+    product_ids: List[int]
+) -> bytes:
+    products = await get_serialized_products(db, product_ids)
+    return crud.product_list_json(products, product_ids)
+
+
+async def search_products(
+    db: AsyncSession,
+    match_query: str,
+    after: Optional[Tuple[float, int]],
+    limit: int
+) -> List[Tuple[models.Product, float]]:
+    result = await db.execute(
+        search.search_statement(match_query, after, limit)
+    )
+    return result.all()
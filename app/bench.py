@@ -0,0 +1,708 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import requests
+from fastapi import Depends, FastAPI, HTTPException, Response
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from . import (
+    async_crud, cache, crud, database, hashing, hits, migrations, models,
+    security
+)
+from .database import Base
+
+# Two benchmarks live here:
+#
+# - `suite` drives the whole app through a set of scenarios (anonymous
+#   reads, login, authenticated CRUD and hits) for every catalog size and
+#   concurrency level, and can compare the results against a baseline.
+# - `sessions` compares the sync and async DB paths of the product detail.
+
+BENCH_USER_EMAIL = "bench@example.com"
+BENCH_USER_PASSWORD = "bench"
+
+
+class BenchRequest(NamedTuple):
+    method: str
+    path: str
+    headers: Dict[str, str] = {}
+    body: bytes = b""
+    expected_status: int = 200
+
+
+# ==================================================================
+# Transports
+# ==================================================================
+async def asgi_request(
+    app,
+    method: str,
+    path: str,
+    headers: Optional[Dict[str, str]] = None,
+    body: bytes = b""
+) -> int:
+    """Send a request straight to the ASGI app, returns the status code"""
+    path, _, query_string = path.partition("?")
+    raw_headers = [(b"host", b"bench")] + [
+        (name.lower().encode(), value.encode())
+        for name, value in (headers or {}).items()
+    ]
+    if body:
+        raw_headers.append((b"content-length", str(len(body)).encode()))
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query_string.encode(),
+        "root_path": "",
+        "headers": raw_headers,
+        "client": ("127.0.0.1", 0),
+        "server": ("bench", 80),
+    }
+    status = None
+    request_sent = False
+
+    async def receive():
+        nonlocal request_sent
+        if request_sent:
+            # Nothing else is coming, like a client waiting for the response
+            await asyncio.Event().wait()
+        request_sent = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+    return status
+
+
+async def asgi_get(app, path: str) -> int:
+    return await asgi_request(app, "GET", path)
+
+
+class ASGITransport:
+    """Requests handled by the app in this same event loop"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, request: BenchRequest) -> int:
+        return await asgi_request(self.app, request.method, request.path,
+                                  request.headers, request.body)
+
+    def close(self):
+        pass
+
+
+class UvicornTransport:
+    """Requests sent over HTTP to uvicorn serving the app in a thread"""
+
+    def __init__(self, app, concurrency: int):
+        import uvicorn
+
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        self.server = uvicorn.Server(uvicorn.Config(
+            app, host="127.0.0.1", port=self.port, log_level="warning",
+            lifespan="off"
+        ))
+        # Signals can only be handled in the main thread
+        self.server.install_signal_handlers = lambda: None
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+
+        self.executor = ThreadPoolExecutor(concurrency)
+        self.sessions = threading.local()
+
+    def _send(self, request: BenchRequest) -> int:
+        session = getattr(self.sessions, "session", None)
+        if session is None:
+            session = self.sessions.session = requests.Session()
+        response = session.request(
+            request.method, f"http://127.0.0.1:{self.port}{request.path}",
+            headers=request.headers, data=request.body
+        )
+        return response.status_code
+
+    async def __call__(self, request: BenchRequest) -> int:
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, self._send, request
+        )
+
+    def close(self):
+        self.executor.shutdown()
+        self.server.should_exit = True
+        self.thread.join()
+
+
+# ==================================================================
+# Measuring
+# ==================================================================
+def percentile(values: List[float], percent: float) -> float:
+    """Nearest-rank percentile of the (sorted) values"""
+    if not values:
+        return 0.0
+    rank = max(1, -(-len(values) * percent // 100))
+    return values[int(rank) - 1]
+
+
+async def run_requests(app, paths, concurrency: int) -> float:
+    """GET every path with `concurrency` requests in flight, returns the
+    requests per second"""
+    queue = list(reversed(paths))
+
+    async def worker():
+        while queue:
+            status = await asgi_get(app, queue.pop())
+            if status != 200:
+                raise RuntimeError(f"Unexpected status {status}")
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return len(paths) / (time.perf_counter() - started_at)
+
+
+async def measure(
+    transport: Callable,
+    bench_requests: List[BenchRequest],
+    concurrency: int
+) -> dict:
+    """Send the requests with `concurrency` in flight, returns the
+    throughput, latency percentiles and unexpected statuses"""
+    queue = list(reversed(bench_requests))
+    latencies = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        while queue:
+            request = queue.pop()
+            sent_at = time.perf_counter()
+            status = await transport(request)
+            latencies.append(time.perf_counter() - sent_at)
+            if status != request.expected_status:
+                errors += 1
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started_at
+
+    latencies.sort()
+    return {
+        "requests": len(bench_requests),
+        "errors": errors,
+        "rps": len(bench_requests) / elapsed,
+        "p50_ms": 1000 * percentile(latencies, 50),
+        "p95_ms": 1000 * percentile(latencies, 95),
+        "p99_ms": 1000 * percentile(latencies, 99),
+    }
+
+
+# ==================================================================
+# Scenarios
+# ==================================================================
+class Catalog:
+    """What the scenarios know about the bench DB
+
+    Products are deleted from the end of the catalog and never read, so
+    every other scenario keeps finding the ones it asks for.
+    """
+
+    def __init__(self, products: int, reserved: int, auth_headers: dict):
+        self.products = products
+        self.readable = products - reserved
+        self.next_deleted = products
+        self.next_created = 0
+        self.auth_headers = auth_headers
+
+
+def product_json(sku: str, name: str) -> bytes:
+    return json.dumps({
+        "sku": sku, "name": name, "brand": "Bench", "price": 9.99,
+        "description": "Benchmark product",
+    }).encode()
+
+
+def list_requests(catalog: Catalog, rng: random.Random, count: int):
+    return [BenchRequest("GET", "/products/?limit=50") for _ in range(count)]
+
+
+def detail_requests(catalog: Catalog, rng: random.Random, count: int):
+    return [
+        BenchRequest("GET", f"/products/{rng.randint(1, catalog.readable)}")
+        for _ in range(count)
+    ]
+
+
+def hits_requests(catalog: Catalog, rng: random.Random, count: int):
+    return [
+        BenchRequest(
+            "GET", f"/products/{rng.randint(1, catalog.readable)}/hits",
+            catalog.auth_headers
+        )
+        for _ in range(count)
+    ]
+
+
+def token_requests(catalog: Catalog, rng: random.Random, count: int):
+    body = (f"username={BENCH_USER_EMAIL}&"
+            f"password={BENCH_USER_PASSWORD}").encode()
+    headers = {"content-type": "application/x-www-form-urlencoded"}
+    return [BenchRequest("POST", "/token", headers, body)
+            for _ in range(count)]
+
+
+def create_requests(catalog: Catalog, rng: random.Random, count: int):
+    headers = dict(catalog.auth_headers, **{
+        "content-type": "application/json"
+    })
+    first, catalog.next_created = (catalog.next_created,
+                                   catalog.next_created + count)
+    return [
+        BenchRequest("POST", "/products/", headers,
+                     product_json(f"NEW{i:08d}", f"New product {i}"))
+        for i in range(first, first + count)
+    ]
+
+
+def update_requests(catalog: Catalog, rng: random.Random, count: int):
+    headers = dict(catalog.auth_headers, **{
+        "content-type": "application/json"
+    })
+    bench_requests = []
+    for _ in range(count):
+        product_id = rng.randint(1, catalog.readable)
+        bench_requests.append(BenchRequest(
+            "PUT", f"/products/{product_id}", headers,
+            product_json(seeded_sku(product_id), f"Updated {product_id}")
+        ))
+    return bench_requests
+
+
+def delete_requests(catalog: Catalog, rng: random.Random, count: int):
+    last, catalog.next_deleted = (catalog.next_deleted,
+                                  catalog.next_deleted - count)
+    return [
+        BenchRequest("DELETE", f"/products/{product_id}",
+                     catalog.auth_headers)
+        for product_id in range(last, last - count, -1)
+    ]
+
+
+SCENARIOS = {
+    "list": list_requests,
+    "detail": detail_requests,
+    "hits": hits_requests,
+    "token": token_requests,
+    "create": create_requests,
+    "update": update_requests,
+    "delete": delete_requests,
+}
+
+
+# ==================================================================
+# Bench DB
+# ==================================================================
+def seeded_sku(product_id: int) -> str:
+    return f"BENCH{product_id - 1:08d}"
+
+
+def seed(engine, products: int):
+    """Fresh schema with `products` products"""
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    seed_products(engine, products)
+
+
+def seed_suite_db(db_path: str, products: int):
+    """The bench catalog on a migrated DB, plus the user of the scenarios"""
+    for suffix in ["", "-wal", "-shm"]:
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    engine = create_engine(f"sqlite:///{db_path}")
+    try:
+        migrations.migrate(engine)
+        with engine.begin() as conn:
+            conn.execute(models.User.__table__.insert(), {
+                "email": BENCH_USER_EMAIL,
+                "hashed_password": security._hash(BENCH_USER_PASSWORD),
+                "is_admin": True,
+            })
+        seed_products(engine, products)
+    finally:
+        engine.dispose()
+
+
+def seed_products(engine, products: int, batch_size: int = 10000):
+    """Products with IDs 1 to `products`, ID N has seeded_sku(N)"""
+    with engine.begin() as conn:
+        for start in range(1, products + 1, batch_size):
+            conn.execute(models.Product.__table__.insert(), [
+                {"id": product_id, "sku": seeded_sku(product_id),
+                 "name": f"Product {product_id}",
+                 "brand": f"Brand {product_id % 50}",
+                 "price": product_id % 1000 + 0.99,
+                 "description": "Benchmark product"}
+                for product_id in range(start,
+                                        min(start + batch_size, products + 1))
+            ])
+
+
+class SuiteDB:
+    """Engines on the bench DB set up like the ones of database.py"""
+
+    def __init__(self, db_path: str):
+        sync_url = f"sqlite:///{db_path}"
+        connect_args = {"check_same_thread": False}
+        self.engine = create_engine(sync_url, connect_args=connect_args,
+                                    poolclass=QueuePool,
+                                    **database.pool_options)
+        database.apply_pragmas(self.engine, database.pragmas)
+        self.read_engine = create_engine(sync_url, connect_args=connect_args,
+                                         poolclass=QueuePool,
+                                         **database.read_pool_options)
+        database.apply_pragmas(self.read_engine, database.read_pragmas)
+        self.async_engine = create_async_engine(
+            f"sqlite+aiosqlite:///{db_path}",
+            poolclass=AsyncAdaptedQueuePool, **database.read_pool_options
+        )
+        database.apply_pragmas(self.async_engine.sync_engine,
+                               database.read_pragmas)
+
+        self.session_factory = sessionmaker(autoflush=False,
+                                            bind=self.engine)
+        self.read_session_factory = sessionmaker(autoflush=False,
+                                                 bind=self.read_engine)
+        self.async_session_factory = sessionmaker(
+            self.async_engine, class_=AsyncSession, autoflush=False,
+            expire_on_commit=False
+        )
+        self.hit_recorder = hits.HitRecorder(self.session_factory)
+
+    def overrides(self, main) -> dict:
+        def get_db():
+            db = self.session_factory()
+            try:
+                yield db
+            finally:
+                db.close()
+
+        def get_read_db():
+            db = self.read_session_factory()
+            try:
+                yield db
+            finally:
+                db.close()
+
+        async def get_async_db():
+            async with self.async_session_factory() as db:
+                yield db
+
+        return {
+            main.get_db: get_db,
+            main.get_read_db: get_read_db,
+            main.get_async_db: get_async_db,
+            main.get_hit_recorder: lambda: self.hit_recorder,
+            main.get_ses_client: lambda: None,
+        }
+
+    async def close(self):
+        self.hit_recorder.stop()
+        await self.async_engine.dispose()
+        self.read_engine.dispose()
+        self.engine.dispose()
+
+
+# ==================================================================
+# Suite
+# ==================================================================
+def warmup_count(count: int) -> int:
+    """Requests sent before measuring a scenario, not part of the results"""
+    return max(1, count // 10) if count else 0
+
+
+async def run_suite(args) -> dict:
+    """Every scenario, for every catalog size and concurrency level"""
+    from . import main
+
+    scenarios = args.scenarios or list(SCENARIOS)
+    counts = {scenario: args.requests for scenario in scenarios}
+    if "token" in counts:
+        counts["token"] = min(args.requests, args.token_requests)
+    # Every run of "delete", and its warmup, takes products of its own
+    deletes = counts.get("delete", 0)
+    reserved = (deletes + warmup_count(deletes)) * len(args.concurrency)
+
+    results = []
+    for products in args.products:
+        if products <= reserved:
+            raise ValueError(f"A catalog of {products} products is too small "
+                             f"for {reserved} deletes")
+        seed_suite_db(args.db, products)
+        suite_db = SuiteDB(args.db)
+        suite_db.hit_recorder.start()
+        overrides = suite_db.overrides(main)
+        previous_overrides = dict(main.app.dependency_overrides)
+        main.app.dependency_overrides.update(overrides)
+        for suite_cache in [cache.product_cache, cache.product_list_cache,
+                            cache.product_query_cache, cache.principal_cache]:
+            suite_cache.clear()
+
+        token = security.create_access_token(data={"sub": BENCH_USER_EMAIL})
+        catalog = Catalog(products, reserved,
+                          {"Authorization": f"Bearer {token}"})
+        rng = random.Random(args.seed)
+        try:
+            for concurrency in args.concurrency:
+                if args.transport == "uvicorn":
+                    transport = UvicornTransport(main.app, concurrency)
+                else:
+                    transport = ASGITransport(main.app)
+                try:
+                    for scenario in scenarios:
+                        make_requests = SCENARIOS[scenario]
+                        count = counts[scenario]
+                        await measure(
+                            transport,
+                            make_requests(catalog, rng, warmup_count(count)),
+                            concurrency
+                        )
+                        result = await measure(
+                            transport, make_requests(catalog, rng, count),
+                            concurrency
+                        )
+                        result.update(scenario=scenario, products=products,
+                                      concurrency=concurrency)
+                        results.append(result)
+                        if args.verbose:
+                            print(format_result(result), flush=True)
+                finally:
+                    transport.close()
+        finally:
+            main.app.dependency_overrides.clear()
+            main.app.dependency_overrides.update(previous_overrides)
+            await suite_db.close()
+    # Started by the token scenario
+    hashing.password_pool.shutdown()
+
+    return {
+        "meta": {
+            "transport": args.transport,
+            "products": args.products,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "seed": args.seed,
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "created_at": datetime.utcnow().isoformat(),
+        },
+        "results": results,
+    }
+
+
+def result_key(result: dict) -> Tuple[str, int, int]:
+    return result["scenario"], result["products"], result["concurrency"]
+
+
+def compare_to_baseline(
+    results: List[dict],
+    baseline: List[dict],
+    tolerance: float
+) -> List[str]:
+    """Results that got worse than the baseline by more than `tolerance`
+    (a fraction) in throughput or p95 latency, or that have new errors"""
+    baseline_by_key = {result_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        base = baseline_by_key.get(result_key(result))
+        if base is None:
+            continue
+        name = "{} products={} concurrency={}".format(*result_key(result))
+        if result["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append(f"{name}: {result['rps']:.1f} requests/sec, "
+                               f"was {base['rps']:.1f}")
+        if result["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {result['p95_ms']:.1f} ms, "
+                               f"was {base['p95_ms']:.1f}")
+        if result["errors"] > base["errors"]:
+            regressions.append(f"{name}: {result['errors']} errors, "
+                               f"was {base['errors']}")
+    return regressions
+
+
+def format_result(result: dict) -> str:
+    return (f"{result['scenario']:>7} {result['products']:>9} "
+            f"{result['concurrency']:>5} {result['rps']:>10.1f} "
+            f"{result['p50_ms']:>8.2f} {result['p95_ms']:>8.2f} "
+            f"{result['p99_ms']:>8.2f} {result['errors']:>6}")
+
+
+RESULTS_HEADER = (f"{'':>7} {'products':>9} {'conc':>5} {'req/s':>10} "
+                  f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>6}")
+
+
+# ==================================================================
+# Sync vs async sessions
+# ==================================================================
+def build_app(db_path: str):
+    """Product detail served by the sync (threadpool) and the async path"""
+    engine = create_engine(f"sqlite:///{db_path}",
+                           connect_args={"check_same_thread": False})
+    session_factory = sessionmaker(bind=engine, autoflush=False)
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}",
+                                       poolclass=AsyncAdaptedQueuePool)
+    async_session_factory = sessionmaker(async_engine, class_=AsyncSession,
+                                         expire_on_commit=False)
+
+    def get_db():
+        db = session_factory()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    async def get_async_db():
+        async with async_session_factory() as db:
+            yield db
+
+    bench_app = FastAPI()
+
+    @bench_app.get("/sync/{product_id}")
+    def sync_detail(product_id: int, db: Session = Depends(get_db)):
+        body = crud.get_product_details_json(db, product_id)
+        if body is None:
+            raise HTTPException(status_code=404)
+        return Response(content=body, media_type="application/json")
+
+    @bench_app.get("/async/{product_id}")
+    async def async_detail(
+        product_id: int,
+        db: AsyncSession = Depends(get_async_db)
+    ):
+        body = await async_crud.get_product_details_json(db, product_id)
+        if body is None:
+            raise HTTPException(status_code=404)
+        return Response(content=body, media_type="application/json")
+
+    return bench_app, engine, async_engine
+
+
+async def compare(args) -> dict:
+    bench_app, engine, async_engine = build_app(args.db)
+    seed(engine, args.products)
+
+    # Every request has to reach the DB
+    max_size = cache.product_cache.max_size
+    cache.product_cache.max_size = 0
+
+    rng = random.Random(args.seed)
+    ids = [rng.randint(1, args.products) for _ in range(args.requests)]
+    results = {}
+    try:
+        for path in ["sync", "async"]:
+            paths = [f"/{path}/{product_id}" for product_id in ids]
+            await run_requests(bench_app, paths[:100], args.concurrency)
+            results[path] = await run_requests(bench_app, paths,
+                                               args.concurrency)
+    finally:
+        cache.product_cache.max_size = max_size
+        await async_engine.dispose()
+        engine.dispose()
+    return results
+
+
+def int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(",")]
+
+
+if __name__ == "__main__":  # pragma: no cover
+    parser = argparse.ArgumentParser(description="Benchmarks of the API")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    suite = commands.add_parser(
+        "suite", help="throughput and latency of every scenario, for every "
+                      "catalog size and concurrency level"
+    )
+    suite.add_argument("--db", default="./bench.db")
+    suite.add_argument("--transport", choices=["asgi", "uvicorn"],
+                       default="asgi")
+    suite.add_argument("--products", type=int_list, default=[10000],
+                       help="catalog sizes, comma separated")
+    suite.add_argument("--concurrency", type=int_list, default=[1, 10, 50],
+                       help="requests in flight, comma separated")
+    suite.add_argument("--requests", type=int, default=1000,
+                       help="requests per scenario")
+    suite.add_argument("--token-requests", type=int, default=100,
+                       help="requests of the (bcrypt bound) token scenario")
+    suite.add_argument("--scenarios", type=lambda value: value.split(","),
+                       help=f"comma separated, of {', '.join(SCENARIOS)}")
+    suite.add_argument("--seed", type=int, default=0)
+    suite.add_argument("--output", help="save the results as JSON")
+    suite.add_argument("--baseline",
+                       help="results JSON to compare with, exits with 1 if "
+                            "anything regressed")
+    suite.add_argument("--tolerance", type=float, default=0.2,
+                       help="regression allowed before failing, a fraction")
+    suite.add_argument("--verbose", action="store_true")
+
+    sessions = commands.add_parser(
+        "sessions", help="requests/sec of GET /products/{id} through the "
+                         "sync (threadpool) and async DB paths, no caches"
+    )
+    sessions.add_argument("--db", default="./bench.db")
+    sessions.add_argument("--products", type=int, default=10000)
+    sessions.add_argument("--requests", type=int, default=5000)
+    sessions.add_argument("--concurrency", type=int, default=50)
+    sessions.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+
+    if args.command == "sessions":
+        for path, rps in asyncio.run(compare(args)).items():
+            print(f"{path:>5}: {rps:8.1f} requests/sec")
+        sys.exit()
+
+    if args.verbose:
+        print(RESULTS_HEADER)
+    report = asyncio.run(run_suite(args))
+    if not args.verbose:
+        print(RESULTS_HEADER)
+        for result in report["results"]:
+            print(format_result(result))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare_to_baseline(
+                report["results"], json.load(baseline)["results"],
+                args.tolerance
+            )
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,199 @@
+import csv
+import io
+import json
+from typing import AsyncIterator, List, Tuple, Union
+
+from pydantic import ValidationError
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from . import config, crud, schemas
+
+# A row is either the parsed record or the reason it couldn't be parsed
+Row = Tuple[int, Union[dict, str]]
+
+
+class ImportReport:
+    """Outcome of a bulk import, errors beyond max_errors are only counted"""
+
+    def __init__(self, max_errors: int = config.IMPORT_MAX_ERRORS):
+        self.max_errors = max_errors
+        self.created = 0
+        self.failed = 0
+        self.product_ids: List[int] = []
+        self.errors: List[dict] = []
+
+    def add_error(self, row: int, detail: str):
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({"row": row, "detail": detail})
+
+    def dict(self) -> dict:
+        return {
+            "created": self.created,
+            "failed": self.failed,
+            "errors": sorted(self.errors, key=lambda error: error["row"]),
+        }
+
+
+# ==================================================================
+# Parsing
+# ==================================================================
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    pending = b""
+    async for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield line.decode("utf-8", errors="replace")
+    if pending:
+        yield pending.decode("utf-8", errors="replace")
+
+
+async def iter_ndjson_rows(lines: AsyncIterator[str]) -> AsyncIterator[Row]:
+    row_number = 0
+    async for line in lines:
+        if not line.strip():
+            continue
+        row_number += 1
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield row_number, "Invalid JSON"
+            continue
+        if not isinstance(record, dict):
+            yield row_number, "Expected a JSON object"
+            continue
+        yield row_number, record
+
+
+async def iter_csv_rows(lines: AsyncIterator[str]) -> AsyncIterator[Row]:
+    """Rows of a CSV with a header line, quoted fields may span lines"""
+    header = None
+    row_number = 0
+    record_lines = []
+    async for line in lines:
+        record_lines.append(line)
+        # An odd number of quotes means a quoted field is still open
+        if sum(part.count('"') for part in record_lines) % 2:
+            continue
+
+        text = "\n".join(record_lines)
+        record_lines = []
+        if not text.strip():
+            continue
+
+        values = next(csv.reader(io.StringIO(text)))
+        if header is None:
+            header = values
+            continue
+
+        row_number += 1
+        yield row_number, dict(zip(header, values))
+
+    if record_lines:
+        yield row_number + 1, "Unterminated quoted field"
+
+
+def _format_validation_error(error: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(str(loc) for loc in e['loc'])}: {e['msg']}"
+        for e in error.errors()
+    )
+
+
+# ==================================================================
+# Loading
+# ==================================================================
+def _insert_batch(
+    db: Session,
+    batch: List[Tuple[int, schemas.ProductIn]],
+    report: ImportReport,
+    before_commit: crud.BeforeCommit
+):
+    existing_skus = crud.get_existing_skus(
+        db, [product_in.sku for _, product_in in batch]
+    )
+
+    new_rows = []
+    for row_number, product_in in batch:
+        if product_in.sku in existing_skus:
+            report.add_error(row_number, "SKU already exists")
+        else:
+            new_rows.append((row_number, product_in))
+
+    while new_rows:
+        try:
+            product_ids = crud.create_products(
+                db, [product_in for _, product_in in new_rows], before_commit
+            )
+        except IntegrityError:
+            # Another request took some of the SKUs after we checked them,
+            # the batch is rolled back and retried without those
+            db.rollback()
+            taken_skus = crud.get_existing_skus(
+                db, [product_in.sku for _, product_in in new_rows]
+            )
+            if not taken_skus:
+                raise
+            remaining_rows = []
+            for row_number, product_in in new_rows:
+                if product_in.sku in taken_skus:
+                    report.add_error(
+                        row_number,
+                        "Conflicts with a product created meanwhile"
+                    )
+                else:
+                    remaining_rows.append((row_number, product_in))
+            new_rows = remaining_rows
+            continue
+
+        report.product_ids += product_ids
+        report.created += len(new_rows)
+        return
+
+
+async def import_products(
+    db: Session,
+    rows: AsyncIterator[Row],
+    batch_size: int = config.IMPORT_BATCH_SIZE,
+    before_commit: crud.BeforeCommit = None
+) -> ImportReport:
+    """Validate the rows and insert them in transactions of batch_size
+
+    The DB work runs in the threadpool so other requests aren't blocked
+    while a batch is being written. `before_commit` is called for every
+    batch with the IDs of its products.
+    """
+    report = ImportReport()
+    seen_skus = set()
+    batch = []
+
+    async for row_number, row in rows:
+        if isinstance(row, str):
+            report.add_error(row_number, row)
+            continue
+
+        try:
+            product_in = schemas.ProductIn(**row)
+        except ValidationError as e:
+            report.add_error(row_number, _format_validation_error(e))
+            continue
+
+        if product_in.sku in seen_skus:
+            report.add_error(row_number, "SKU repeated in this import")
+            continue
+        seen_skus.add(product_in.sku)
+
+        batch.append((row_number, product_in))
+        if len(batch) >= batch_size:
+            await run_in_threadpool(_insert_batch, db, batch, report,
+                                    before_commit)
+            batch = []
+
+    if batch:
+        await run_in_threadpool(_insert_batch, db, batch, report,
+                                before_commit)
+
+    return report
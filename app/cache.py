@@ -0,0 +1,146 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+from . import config
+
+# Returned by LRUCache.get() when the key isn't cached, None is a valid value
+MISSING = object()
+
+
+class LRUCache:
+    """Thread safe LRU cache whose entries also expire after a TTL
+
+    A max_size of 0 disables the cache, every get() is then a miss.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        ttl: float,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # Bumped by every invalidation, see set()
+        self.generation = 0
+
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > self.clock():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return MISSING
+
+    def set(
+        self,
+        key: Hashable,
+        value: Any,
+        ttl: Optional[float] = None,
+        generation: Optional[int] = None
+    ):
+        """Cache a value, `ttl` defaults to the one of the cache
+
+        Pass the `generation` read before loading the value to discard it
+        if an invalidation happened in the meantime, otherwise a value
+        loaded before a write could be cached after it.
+        """
+        if self.max_size <= 0:
+            return
+
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = (self.clock() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+# Product details by ID
+product_cache = LRUCache(config.PRODUCT_CACHE_SIZE, config.PRODUCT_CACHE_TTL)
+
+# Pages of the product list, adding or removing products invalidates them
+product_list_cache = LRUCache(config.PRODUCT_LIST_CACHE_SIZE,
+                              config.PRODUCT_CACHE_TTL)
+
+# Pages of the filtered/sorted product list, any write invalidates them
+product_query_cache = LRUCache(config.PRODUCT_QUERY_CACHE_SIZE,
+                               config.PRODUCT_CACHE_TTL)
+
+# Authenticated users (schemas.UserOut) by email, user writes invalidate them
+principal_cache = LRUCache(config.PRINCIPAL_CACHE_SIZE,
+                           config.PRINCIPAL_CACHE_TTL)
+
+
+class CatalogVersion:
+    """Counter bumped by every product write, used to build HTTP validators
+
+    The counter only sees the writes made by this process. Other workers
+    (or anything else writing to the DB) are picked up once the cached
+    products expire, so the validators also roll over every `ttl` seconds.
+    """
+
+    def __init__(self, ttl: float, clock: Callable[[], float] = time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self.process_id = uuid.uuid4().hex[:8]
+        self.version = 0
+        self.modified_at = clock()
+        self._lock = threading.Lock()
+
+    def bump(self):
+        with self._lock:
+            self.version += 1
+            self.modified_at = self.clock()
+
+    def validators(self) -> Tuple[str, float]:
+        """ETag and last modification timestamp of the catalog"""
+        now = self.clock()
+        epoch = int(now // self.ttl) if self.ttl > 0 else 0
+        with self._lock:
+            etag = f'W/"{self.process_id}-{self.version}-{epoch}"'
+            modified_at = max(self.modified_at, epoch * self.ttl)
+        return etag, modified_at
+
+
+catalog_version = CatalogVersion(config.PRODUCT_CACHE_TTL)
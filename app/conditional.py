@@ -0,0 +1,57 @@
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Optional
+
+from fastapi import Request, Response
+
+from . import cache
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    # Weak comparison, as required for If-None-Match
+    if if_none_match.strip() == "*":
+        return True
+    opaque_tag = etag.replace("W/", "", 1)
+    return any(
+        candidate.strip().replace("W/", "", 1) == opaque_tag
+        for candidate in if_none_match.split(",")
+    )
+
+
+def _not_modified_since(if_modified_since: str, modified_at: float) -> bool:
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since is None or since.tzinfo is None:
+        return False
+    # HTTP dates have a resolution of one second
+    return int(modified_at) <= since.timestamp()
+
+
+def catalog_not_modified(
+    request: Request,
+    response: Response
+) -> Optional[Response]:
+    """Add the catalog validators to the response and check the request's
+
+    Returns a 304 response if the client's copy is still current, in which
+    case there's no body to build or send.
+    """
+    etag, modified_at = cache.catalog_version.validators()
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(modified_at, usegmt=True),
+    }
+    response.headers.update(headers)
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        not_modified = _etag_matches(if_none_match, etag)
+    else:
+        if_modified_since = request.headers.get("if-modified-since")
+        not_modified = if_modified_since is not None and \
+            _not_modified_since(if_modified_since, modified_at)
+
+    if not_modified:
+        return Response(status_code=304, headers=headers)
+    return None
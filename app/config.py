@@ -1,3 +1,5 @@
+import os
+
 # TODO: This kind of secret shouldn't be in the repo
 #
 # It was left here as this is just a demo, but as soon as possible it should
@@ -23,3 +25,122 @@ INITIAL_PRODUCTS = [
   dict(id=2, sku="B00U26V4VQ", name="Catan classic", brand="Catan Studio",
        price="1140.26", description="Classic board game"),
 ]
+
+# Anonymous product hits are buffered in memory and written in batches,
+# see hits.py. A batch is flushed every HITS_FLUSH_INTERVAL seconds or as
+# soon as HITS_FLUSH_SIZE hits are waiting, whatever happens first. Hits
+# that arrive while HITS_MAX_BUFFER are already pending are dropped.
+HITS_FLUSH_SIZE = int(os.environ.get("HITS_FLUSH_SIZE", 500))
+HITS_FLUSH_INTERVAL = float(os.environ.get("HITS_FLUSH_INTERVAL", 2.0))
+HITS_MAX_BUFFER = int(os.environ.get("HITS_MAX_BUFFER", 50000))
+
+# Number of products tracked by each of the trending sketches, see
+# trending.py. Products outside the top ones are approximated.
+TRENDING_CAPACITY = int(os.environ.get("TRENDING_CAPACITY", 1000))
+
+# List endpoints are paginated with an `id` cursor, see pagination.py
+PAGE_SIZE = int(os.environ.get("PAGE_SIZE", 100))
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", 1000))
+
+# Rows fetched from the DB per round trip by the catalog export
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", 1000))
+
+# POST /products/bulk inserts the products in transactions of this size and
+# reports at most IMPORT_MAX_ERRORS failed rows in detail
+IMPORT_BATCH_SIZE = int(os.environ.get("IMPORT_BATCH_SIZE", 5000))
+IMPORT_MAX_ERRORS = int(os.environ.get("IMPORT_MAX_ERRORS", 1000))
+
+# Largest list of IDs accepted by the bulk update/delete endpoints
+BULK_MAX_IDS = int(os.environ.get("BULK_MAX_IDS", 10000))
+
+# In-memory caches of product reads, see cache.py. The write paths
+# invalidate them, the TTL (seconds) bounds how stale they can get if
+# something else writes to the DB. A size of 0 disables a cache.
+PRODUCT_CACHE_SIZE = int(os.environ.get("PRODUCT_CACHE_SIZE", 10000))
+PRODUCT_LIST_CACHE_SIZE = int(os.environ.get("PRODUCT_LIST_CACHE_SIZE", 1000))
+PRODUCT_QUERY_CACHE_SIZE = int(
+    os.environ.get("PRODUCT_QUERY_CACHE_SIZE", 1000)
+)
+PRODUCT_CACHE_TTL = float(os.environ.get("PRODUCT_CACHE_TTL", 60))
+
+# Authenticated users are cached by email until their token expires, the
+# TTL (seconds) bounds how long a user deleted by another worker can last
+PRINCIPAL_CACHE_SIZE = int(os.environ.get("PRINCIPAL_CACHE_SIZE", 1000))
+PRINCIPAL_CACHE_TTL = float(os.environ.get("PRINCIPAL_CACHE_TTL", 60))
+
+# Password hashing runs in its own pool of processes, see hashing.py. At
+# most HASHING_MAX_PENDING hashes can be queued or running and requests
+# wait HASHING_TIMEOUT seconds at most. 0 workers hash in the caller thread.
+HASHING_WORKERS = int(os.environ.get("HASHING_WORKERS", 2))
+HASHING_MAX_PENDING = int(os.environ.get("HASHING_MAX_PENDING", 32))
+HASHING_TIMEOUT = float(os.environ.get("HASHING_TIMEOUT", 5.0))
+
+# Notifications go through an outbox table, see outbox.py. Every SES call
+# covers up to NOTIFICATION_BATCH_SIZE addressees (SES allows 50), failed
+# sends are retried after NOTIFICATION_RETRY_DELAY seconds up to
+# NOTIFICATION_MAX_ATTEMPTS times. Leftovers are looked for every
+# NOTIFICATION_DISPATCH_INTERVAL seconds.
+NOTIFICATION_BATCH_SIZE = int(os.environ.get("NOTIFICATION_BATCH_SIZE", 50))
+NOTIFICATION_RETRY_DELAY = float(
+    os.environ.get("NOTIFICATION_RETRY_DELAY", 60)
+)
+NOTIFICATION_MAX_ATTEMPTS = int(
+    os.environ.get("NOTIFICATION_MAX_ATTEMPTS", 5)
+)
+NOTIFICATION_DISPATCH_INTERVAL = float(
+    os.environ.get("NOTIFICATION_DISPATCH_INTERVAL", 10)
+)
+
+# Notifications for an admin are held this many seconds and whatever piles
+# up in the meantime is sent as a single digest, 0 sends them right away
+NOTIFICATION_DIGEST_WINDOW = float(
+    os.environ.get("NOTIFICATION_DIGEST_WINDOW", 300)
+)
+
+# SQLite tuning, see database.py. DB_PROFILE picks the pragmas applied to
+# every connection: "wal" (WAL journal, relaxed syncing, bigger caches) or
+# "default" to keep SQLite's own settings. The DB_* pragma variables
+# override a single value of the profile.
+DB_PROFILE = os.environ.get("DB_PROFILE", "wal")
+DB_JOURNAL_MODE = os.environ.get("DB_JOURNAL_MODE")
+DB_SYNCHRONOUS = os.environ.get("DB_SYNCHRONOUS")
+DB_MMAP_SIZE = os.environ.get("DB_MMAP_SIZE")
+DB_CACHE_SIZE = os.environ.get("DB_CACHE_SIZE")
+DB_BUSY_TIMEOUT = os.environ.get("DB_BUSY_TIMEOUT")
+DB_TEMP_STORE = os.environ.get("DB_TEMP_STORE")
+
+# Connections kept open by the writer engine. Under load up to
+# DB_MAX_OVERFLOW more are opened and closed once returned, -1 (the
+# default) doesn't limit them. A sync session only gives its connection
+# back from a threadpool job queued after the response, so a checkout that
+# waits can hold the very threads those jobs need. With a limit, keep it
+# well above THREADPOOL_WORKERS: a session waits DB_POOL_TIMEOUT seconds
+# at most and then fails.
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", -1))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 5))
+
+# The GET endpoints run on read-only connections of their own, sized apart
+# from the writer ones. Each of the sync and async reader engines gets
+# this many.
+DB_READ_POOL_SIZE = int(os.environ.get("DB_READ_POOL_SIZE", 10))
+DB_READ_MAX_OVERFLOW = int(os.environ.get("DB_READ_MAX_OVERFLOW", -1))
+
+# Threads running the sync endpoints and dependencies, Python's default
+# for a ThreadPoolExecutor unless set
+THREADPOOL_WORKERS = int(
+    os.environ.get("THREADPOOL_WORKERS", min(32, (os.cpu_count() or 1) + 4))
+)
+
+# SQL statements are timed per request, see metrics.py. With
+# SQL_DEBUG_HEADERS set every response carries the number of statements it
+# took and their time (X-SQL-Queries and X-SQL-Time-Ms). Statements slower
+# than SLOW_QUERY_MS are logged, and so are the ones run at least
+# REPEATED_STATEMENT_THRESHOLD times in a single request (0 disables it).
+SQL_DEBUG_HEADERS = os.environ.get("SQL_DEBUG_HEADERS", "").lower() in (
+    "1", "true", "yes"
+)
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 100))
+REPEATED_STATEMENT_THRESHOLD = int(
+    os.environ.get("REPEATED_STATEMENT_THRESHOLD", 10)
+)
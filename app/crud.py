@@ -1,8 +1,22 @@
-from typing import Optional, List
-
+import json
+import time
+from datetime import datetime, timedelta
+from collections import Counter
+from decimal import Decimal
+from typing import (
+    Callable, Optional, Dict, List, Iterable, Iterator, Set, Tuple
+)
+
+from sqlalchemy import or_, tuple_
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.orm import Session
+from sqlalchemy.sql import func, literal, select
+
+from . import models, schemas, security, cache, serialization, search
 
-from . import models, schemas, security
+# The product writes call it with the IDs of the written products right
+# before committing, whatever it adds to the session commits along with them
+BeforeCommit = Optional[Callable[[List[int]], None]]
 
 
 # ==================================================================
@@ -16,10 +30,58 @@ def get_all_users(db: Session) -> List[models.User]:
     return db.query(models.User).all()
 
 
+def get_users_page(
+    db: Session,
+    after_id: Optional[int],
+    limit: int
+) -> List[models.User]:
+    """Up to `limit` users with an ID greater than `after_id`"""
+    query = db.query(models.User)
+    if after_id is not None:
+        query = query.filter(models.User.id > after_id)
+    return query.order_by(models.User.id).limit(limit).all()
+
+
 def get_user_by_email(db: Session, email: str) -> Optional[models.User]:
     return db.query(models.User).filter(models.User.email == email).first()
 
 
+def get_principal(
+    db: Session,
+    email: str,
+    expires_at: float
+) -> Optional[schemas.UserOut]:
+    """The user a token was issued to, cached until the token expires
+
+    Returns a snapshot of the user instead of the model so it can be
+    shared between requests (and their sessions).
+    """
+    principal = cache.principal_cache.get(email)
+    if principal is not cache.MISSING:
+        return principal
+
+    generation = cache.principal_cache.generation
+    return cache_principal(get_user_by_email(db, email), expires_at,
+                           generation)
+
+
+def cache_principal(
+    user: Optional[models.User],
+    expires_at: float,
+    generation: int
+) -> Optional[schemas.UserOut]:
+    """Snapshot of a user just loaded by get_principal(), cached"""
+    if user is None:
+        return None
+
+    principal = schemas.UserOut.from_orm(user)
+    ttl = min(cache.principal_cache.ttl, expires_at - time.time())
+    if ttl > 0:
+        cache.principal_cache.set(user.email, principal, ttl=ttl,
+                                  generation=generation)
+    return principal
+
+
 def create_user(db: Session, user_in: schemas.UserIn) -> models.User:
     new_user = models.User(
         email=user_in.email,
@@ -37,6 +99,7 @@ def update_user(
     user_db: models.User,
     user_in: schemas.UserIn
 ) -> models.User:
+    previous_email = user_db.email
     fields_to_update = user_in.dict(exclude_unset=True)
 
     if "password" in fields_to_update:
@@ -50,25 +113,19 @@ def update_user(
 
     db.add(user_db)
     db.commit()
+    cache.principal_cache.invalidate(previous_email)
     db.refresh(user_db)
     return user_db
 
 
 def delete_user(db: Session, user_db: models.User):
+    email = user_db.email
     db.delete(user_db)
     db.commit()
+    cache.principal_cache.invalidate(email)
 
 
-def authenticate_user(db: Session, email: str, password: str):
-    user = get_user_by_email(db, email)
-    if not user:
-        return False
-    if not security.verify_password(password, user.hashed_password):
-        return False
-    return user
-
-
-def get_users_other_than(db: Session, user_db: models.User):
+def get_users_other_than(db: Session, user_db: schemas.UserOut):
     return db.query(models.User).filter(
         models.User.id != user_db.id,
         models.User.is_admin
@@ -82,6 +139,90 @@ def get_all_products(db: Session) -> List[models.Product]:
     return db.query(models.Product).all()
 
 
+# Name and type of the cursor key used by each sort order, besides the ID
+PRODUCT_SORT_KEYS = {
+    schemas.ProductSort.id: {},
+    schemas.ProductSort.price: {"price": (int, float)},
+    schemas.ProductSort.price_desc: {"price": (int, float)},
+    schemas.ProductSort.name: {"name": str},
+}
+
+_PRODUCT_SORT_COLUMNS = {
+    schemas.ProductSort.id: [],
+    schemas.ProductSort.price: [models.Product.price],
+    schemas.ProductSort.price_desc: [models.Product.price],
+    schemas.ProductSort.name: [models.Product.name],
+}
+
+
+def product_list_statement(
+    filters: schemas.ProductFilter,
+    after: Optional[tuple],
+    limit: Optional[int]
+):
+    """SELECT of the keys (sort column, ID) of a page of the product list
+
+    `after` is the key of the last product of the previous page, the
+    comparison is done on the whole key so it can use the indexes.
+    """
+    columns = _PRODUCT_SORT_COLUMNS[filters.sort] + [models.Product.id]
+    descending = filters.sort == schemas.ProductSort.price_desc
+
+    statement = select(*columns)
+    if filters.brand is not None:
+        statement = statement.where(models.Product.brand == filters.brand)
+    if filters.min_price is not None:
+        statement = statement.where(models.Product.price >= filters.min_price)
+    if filters.max_price is not None:
+        statement = statement.where(models.Product.price <= filters.max_price)
+
+    if after is not None:
+        key = tuple_(*columns)
+        statement = statement.where(
+            key < after if descending else key > after
+        )
+
+    statement = statement.order_by(
+        *[column.desc() if descending else column for column in columns]
+    )
+    if limit is not None:
+        statement = statement.limit(limit)
+    return statement
+
+
+def product_keys(rows: Iterable[tuple]) -> List[tuple]:
+    """Product list keys from result rows, prices as floats"""
+    return [
+        tuple(float(value) if isinstance(value, Decimal) else value
+              for value in row)
+        for row in rows
+    ]
+
+
+def get_product_keys_page(
+    db: Session,
+    filters: schemas.ProductFilter,
+    after: Optional[tuple],
+    limit: Optional[int]
+) -> List[tuple]:
+    """Keys of up to `limit` products after the `after` key, in order"""
+    return product_keys(
+        db.execute(product_list_statement(filters, after, limit))
+    )
+
+
+def iter_products(db: Session, batch_size: int) -> Iterator[tuple]:
+    """Every product as a plain row, fetched `batch_size` rows at a time"""
+    return db.query(
+        models.Product.id,
+        models.Product.sku,
+        models.Product.name,
+        models.Product.price,
+        models.Product.brand,
+        models.Product.description,
+    ).order_by(models.Product.id).yield_per(batch_size)
+
+
 def get_single_product(
     db: Session,
     product_id: int
@@ -91,16 +232,272 @@ def get_single_product(
     ).first()
 
 
+def get_serialized_products(
+    db: Session,
+    product_ids: List[int]
+) -> Dict[int, serialization.SerializedProduct]:
+    """Pre-serialized JSON of the given products, by ID
+
+    Served from cache.product_cache, products that aren't cached are
+    loaded with a single query. Unknown IDs are left out.
+    """
+    products, missing = get_cached_products(product_ids)
+    if missing:
+        generation = cache.product_cache.generation
+        products.update(cache_products(get_products_by_ids(db, missing),
+                                       generation))
+    return products
+
+
+def get_cached_products(
+    product_ids: List[int]
+) -> Tuple[Dict[int, serialization.SerializedProduct], List[int]]:
+    """The cached products by ID, and the IDs that aren't cached"""
+    products = {}
+    missing = []
+    for product_id in product_ids:
+        product = cache.product_cache.get(product_id)
+        if product is cache.MISSING:
+            missing.append(product_id)
+        else:
+            products[product_id] = product
+    return products, missing
+
+
+def cache_products(
+    db_products: Iterable[models.Product],
+    generation: int
+) -> Dict[int, serialization.SerializedProduct]:
+    """Serialize and cache products loaded by get_serialized_products()"""
+    products = {}
+    for db_product in db_products:
+        product = serialization.serialize_product(db_product)
+        cache.product_cache.set(db_product.id, product,
+                                generation=generation)
+        products[db_product.id] = product
+    return products
+
+
+def get_product_details_json(db: Session, product_id: int) -> Optional[bytes]:
+    product = get_serialized_products(db, [product_id]).get(product_id)
+    return product.details if product else None
+
+
+def get_product_list_keys(
+    db: Session,
+    filters: schemas.ProductFilter,
+    after: Optional[tuple],
+    limit: Optional[int]
+) -> List[tuple]:
+    """Keys of a page of the product list (or all of it if there's no
+    limit), the ID is always the last value of the key
+
+    The default listing is served from cache.product_list_cache and the
+    filtered or sorted ones from cache.product_query_cache.
+    """
+    list_cache, cache_key = product_list_cache_key(filters, after, limit)
+    keys = list_cache.get(cache_key)
+    if keys is cache.MISSING:
+        generation = list_cache.generation
+        keys = get_product_keys_page(db, filters, after, limit)
+        list_cache.set(cache_key, keys, generation=generation)
+    return keys
+
+
+def product_list_cache_key(
+    filters: schemas.ProductFilter,
+    after: Optional[tuple],
+    limit: Optional[int]
+) -> Tuple[cache.LRUCache, tuple]:
+    """Cache and key holding a page of the product list"""
+    if filters.is_default():
+        list_cache = cache.product_list_cache
+    else:
+        list_cache = cache.product_query_cache
+    return list_cache, (tuple(filters.dict().values()), after, limit)
+
+
+def get_product_list_json(db: Session, product_ids: List[int]) -> bytes:
+    """JSON array of the given products, assembled from cached items"""
+    return product_list_json(get_serialized_products(db, product_ids),
+                             product_ids)
+
+
+def product_list_json(
+    products: Dict[int, serialization.SerializedProduct],
+    product_ids: List[int]
+) -> bytes:
+    return serialization.json_array(
+        products[product_id].summary
+        for product_id in product_ids
+        if product_id in products
+    )
+
+
+def invalidate_product_caches(
+    product_ids: Iterable[int] = (),
+    list_changed: bool = True
+):
+    """Called after every committed product write
+
+    Only the written products are serialized again, the cached pages of
+    the default product list just hold IDs so they only have to go when
+    products are added or removed. Filtered or sorted pages depend on the
+    values of the products so they always go.
+    """
+    for product_id in product_ids:
+        cache.product_cache.invalidate(product_id)
+    if list_changed:
+        cache.product_list_cache.clear()
+    cache.product_query_cache.clear()
+    cache.catalog_version.bump()
+
+
+def products_by_ids_statement(product_ids: Iterable[int]):
+    return select(models.Product).where(
+        models.Product.id.in_(list(product_ids))
+    )
+
+
+def get_products_by_ids(
+    db: Session,
+    product_ids: Iterable[int]
+) -> List[models.Product]:
+    return db.execute(
+        products_by_ids_statement(product_ids)
+    ).scalars().all()
+
+
 def increment_product_hits(db: Session, db_product: models.Product):
-    new_hit = models.ProductHit(product_id=db_product.id)
-    db.add(new_hit)
+    create_product_hits(db, [(db_product.id, datetime.utcnow())])
+
+
+def create_product_hits(
+    db: Session,
+    hits: Iterable[Tuple[int, datetime]]
+):
+    """Bulk insert (product_id, seen_at) pairs in a single transaction
+
+    The per product totals in product_hit_counts are updated in the same
+    transaction, so they never drift from the raw rows.
+    """
+    hits = list(hits)
+    db.execute(
+        models.ProductHit.__table__.insert(),
+        [
+            {"product_id": product_id, "seen_at": seen_at}
+            for product_id, seen_at in hits
+        ]
+    )
+
+    counts = Counter(product_id for product_id, _ in hits)
+    table = models.ProductHitCount.__table__
+    upsert = insert(table)
+    db.execute(
+        upsert.on_conflict_do_update(
+            index_elements=[table.c.product_id],
+            set_={"hits": table.c.hits + upsert.excluded.hits}
+        ),
+        [
+            {"product_id": product_id, "hits": count}
+            for product_id, count in counts.items()
+        ]
+    )
+
+    buckets = Counter(
+        (product_id, granularity, hit_bucket_start(seen_at, granularity))
+        for product_id, seen_at in hits
+        for granularity in schemas.HitGranularity
+    )
+    table = models.ProductHitBucket.__table__
+    upsert = insert(table)
+    db.execute(
+        upsert.on_conflict_do_update(
+            index_elements=[table.c.product_id, table.c.granularity,
+                            table.c.bucket_start],
+            set_={"hits": table.c.hits + upsert.excluded.hits}
+        ),
+        [
+            {"product_id": product_id, "granularity": granularity.value,
+             "bucket_start": bucket_start, "hits": count}
+            for (product_id, granularity, bucket_start), count
+            in buckets.items()
+        ]
+    )
     db.commit()
 
 
-def get_product_hits(db: Session, db_product: models.Product):
-    return db.query(models.ProductHit).filter(
-        models.ProductHit.product_id == db_product.id
-    ).count()
+def hit_bucket_start(
+    seen_at: datetime,
+    granularity: schemas.HitGranularity
+) -> datetime:
+    """Start of the bucket that contains seen_at"""
+    bucket_start = seen_at.replace(minute=0, second=0, microsecond=0)
+    if granularity == schemas.HitGranularity.day:
+        bucket_start = bucket_start.replace(hour=0)
+    return bucket_start
+
+
+def get_product_hits(db: Session, db_product: models.Product) -> int:
+    return db.query(models.ProductHitCount.hits).filter(
+        models.ProductHitCount.product_id == db_product.id
+    ).scalar() or 0
+
+
+def get_product_hit_buckets(
+    db: Session,
+    db_product: models.Product,
+    granularity: schemas.HitGranularity,
+    start: datetime,
+    end: datetime
+) -> List[models.ProductHitBucket]:
+    """Non-empty buckets that start in [start, end)"""
+    return db.query(models.ProductHitBucket).filter(
+        models.ProductHitBucket.product_id == db_product.id,
+        models.ProductHitBucket.granularity == granularity.value,
+        models.ProductHitBucket.bucket_start >= start,
+        models.ProductHitBucket.bucket_start < end
+    ).order_by(models.ProductHitBucket.bucket_start).all()
+
+
+# Same text format SQLAlchemy uses to store DateTime columns in sqlite, the
+# rebuilt buckets must compare equal to the ones inserted from Python
+_BUCKET_FORMATS = {
+    schemas.HitGranularity.hour: "%Y-%m-%d %H:00:00.000000",
+    schemas.HitGranularity.day: "%Y-%m-%d 00:00:00.000000",
+}
+
+
+def rebuild_product_hit_counts(db: Session) -> int:
+    """Recompute the hit totals and buckets from the raw product_hits rows"""
+    db.query(models.ProductHitCount).delete()
+    db.execute(
+        models.ProductHitCount.__table__.insert().from_select(
+            ["product_id", "hits"],
+            db.query(
+                models.ProductHit.product_id,
+                func.count(models.ProductHit.id)
+            ).group_by(models.ProductHit.product_id)
+        )
+    )
+
+    db.query(models.ProductHitBucket).delete()
+    for granularity, bucket_format in _BUCKET_FORMATS.items():
+        bucket_start = func.strftime(bucket_format,
+                                     models.ProductHit.seen_at)
+        db.execute(
+            models.ProductHitBucket.__table__.insert().from_select(
+                ["product_id", "granularity", "bucket_start", "hits"],
+                db.query(
+                    models.ProductHit.product_id,
+                    literal(granularity.value),
+                    bucket_start,
+                    func.count(models.ProductHit.id)
+                ).group_by(models.ProductHit.product_id, bucket_start)
+            )
+        )
+    db.commit()
+    return db.query(models.ProductHitCount).count()
 
 
 def get_product_by_sku(db: Session, sku: str) -> Optional[models.Product]:
@@ -109,19 +506,62 @@ def get_product_by_sku(db: Session, sku: str) -> Optional[models.Product]:
 
 def create_product(
     db: Session,
-    product_in: schemas.ProductIn
+    product_in: schemas.ProductIn,
+    before_commit: BeforeCommit = None
 ) -> models.Product:
     new_product = models.Product(**product_in.dict())
     db.add(new_product)
+    db.flush()
+    search.index_products(db, models.Product.id == new_product.id)
+    if before_commit:
+        before_commit([new_product.id])
     db.commit()
+    invalidate_product_caches()
     db.refresh(new_product)
     return new_product
 
 
+def get_existing_skus(db: Session, skus: Iterable[str]) -> Set[str]:
+    """The subset of the given SKUs that are already in use"""
+    return {
+        sku for sku, in db.query(models.Product.sku).filter(
+            models.Product.sku.in_(list(skus))
+        )
+    }
+
+
+def create_products(
+    db: Session,
+    products_in: List[schemas.ProductIn],
+    before_commit: BeforeCommit = None
+) -> List[int]:
+    """Insert several products in a single transaction, returns their IDs"""
+    if not products_in:
+        return []
+    db.execute(
+        models.Product.__table__.insert(),
+        [product_in.dict() for product_in in products_in]
+    )
+    criteria = models.Product.sku.in_(
+        [product_in.sku for product_in in products_in]
+    )
+    search.index_products(db, criteria)
+    product_ids = [
+        product_id for product_id,
+        in db.query(models.Product.id).filter(criteria)
+    ]
+    if before_commit:
+        before_commit(product_ids)
+    db.commit()
+    invalidate_product_caches()
+    return product_ids
+
+
 def update_product(
     db: Session,
     product_db: models.Product,
-    product_in: schemas.ProductIn
+    product_in: schemas.ProductIn,
+    before_commit: BeforeCommit = None
 ) -> models.Product:
     fields_to_update = product_in.dict(exclude_unset=True)
 
@@ -129,11 +569,194 @@ def update_product(
         setattr(product_db, field, value)
 
     db.add(product_db)
+    db.flush()
+    search.index_products(db, models.Product.id == product_db.id)
+    if before_commit:
+        before_commit([product_db.id])
     db.commit()
+    invalidate_product_caches([product_db.id], list_changed=False)
     db.refresh(product_db)
     return product_db
 
 
-def delete_product(db: Session, product_db: models.Product):
+def delete_product(
+    db: Session,
+    product_db: models.Product,
+    before_commit: BeforeCommit = None
+):
     db.delete(product_db)
+    search.unindex_products(db, [product_db.id])
+    if before_commit:
+        before_commit([product_db.id])
+    db.commit()
+    invalidate_product_caches([product_db.id])
+
+
+def _selection_criteria(selection: schemas.ProductSelection):
+    if selection.ids is not None:
+        return models.Product.id.in_(selection.ids)
+    return models.Product.brand == selection.brand
+
+
+def update_products(
+    db: Session,
+    selection: schemas.ProductSelection,
+    changes: schemas.ProductChanges,
+    before_commit: BeforeCommit = None
+) -> List[int]:
+    """Apply the same changes to every selected product in one UPDATE
+
+    Returns the IDs of the updated products.
+    """
+    criteria = _selection_criteria(selection)
+    product_ids = [
+        product_id for product_id,
+        in db.query(models.Product.id).filter(criteria)
+    ]
+
+    values = changes.dict(exclude_none=True, exclude={"price_factor"})
+    if changes.price_factor is not None:
+        # Prices are stored with cents, like the ones set directly
+        values["price"] = func.round(
+            models.Product.price * changes.price_factor, 2
+        )
+
+    if product_ids:
+        db.query(models.Product).filter(criteria).update(
+            values, synchronize_session=False
+        )
+        search.index_products(db, models.Product.id.in_(product_ids))
+        if before_commit:
+            before_commit(product_ids)
+    db.commit()
+    invalidate_product_caches(product_ids, list_changed=False)
+    return product_ids
+
+
+def delete_products(
+    db: Session,
+    selection: schemas.ProductSelection,
+    before_commit: BeforeCommit = None
+) -> List[int]:
+    """Delete every selected product in one DELETE
+
+    Returns the IDs of the deleted products.
+    """
+    criteria = _selection_criteria(selection)
+    product_ids = [
+        product_id for product_id,
+        in db.query(models.Product.id).filter(criteria)
+    ]
+
+    if product_ids:
+        db.query(models.Product).filter(criteria).delete(
+            synchronize_session=False
+        )
+        search.unindex_products(db, product_ids)
+        if before_commit:
+            before_commit(product_ids)
+    db.commit()
+    invalidate_product_caches(product_ids)
+    return product_ids
+
+
+# ==================================================================
+# Notification outbox utilities
+# ==================================================================
+def enqueue_notifications(
+    db: Session,
+    addressees: Iterable[str],
+    user: str,
+    change: str,
+    action: str,
+    product_ids: List[int]
+):
+    """Add the notifications to the session, committing is up to the
+    caller so they go out only if the change they describe is saved"""
+    created_at = datetime.utcnow()
+    db.bulk_insert_mappings(models.NotificationOutbox, [
+        {
+            "addressee": addressee,
+            "user": user,
+            "change": change,
+            "action": action,
+            "product_ids": json.dumps(product_ids),
+            "created_at": created_at,
+        }
+        for addressee in addressees
+    ])
+
+
+def claim_notifications(
+    db: Session,
+    claimed_by: str,
+    lease: float,
+    limit: int,
+    ready_before: datetime
+) -> List[models.NotificationOutbox]:
+    """Claim the notifications of up to `limit` addressees
+
+    Only addressees whose oldest unclaimed (or abandoned) notification was
+    queued before `ready_before` are picked, and all of their notifications
+    are claimed at once so they can go out in a single digest. The claim is
+    an UPDATE guarded by the same condition as the SELECT, so two
+    dispatchers can never claim the same row.
+    """
+    now = datetime.utcnow()
+    outbox = models.NotificationOutbox
+    claimable = or_(
+        outbox.claimed_until.is_(None),
+        outbox.claimed_until < now
+    )
+    addressees = select(outbox.addressee).where(claimable).group_by(
+        outbox.addressee
+    ).having(
+        func.min(outbox.created_at) <= ready_before
+    ).order_by(func.min(outbox.id)).limit(limit)
+
+    db.query(outbox).filter(
+        outbox.addressee.in_(addressees),
+        claimable
+    ).update({
+        "claimed_by": claimed_by,
+        "claimed_until": now + timedelta(seconds=lease),
+    }, synchronize_session=False)
+    db.commit()
+
+    return db.query(outbox).filter(
+        outbox.claimed_by == claimed_by
+    ).order_by(outbox.id).all()
+
+
+def delete_notifications(db: Session, notification_ids: Iterable[int]):
+    db.query(models.NotificationOutbox).filter(
+        models.NotificationOutbox.id.in_(list(notification_ids))
+    ).delete(synchronize_session=False)
+    db.commit()
+
+
+def release_notifications(
+    db: Session,
+    notification_ids: Iterable[int],
+    retry_delay: float,
+    max_attempts: int
+) -> int:
+    """Make failed notifications claimable again after `retry_delay`
+
+    The ones that already failed `max_attempts` times are dropped, returns
+    how many of them there were.
+    """
+    notification_ids = list(notification_ids)
+    query = db.query(models.NotificationOutbox).filter(
+        models.NotificationOutbox.id.in_(notification_ids)
+    )
+    query.update({
+        "attempts": models.NotificationOutbox.attempts + 1,
+        "claimed_by": None,
+        "claimed_until": datetime.utcnow() + timedelta(seconds=retry_delay),
+    }, synchronize_session=False)
+    dropped = query.filter(
+        models.NotificationOutbox.attempts >= max_attempts
+    ).delete(synchronize_session=False)
     db.commit()
+    return dropped
@@ -1,59 +1,117 @@
-from sqlalchemy import create_engine
+from typing import Dict, Union
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 
-from . import config, security
+from . import config
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./sql_app.db"
+ASYNC_SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///./sql_app.db"
+
+Pragmas = Dict[str, Union[int, str]]
+
+# Pragmas applied to every new connection, by DB_PROFILE
+DB_PROFILES: Dict[str, Pragmas] = {
+    "default": {},
+    # Readers don't block behind writers (nor writers behind readers) and
+    # commits only fsync the WAL at checkpoints, which is still safe
+    # against application crashes
+    "wal": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,  # Negative is in KiB
+        "busy_timeout": 5000,  # ms
+        "temp_store": "MEMORY",
+    },
+}
+
+
+def profile_pragmas(profile: str = config.DB_PROFILE) -> Pragmas:
+    """The pragmas of the profile with the DB_* overrides applied"""
+    if profile not in DB_PROFILES:
+        raise ValueError(f"Unknown DB_PROFILE {profile!r}, expected one "
+                         f"of {', '.join(DB_PROFILES)}")
+    overrides = {
+        "journal_mode": config.DB_JOURNAL_MODE,
+        "synchronous": config.DB_SYNCHRONOUS,
+        "mmap_size": config.DB_MMAP_SIZE,
+        "cache_size": config.DB_CACHE_SIZE,
+        "busy_timeout": config.DB_BUSY_TIMEOUT,
+        "temp_store": config.DB_TEMP_STORE,
+    }
+    pragmas = dict(DB_PROFILES[profile])
+    pragmas.update((name, value) for name, value in overrides.items()
+                   if value is not None)
+    return pragmas
+
+
+def apply_pragmas(engine: Engine, pragmas: Pragmas):
+    """Run the pragmas on every connection the engine opens"""
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+        finally:
+            cursor.close()
+
+
+def engine_settings(engine: Engine, pool_options: dict) -> dict:
+    """Pragmas in effect, as reported by a connection, and the options the
+    engine's pool was created with"""
+    settings = {}
+    with engine.connect() as conn:
+        for name in [*DB_PROFILES["wal"], "query_only"]:
+            settings[name] = conn.exec_driver_sql(f"PRAGMA {name}").scalar()
+    settings.update(pool_options)
+    return settings
+
+
+pragmas = profile_pragmas()
+pool_options = dict(pool_size=config.DB_POOL_SIZE,
+                    max_overflow=config.DB_MAX_OVERFLOW,
+                    pool_timeout=config.DB_POOL_TIMEOUT)
 
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False},
+    poolclass=QueuePool, **pool_options
 )
+apply_pragmas(engine, pragmas)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-Base = declarative_base()
+# Readers get connections of their own that refuse to write, under WAL
+# they never wait for the writer ones (nor the writers for them)
+read_pragmas = dict(pragmas, query_only="ON")
+read_pool_options = dict(pool_size=config.DB_READ_POOL_SIZE,
+                         max_overflow=config.DB_READ_MAX_OVERFLOW,
+                         pool_timeout=config.DB_POOL_TIMEOUT)
 
+read_engine = create_engine(
+    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False},
+    poolclass=QueuePool, **read_pool_options
+)
+apply_pragmas(read_engine, read_pragmas)
 
-def initialize_db():
-    # TODO: delegate DB initalization to migrations library
-    Base.metadata.drop_all(bind=engine)
-    Base.metadata.create_all(bind=engine)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False,
+                                bind=read_engine)
 
-    with engine.connect() as conn:
-        hashed_password = security.get_password_hash(
-            config.FIRST_USER_PASSWORD
-        )
-        conn.execute(
-            """
-                INSERT INTO
-                    users(email, hashed_password, is_admin)
-                    VALUES(:email, :pwd, :is_admin)
-            """,
-            email=config.FIRST_USER_EMAIL,
-            pwd=hashed_password,
-            is_admin=True
-        )
-        hashed_password = security.get_password_hash(
-            config.SECOND_USER_PASSWORD
-        )
-        conn.execute(
-            """
-                INSERT INTO
-                    users(email, hashed_password, is_admin)
-                    VALUES(:email, :pwd, :is_admin)
-            """,
-            email=config.SECOND_USER_EMAIL,
-            pwd=hashed_password,
-            is_admin=True
-        )
-
-        for product in config.INITIAL_PRODUCTS:
-            conn.execute(
-                """
-                    INSERT INTO
-                        products(id, sku, name, brand, price, description)
-                        VALUES(:id, :sku, :name, :brand, :price, :description)
-                """,
-                product
-            )
+# Same DB for the async endpoints, which are all reads. Every aiosqlite
+# connection runs on its own thread, so they're pooled instead of opened
+# for every session.
+async_engine = create_async_engine(
+    ASYNC_SQLALCHEMY_DATABASE_URL, poolclass=AsyncAdaptedQueuePool,
+    **read_pool_options
+)
+apply_pragmas(async_engine.sync_engine, read_pragmas)
+
+AsyncSessionLocal = sessionmaker(async_engine, class_=AsyncSession,
+                                 autoflush=False, expire_on_commit=False)
+
+Base = declarative_base()
@@ -0,0 +1,323 @@
+import argparse
+import itertools
+import random
+import re
+import time
+from datetime import datetime, timezone
+from typing import (
+    Any, Callable, Iterable, Iterator, List, Optional, Tuple
+)
+
+from passlib.hash import bcrypt
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from . import crud, database, migrations, models, search
+
+# Synthetic catalogs and traffic for large scale testing. Everything is
+# drawn from random generators seeded with --seed, one per kind of row, so
+# the same arguments always produce the very same rows.
+
+BRANDS = [
+    "Kingston", "Samsung", "Sony", "LG", "Lenovo", "Logitech", "Philips",
+    "Bosch", "Hasbro", "Lego", "Mattel", "Catan Studio", "Asmodee", "Nike",
+    "Adidas", "Puma", "Canon", "Nikon", "Dell", "HP", "Acer", "Asus",
+    "Xiaomi", "Anker", "JBL", "Bose", "Ikea", "Tefal", "Moulinex", "Braun",
+    "Garmin", "Fitbit", "Nintendo", "Microsoft", "Apple", "Crucial",
+    "Western Digital", "Seagate", "SanDisk", "Corsair",
+]
+
+# (name, median price, description)
+CATEGORIES = [
+    ("SSD Disk", 1500.0, "Fast storage solution"),
+    ("Hard Drive", 1100.0, "Plenty of storage"),
+    ("Memory Card", 250.0, "Storage for cameras and phones"),
+    ("Board game", 900.0, "Fun for the whole family"),
+    ("Puzzle", 300.0, "Hours of concentration"),
+    ("Headphones", 1200.0, "Immersive sound"),
+    ("Speaker", 1800.0, "Room filling sound"),
+    ("Keyboard", 700.0, "Comfortable typing"),
+    ("Mouse", 400.0, "Precise pointing"),
+    ("Monitor", 4500.0, "Sharp picture"),
+    ("Laptop", 18000.0, "Work from anywhere"),
+    ("Camera", 12000.0, "Capture every moment"),
+    ("Sneakers", 1600.0, "Light and comfortable"),
+    ("Blender", 1300.0, "Smoothies in seconds"),
+    ("Smartwatch", 3500.0, "Track your day"),
+]
+
+# Bcrypt salt alphabet, the last character of a salt only takes 4 values
+SALT_CHARS = "./ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789"
+
+USER_EMAIL = re.compile(r"user(\d+)@datagen\.example\.com")
+
+# The way SQLAlchemy stores DateTime in SQLite
+SEEN_AT_FROM_TIMESTAMP = (
+    "strftime('%Y-%m-%d %H:%M:%S', ?, 'unixepoch') || '.000000'"
+)
+
+
+def zipf_cum_weights(count: int, exponent: float) -> List[float]:
+    """Cumulative weights of the ranks 1 to `count` under Zipf's law"""
+    return list(itertools.accumulate(
+        1 / rank ** exponent for rank in range(1, count + 1)
+    ))
+
+
+def generate_products(
+    rng: random.Random,
+    count: int,
+    first_id: int,
+    sku_prefix: str,
+    batch_size: int = 50000
+) -> Iterator[Tuple]:
+    """(id, sku, name, brand, price, description) rows
+
+    A few brands get most of the catalog and prices are log-normal around
+    the median of their category.
+    """
+    brand_weights = zipf_cum_weights(len(BRANDS), 1.0)
+    lognormvariate, random_ = rng.lognormvariate, rng.random
+    for start in range(first_id, first_id + count, batch_size):
+        size = min(batch_size, first_id + count - start)
+        brands = rng.choices(BRANDS, cum_weights=brand_weights, k=size)
+        categories = rng.choices(CATEGORIES, k=size)
+        for product_id, brand, (name, median_price, description) in zip(
+            range(start, start + size), brands, categories
+        ):
+            price = round(lognormvariate(0, 0.5) * median_price, 2)
+            yield (product_id, f"{sku_prefix}{product_id:010d}",
+                   f"{brand} {name} {int(random_() * 999) + 1}", brand,
+                   price, description)
+
+
+def generate_users(
+    rng: random.Random,
+    count: int,
+    first_number: int,
+    hashed_password: str,
+    admin_share: float
+) -> Iterator[Tuple]:
+    """(email, hashed_password, is_admin) rows, all with the same password"""
+    for number in range(first_number, first_number + count):
+        yield (f"user{number}@datagen.example.com", hashed_password,
+               rng.random() < admin_share)
+
+
+def generate_hits(
+    rng: random.Random,
+    count: int,
+    product_ids: List[int],
+    until: datetime,
+    days: float,
+    exponent: float,
+    batch_size: int = 50000
+) -> Iterator[Tuple[int, int]]:
+    """(product_id, seen_at as a UNIX timestamp) rows for the `days` before
+    `until`, which is naive UTC
+
+    Popularity follows Zipf's law over the products in a random order, so
+    the most visited ones aren't simply the lowest IDs.
+    """
+    ranked_ids = list(product_ids)
+    rng.shuffle(ranked_ids)
+    cum_weights = zipf_cum_weights(len(ranked_ids), exponent)
+    until_timestamp = int(until.replace(tzinfo=timezone.utc).timestamp())
+    span = int(days * 24 * 3600)
+    random_ = rng.random
+    for start in range(0, count, batch_size):
+        size = min(batch_size, count - start)
+        hit_ids = rng.choices(ranked_ids, cum_weights=cum_weights, k=size)
+        yield from zip(hit_ids, [until_timestamp - int(random_() * span)
+                                 for _ in range(size)])
+
+
+def without_indexes(engine: Engine, table, load: Callable[[], Any]) -> Any:
+    """Run load() with the secondary indexes of the table dropped
+
+    Building an index once over the loaded rows is much faster than
+    updating it row by row in random order. Unique indexes stay, the rows
+    are committed before the others are rebuilt and nothing else would
+    reject duplicates.
+    """
+    indexes = [index for index in table.indexes if not index.unique]
+    for index in indexes:
+        index.drop(bind=engine)
+    try:
+        return load()
+    finally:
+        for index in indexes:
+            index.create(bind=engine)
+
+
+def insert_rows(
+    engine: Engine,
+    statement: str,
+    rows: Iterable[Tuple],
+    batch_size: int
+) -> int:
+    """executemany() straight on the driver in a single transaction, the
+    ORM and Core per row processing would dominate the load time"""
+    inserted = 0
+    connection = engine.raw_connection()
+    cursor = connection.cursor()
+    try:
+        # A crash halfway means starting over anyway
+        cursor.execute("PRAGMA synchronous=OFF")
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            cursor.executemany(statement, batch)
+            inserted += len(batch)
+        connection.commit()
+    finally:
+        cursor.close()
+        connection.close()
+    return inserted
+
+
+def last_user_number(db: Session) -> int:
+    """Highest N of the userN@datagen.example.com users, 0 if there are none"""
+    numbers = [
+        int(match.group(1)) for email, in db.query(models.User.email).filter(
+            models.User.email.like("user%@datagen.example.com")
+        )
+        for match in [USER_EMAIL.fullmatch(email)] if match
+    ]
+    return max(numbers, default=0)
+
+
+def deterministic_hash(rng: random.Random, password: str) -> str:
+    """A bcrypt hash whose salt comes from the generator too"""
+    salt = "".join(rng.choice(SALT_CHARS) for _ in range(21)) + "."
+    return bcrypt.using(salt=salt).hash(password)
+
+
+def generate(
+    engine: Engine,
+    products: int,
+    users: int,
+    hits: int,
+    seed: int,
+    until: datetime,
+    days: float = 30,
+    password: str = "datagen",
+    admin_share: float = 0.0,
+    skew: float = 1.1,
+    batch_size: int = 50000
+) -> dict:
+    """Add the products, users and hits, returns how long each one took
+
+    New rows come after the ones already there. Hits go to every product
+    in the DB, not only the new ones.
+    """
+    timings = {}
+    with Session(bind=engine) as db:
+        last_product_id = db.query(models.Product.id).order_by(
+            models.Product.id.desc()
+        ).limit(1).scalar() or 0
+        last_user = last_user_number(db)
+
+    started_at = time.perf_counter()
+    without_indexes(engine, models.Product.__table__, lambda: insert_rows(
+        engine,
+        "INSERT INTO products(id, sku, name, brand, price, description) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        generate_products(random.Random(f"{seed}-products"), products,
+                          last_product_id + 1, f"GEN{seed}-", batch_size),
+        batch_size
+    ))
+    with Session(bind=engine) as db:
+        search.index_products(db, models.Product.id > last_product_id)
+        db.commit()
+    timings["products"] = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    users_rng = random.Random(f"{seed}-users")
+    insert_rows(
+        engine,
+        "INSERT INTO users(email, hashed_password, is_admin) "
+        "VALUES (?, ?, ?)",
+        generate_users(users_rng, users, last_user + 1,
+                       deterministic_hash(users_rng, password), admin_share),
+        batch_size
+    )
+    timings["users"] = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    with Session(bind=engine) as db:
+        product_ids = [product_id for product_id,
+                       in db.query(models.Product.id)]
+    if hits and product_ids:
+        without_indexes(engine, models.ProductHit.__table__, lambda: (
+            insert_rows(
+                engine,
+                "INSERT INTO product_hits(product_id, seen_at) "
+                f"VALUES (?, {SEEN_AT_FROM_TIMESTAMP})",
+                generate_hits(random.Random(f"{seed}-hits"), hits,
+                              product_ids, until, days, skew, batch_size),
+                batch_size
+            )
+        ))
+        # The totals and buckets the endpoints read
+        with Session(bind=engine) as db:
+            crud.rebuild_product_hit_counts(db)
+    timings["hits"] = time.perf_counter() - started_at
+
+    return timings
+
+
+def default_until() -> datetime:
+    """Start of the current UTC day, pass --until for repeatable runs"""
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def parse_until(value: Optional[str]) -> datetime:
+    return datetime.fromisoformat(value) if value else default_until()
+
+
+if __name__ == "__main__":  # pragma: no cover
+    parser = argparse.ArgumentParser(
+        description="Fill a DB with a synthetic catalog, users and hits"
+    )
+    parser.add_argument("--db", default="./sql_app.db")
+    parser.add_argument("--products", type=int, default=100000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--hits", type=int, default=1000000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--until", help="last hit time (ISO, UTC), today's "
+                                        "midnight by default")
+    parser.add_argument("--days", type=float, default=30,
+                        help="hits are spread over this many days")
+    parser.add_argument("--skew", type=float, default=1.1,
+                        help="Zipf exponent of the product popularity")
+    parser.add_argument("--password", default="datagen",
+                        help="password of every generated user")
+    parser.add_argument("--admin-share", type=float, default=0.0,
+                        help="fraction of the users that are admins")
+    parser.add_argument("--batch-size", type=int, default=50000)
+    parser.add_argument("--reset", action="store_true",
+                        help="drop every table (but the notification "
+                             "outbox) first")
+    args = parser.parse_args()
+
+    engine = create_engine(f"sqlite:///{args.db}")
+    database.apply_pragmas(engine, database.pragmas)
+    if args.reset:
+        migrations.reset(engine)
+    migrations.migrate(engine)
+
+    timings = generate(
+        engine, args.products, args.users, args.hits, args.seed,
+        parse_until(args.until), args.days, args.password, args.admin_share,
+        args.skew, args.batch_size
+    )
+    for kind, count in [("products", args.products), ("users", args.users),
+                        ("hits", args.hits)]:
+        seconds = timings[kind]
+        print(f"{count:>11} {kind:<8} in {seconds:6.2f}s "
+              f"({count / seconds if seconds else 0:,.0f}/s)")
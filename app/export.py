@@ -0,0 +1,65 @@
+import csv
+import io
+import json
+from itertools import islice
+from typing import Iterable, Iterator
+
+from . import schemas
+
+EXPORT_FIELDS = ["id", "sku", "name", "price", "brand", "description"]
+
+MEDIA_TYPES = {
+    schemas.ExportFormat.ndjson: "application/x-ndjson",
+    schemas.ExportFormat.csv: "text/csv",
+}
+
+
+def _chunks(rows: Iterable, size: int) -> Iterator[list]:
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _as_dict(row) -> dict:
+    product = dict(row._mapping)
+    # Same representation the JSON endpoints use for Decimal
+    product["price"] = float(product["price"])
+    return product
+
+
+def iter_ndjson(rows: Iterable, chunk_size: int) -> Iterator[str]:
+    """One JSON document per product, `chunk_size` products per chunk"""
+    for chunk in _chunks(rows, chunk_size):
+        yield "".join(
+            json.dumps(_as_dict(row), separators=(",", ":")) + "\n"
+            for row in chunk
+        )
+
+
+def iter_csv(rows: Iterable, chunk_size: int) -> Iterator[str]:
+    """CSV with a header line, `chunk_size` products per chunk"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+    writer.writeheader()
+
+    for chunk in _chunks(rows, chunk_size):
+        writer.writerows(_as_dict(row) for row in chunk)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def iter_export(
+    rows: Iterable,
+    export_format: schemas.ExportFormat,
+    chunk_size: int
+) -> Iterator[str]:
+    if export_format == schemas.ExportFormat.csv:
+        return iter_csv(rows, chunk_size)
+    return iter_ndjson(rows, chunk_size)
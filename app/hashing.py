@@ -0,0 +1,199 @@
+import asyncio
+import functools
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Optional
+
+from . import config
+
+
+class HashingPoolBusy(Exception):
+    """The pool couldn't take or finish the job in time, try again later"""
+
+
+class HashingPool:
+    """Bounded process pool for password hashing
+
+    bcrypt is slow on purpose and holds the GIL while it works, running it
+    in other processes keeps the threadpool that serves the endpoints free
+    during bursts of logins. At most `max_pending` jobs are queued or
+    running, more are rejected right away instead of piling up, and callers
+    wait at most `timeout` seconds for the result. With 0 workers the jobs
+    run in the calling thread, still bounded by `max_pending`.
+    """
+
+    def __init__(
+        self,
+        workers: int = config.HASHING_WORKERS,
+        max_pending: int = config.HASHING_MAX_PENDING,
+        timeout: float = config.HASHING_TIMEOUT,
+    ):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+
+        # Counters
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # Forking a process with running threads isn't safe
+                self._executor = ProcessPoolExecutor(
+                    self.workers,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._executor
+
+    def _reset_executor(self, executor: ProcessPoolExecutor):
+        """Drop a broken executor, the next job starts a new one"""
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _enter(self):
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise HashingPoolBusy("Too many pending password hashes")
+            self.pending += 1
+
+    def _exit(
+        self,
+        started_at: float,
+        future: Optional[Future] = None,
+        failed: bool = False
+    ):
+        latency = time.monotonic() - started_at
+        with self._lock:
+            self.pending -= 1
+            if future is not None:
+                if future.cancelled():
+                    return
+                failed = future.exception() is not None
+            # Failures don't count towards the latency
+            if failed:
+                self.failed += 1
+                return
+            self.completed += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def run(self, fn: Callable, *args) -> Any:
+        """Run fn(*args) in the pool and wait for its result
+
+        `fn` has to be a module level function so it can be pickled.
+        Raises HashingPoolBusy if the pool is full, the job times out or a
+        worker died.
+        """
+        self._enter()
+        started_at = time.monotonic()
+
+        if self.workers <= 0:
+            try:
+                result = fn(*args)
+            except BaseException:
+                self._exit(started_at, failed=True)
+                raise
+            self._exit(started_at)
+            return result
+
+        executor = self._get_executor()
+        future = self._submit(executor, started_at, fn, args)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            raise self._timed_out(future)
+        except BrokenProcessPool:
+            raise self._broken(executor)
+
+    async def run_async(self, fn: Callable, *args) -> Any:
+        """Like run(), but awaits the result instead of blocking a thread"""
+        if self.workers <= 0:
+            # The job runs in the calling thread, which can't be the loop's
+            return await asyncio.get_running_loop().run_in_executor(
+                None, functools.partial(self.run, fn, *args)
+            )
+
+        self._enter()
+        started_at = time.monotonic()
+        executor = self._get_executor()
+        future = self._submit(executor, started_at, fn, args)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future),
+                                          self.timeout)
+        except asyncio.TimeoutError:
+            raise self._timed_out(future)
+        except BrokenProcessPool:
+            raise self._broken(executor)
+
+    def _submit(
+        self,
+        executor: ProcessPoolExecutor,
+        started_at: float,
+        fn: Callable,
+        args: tuple
+    ) -> Future:
+        try:
+            future = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self._exit(started_at, failed=True)
+            raise self._broken(executor)
+        except Exception:
+            self._exit(started_at, failed=True)
+            raise
+        # A job that timed out still holds its slot until it's done, so
+        # the workers can't get swamped by jobs nobody is waiting for
+        future.add_done_callback(lambda f: self._exit(started_at, f))
+        return future
+
+    def _timed_out(self, future: Future) -> HashingPoolBusy:
+        future.cancel()
+        with self._lock:
+            self.timed_out += 1
+        return HashingPoolBusy("Timed out waiting for a password hash")
+
+    def _broken(self, executor: ProcessPoolExecutor) -> HashingPoolBusy:
+        # A worker died, the executor can't take any more jobs
+        self._reset_executor(executor)
+        return HashingPoolBusy("The password hashing pool is restarting")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "pending": self.pending,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+                "avg_latency_ms": (
+                    1000 * self.total_latency / self.completed
+                    if self.completed else 0.0
+                ),
+                "max_latency_ms": 1000 * self.max_latency,
+            }
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+password_pool = HashingPool()
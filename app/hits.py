@@ -0,0 +1,160 @@
+import logging
+import threading
+from collections import Counter
+from datetime import datetime
+from typing import Callable, List, Tuple
+
+from sqlalchemy.orm import Session
+
+from . import config, crud
+
+
+class HitRecorder:
+    """Write-behind buffer for anonymous product hits
+
+    Recording a hit only appends it to an in-memory buffer, the actual
+    INSERT happens later in a background thread which writes every pending
+    hit in a single transaction. This keeps the write (and its fsync) out
+    of the request that generated the hit.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        flush_size: int = config.HITS_FLUSH_SIZE,
+        flush_interval: float = config.HITS_FLUSH_INTERVAL,
+        max_buffer: int = config.HITS_MAX_BUFFER,
+    ):
+        self.session_factory = session_factory
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+
+        # Counters
+        self.buffered = 0
+        self.flushed = 0
+        self.dropped = 0
+
+        self._buffer: List[Tuple[int, datetime]] = []
+        self._pending: Counter = Counter()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def record(self, product_id: int):
+        """Buffer a single hit, never touches the DB"""
+        with self._lock:
+            if len(self._buffer) >= self.max_buffer:
+                self.dropped += 1
+                return
+            self._buffer.append((product_id, datetime.utcnow()))
+            self._pending[product_id] += 1
+            self.buffered += 1
+            full = len(self._buffer) >= self.flush_size
+
+        if full:
+            self._wakeup.set()
+
+    def pending(self, product_id: int) -> int:
+        """Hits for this product that haven't been written yet
+
+        A batch stops being pending only after its transaction commits, so
+        for a moment it's both here and in the DB. Readers adding both may
+        briefly count it twice but never miss it, making the commit and
+        the subtraction atomic would block record() during the write.
+        """
+        with self._lock:
+            return self._pending[product_id]
+
+    def flush(self) -> int:
+        """Write every buffered hit in a single transaction
+
+        Returns the number of hits written. If the write fails the batch
+        is discarded and counted as dropped, retrying it could end up
+        blocking the buffer forever.
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch = self._buffer
+                self._buffer = []
+
+            if not batch:
+                return 0
+
+            db = self.session_factory()
+            written = False
+            try:
+                crud.create_product_hits(db, batch)
+                written = True
+            except Exception as e:
+                logging.exception(e)
+                db.rollback()
+            finally:
+                db.close()
+                with self._lock:
+                    if written:
+                        self.flushed += len(batch)
+                    else:
+                        self.dropped += len(batch)
+                    self._pending.subtract(
+                        product_id for product_id, _ in batch
+                    )
+                    self._pending += Counter()  # Drop zeroed entries
+
+            return len(batch)
+
+    def clear(self):
+        """Discard every buffered hit without writing it"""
+        with self._lock:
+            self._buffer = []
+            self._pending.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "buffered": self.buffered,
+                "flushed": self.flushed,
+                "dropped": self.dropped,
+                "pending": len(self._buffer),
+            }
+
+    # --------------------------------------------------------------
+    # Background flushing
+    # --------------------------------------------------------------
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="hit-recorder",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread and write whatever is left"""
+        if self._thread is not None:
+            self._stopping.set()
+            self._wakeup.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):  # pragma: no cover
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+if __name__ == "__main__":  # pragma: no cover
+    import sys
+
+    from .database import SessionLocal
+
+    if len(sys.argv) < 2 or sys.argv[1] != "--backfill":
+        print("Usage: python -m app.hits --backfill")
+    else:
+        with SessionLocal() as db:
+            products = crud.rebuild_product_hit_counts(db)
+        print(f"Rebuilt hit counts for {products} products")
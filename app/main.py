@@ -1,20 +1,143 @@
+import asyncio
 import logging
-from typing import List
-from datetime import timedelta
+import time
+from typing import Callable, List, Optional, Tuple
+from datetime import datetime, timedelta, timezone
 
 import boto3
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import (
+    BackgroundTasks, FastAPI, Depends, HTTPException, Query, Request,
+    Response, status
+)
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
+from fastapi.responses import (
+    JSONResponse, PlainTextResponse, StreamingResponse
+)
 from fastapi.security import OAuth2PasswordRequestForm
 from jose import JWTError
 
-from . import models, crud, schemas, security, config, notification
-from .database import SessionLocal, initialize_db
+from . import (
+    crud, schemas, security, config, notification, hits, trending,
+    pagination, export, bulk_import, cache, conditional, serialization,
+    search, hashing, outbox, async_crud, migrations, metrics
+)
+from .database import (
+    AsyncSessionLocal, ReadSessionLocal, SessionLocal, async_engine, engine,
+    engine_settings, pool_options, read_engine, read_pool_options
+)
 
+# Module imports aside, the time it takes a worker to get ready
+started_at = time.perf_counter()
 
 app = FastAPI()
+app.add_middleware(metrics.MetricsMiddleware)
+
+hit_recorder = hits.HitRecorder(SessionLocal)
+trending_tracker = trending.TrendingTracker()
+notification_dispatcher = outbox.NotificationDispatcher(
+    SessionLocal, lambda: get_ses_client()
+)
+threadpool = metrics.InstrumentedThreadPool(config.THREADPOOL_WORKERS,
+                                            "threadpool")
+
+for instrumented_engine in (engine, read_engine, async_engine.sync_engine):
+    metrics.instrument_engine(instrumented_engine)
+
+metrics.request_metrics.add_gauge(
+    "threadpool_jobs", "Sync endpoints and dependencies, running (busy) or "
+    "waiting for a thread (queued), and the number of threads (max)",
+    lambda: {(("state", state),): count
+             for state, count in threadpool.stats().items()}
+)
+metrics.request_metrics.add_gauge(
+    "db_pool_checked_out_connections", "Connections in use, by engine",
+    lambda: {
+        (("engine", "writer"),): engine.pool.checkedout(),
+        (("engine", "reader"),): read_engine.pool.checkedout(),
+        (("engine", "async_reader"),): async_engine.pool.checkedout(),
+    }
+)
+
+
+@app.on_event("startup")
+def log_database_settings():  # pragma: no cover
+    # uvicorn's own logger, so it shows up next to the other startup lines
+    logger = logging.getLogger("uvicorn.error")
+    with engine.connect() as conn:
+        version = migrations.schema_version(conn)
+    if version < migrations.LATEST_VERSION:
+        logger.warning("Database schema at version %d of %d, run "
+                       "`python -m app.migrations`", version,
+                       migrations.LATEST_VERSION)
+    for kind, kind_engine, options in [
+        ("writers", engine, pool_options),
+        ("readers", read_engine, read_pool_options),
+    ]:
+        logger.info("Database profile %r, %s: %s", config.DB_PROFILE, kind,
+                    engine_settings(kind_engine, options))
+        max_connections = options["pool_size"] + options["max_overflow"]
+        if (options["max_overflow"] >= 0
+                and max_connections <= config.THREADPOOL_WORKERS):
+            logger.warning("At most %d %s connections for %d threads, sync "
+                           "requests may wait for each other until they time "
+                           "out", max_connections, kind,
+                           config.THREADPOOL_WORKERS)
+
+
+@app.on_event("startup")
+async def install_threadpool():  # pragma: no cover
+    # Where run_in_threadpool() sends the sync endpoints and dependencies
+    asyncio.get_running_loop().set_default_executor(threadpool)
+
+
+@app.on_event("startup")
+def start_hit_recorder():  # pragma: no cover
+    hit_recorder.start()
+
+
+@app.on_event("shutdown")
+def stop_hit_recorder():  # pragma: no cover
+    hit_recorder.stop()
+
+
+@app.on_event("startup")
+def start_notification_dispatcher():  # pragma: no cover
+    notification_dispatcher.start()
+
+
+@app.on_event("shutdown")
+def stop_notification_dispatcher():  # pragma: no cover
+    notification_dispatcher.stop()
+
+
+@app.on_event("shutdown")
+async def close_async_engine():  # pragma: no cover
+    # Pooled aiosqlite connections run on threads that would otherwise
+    # keep the process alive
+    await async_engine.dispose()
+
+
+@app.on_event("shutdown")
+def stop_hashing_pool():  # pragma: no cover
+    hashing.password_pool.shutdown()
+
+
+@app.on_event("startup")
+def report_startup_time():  # pragma: no cover
+    # Registered last, so every other startup handler has already run
+    logging.getLogger("uvicorn.error").info(
+        "Worker ready in %.0f ms", 1000 * (time.perf_counter() - started_at)
+    )
+
 
-initialize_db()
+@app.exception_handler(hashing.HashingPoolBusy)
+def hashing_pool_busy(request: Request, exc: hashing.HashingPoolBusy):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": str(exc)},
+        headers={"Retry-After": "1"},
+    )
 
 
 # ==================================================================
@@ -28,6 +151,21 @@ def get_db():  # pragma: no cover
         db.close()
 
 
+def get_read_db():  # pragma: no cover
+    """Session on the read-only connections, for endpoints that don't write"""
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+async def get_async_db():  # pragma: no cover
+    """Async session, also on read-only connections"""
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
 def get_ses_client():  # pragma: no cover
     ses_client = None
     try:
@@ -38,27 +176,60 @@ def get_ses_client():  # pragma: no cover
     return ses_client
 
 
-def get_current_user(
-    db: Session = Depends(get_db),
-    token: str = Depends(security.oauth2_scheme)
-):
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+def get_notification_dispatcher():  # pragma: no cover
+    return notification_dispatcher
+
+
+def get_hit_recorder():  # pragma: no cover
+    return hit_recorder
+
+
+def get_trending_tracker():  # pragma: no cover
+    return trending_tracker
+
+
+credentials_exception = HTTPException(
+    status_code=status.HTTP_401_UNAUTHORIZED,
+    detail="Could not validate credentials",
+    headers={"WWW-Authenticate": "Bearer"},
+)
+
+
+def decode_token(token: str) -> Tuple[str, float]:
     try:
-        email = security.get_email_from_token(token)
+        return security.decode_access_token(token)
     except JWTError:
         raise credentials_exception
-    user = crud.get_user_by_email(db, email)
+
+
+def authenticate(db: Session, token: str) -> schemas.UserOut:
+    with metrics.Phase("auth"):
+        user = crud.get_principal(db, *decode_token(token))
     if user is None:
         raise credentials_exception
     return user
 
 
+async def authenticate_async(
+    db: AsyncSession,
+    token: str
+) -> schemas.UserOut:
+    with metrics.Phase("auth"):
+        user = await async_crud.get_principal(db, *decode_token(token))
+    if user is None:
+        raise credentials_exception
+    return user
+
+
+def get_current_user(
+    db: Session = Depends(get_read_db),
+    token: str = Depends(security.oauth2_scheme)
+):
+    return authenticate(db, token)
+
+
 def get_optional_user(
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     token: str = Depends(security.optional_oauth2_scheme)
 ):
     # If no auth token is provided we just return an empty user
@@ -67,19 +238,55 @@ def get_optional_user(
 
     # ... but if a token is provided we autenticate the user
     # and return error if the credentials arent' correct
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
-    try:
-        email = security.get_email_from_token(token)
-    except JWTError:
-        raise credentials_exception
-    user = crud.get_user_by_email(db, email)
-    if user is None:
-        raise credentials_exception
-    return user
+    return authenticate(db, token)
+
+
+async def get_async_optional_user(
+    db: AsyncSession = Depends(get_async_db),
+    token: str = Depends(security.optional_oauth2_scheme)
+):
+    """get_optional_user() for the async endpoints"""
+    if token is None:
+        return None
+    return await authenticate_async(db, token)
+
+
+def naive_utc(value: datetime) -> datetime:
+    """Hit timestamps are stored as naive UTC datetimes"""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def notify_other_admins(
+    db: Session,
+    background_tasks: BackgroundTasks,
+    dispatcher: outbox.NotificationDispatcher,
+    current_user: schemas.UserOut,
+    action: notification.ChangeAction,
+    describe: Callable[[List[int]], str]
+) -> Callable[[List[int]], None]:
+    """before_commit hook of the crud writes that queues a notification
+    for the other admins, sent after the response
+
+    The notification is committed along with the change, or not at all.
+    `describe` gives its text from the IDs of the changed products,
+    `action` and the IDs are used when it's merged with others into a
+    digest. While notifications are held for a digest none can be due
+    yet, the dispatcher's own thread sends them once the window is over.
+    """
+    def enqueue(product_ids: List[int]):
+        other_admins = crud.get_users_other_than(db, current_user)
+        if other_admins:
+            crud.enqueue_notifications(
+                db, [admin.email for admin in other_admins],
+                current_user.email, describe(product_ids), action,
+                product_ids
+            )
+            if dispatcher.digest_window <= 0:
+                background_tasks.add_task(dispatcher.dispatch)
+
+    return enqueue
 
 
 # ==================================================================
@@ -92,14 +299,21 @@ def hello_world():
 
 
 @app.post("/token", response_model=schemas.Token)
-def login_and_get_access_token(
-    db: Session = Depends(get_db),
+async def login_and_get_access_token(
+    db: AsyncSession = Depends(get_async_db),
     form_data: OAuth2PasswordRequestForm = Depends()
 ):
-    """Get auth token from FormData credentials"""
-    user = crud.authenticate_user(db, form_data.username,
-                                  form_data.password)
-    if not user:
+    """Get auth token from FormData credentials
+
+    The password is checked in the hashing pool while awaiting, holding
+    neither a thread nor a DB connection.
+    """
+    user = await async_crud.get_user_by_email(db, form_data.username)
+    # Done with the DB, the hash takes much longer than the lookup
+    await db.close()
+    if not user or not await security.verify_password_async(
+        form_data.password, user.hashed_password
+    ):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
@@ -114,23 +328,73 @@ def login_and_get_access_token(
     return {"access_token": access_token, "token_type": "bearer"}
 
 
+@app.get("/stats", response_model=schemas.Stats)
+def get_stats(
+    _: schemas.UserOut = Depends(get_current_user),
+    recorder: hits.HitRecorder = Depends(get_hit_recorder)
+):
+    """Counters of the in-process caches and buffers"""
+    return {
+        "caches": {
+            "product": cache.product_cache.stats(),
+            "product_list": cache.product_list_cache.stats(),
+            "product_query": cache.product_query_cache.stats(),
+            "principal": cache.principal_cache.stats(),
+        },
+        "hit_recorder": recorder.stats(),
+        "hashing_pool": hashing.password_pool.stats(),
+    }
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Request and pool metrics in the Prometheus text format
+
+    Rendered on the event loop, the thread that records the requests.
+    """
+    return PlainTextResponse(
+        metrics.request_metrics.render(),
+        media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 # ==================================================================
 # User-related endpoints
 # ==================================================================
 @app.get("/users/", response_model=List[schemas.UserOut])
 def get_user_list(
-    db: Session = Depends(get_db),
-    _: models.User = Depends(get_current_user)
+    request: Request,
+    response: Response,
+    limit: int = Query(config.PAGE_SIZE, ge=1, le=config.MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None, alias="next"),
+    unpaginated: bool = Query(False, alias="all"),
+    db: Session = Depends(get_read_db),
+    _: schemas.UserOut = Depends(get_current_user)
 ):
-    """Retrieve all users"""
-    return crud.get_all_users(db)
+    """Retrieve users, one page at a time
+
+    The cursor for the following page is returned in the `X-Next-Cursor`
+    header, `all=true` returns every user in a single response.
+    """
+    if unpaginated:
+        return crud.get_all_users(db)
+
+    after_id = pagination.decode_id_cursor(cursor)
+    users = crud.get_users_page(db, after_id, limit + 1)
+
+    if len(users) > limit:
+        users = users[:limit]
+        next_cursor = pagination.encode_cursor({"id": users[-1].id})
+        pagination.add_next_page_headers(request, response, next_cursor)
+
+    return users
 
 
 @app.get("/users/{user_id}", response_model=schemas.UserOut)
 def get_user_detail(
     user_id: int,
-    db: Session = Depends(get_db),
-    _: models.User = Depends(get_current_user)
+    db: Session = Depends(get_read_db),
+    _: schemas.UserOut = Depends(get_current_user)
 ):
     """Retrieve single user by ID"""
     db_user = crud.get_user(db, user_id=user_id)
@@ -145,7 +409,7 @@ def get_user_detail(
 def create_user(
     user_in: schemas.UserIn,
     db: Session = Depends(get_db),
-    _: models.User = Depends(get_current_user)
+    _: schemas.UserOut = Depends(get_current_user)
 ):
     """Create a new user from JSON payload"""
     existing_user = crud.get_user_by_email(db, user_in.email)
@@ -162,7 +426,7 @@ def update_user(
     user_id: int,
     user_in: schemas.UserIn,
     db: Session = Depends(get_db),
-    _: models.User = Depends(get_current_user)
+    _: schemas.UserOut = Depends(get_current_user)
 ):
     """Update an existing user from a JSON payload"""
     user_db = crud.get_user(db, user_id)
@@ -177,7 +441,7 @@ def update_user(
 def delete_user(
     user_id: int,
     db: Session = Depends(get_db),
-    _: models.User = Depends(get_current_user)
+    _: schemas.UserOut = Depends(get_current_user)
 ):
     """Delete user with the given ID"""
     user_db = crud.get_user(db, user_id)
@@ -193,55 +457,230 @@ def delete_user(
 # Product-related endpoints
 # ==================================================================
 @app.get("/products/", response_model=List[schemas.ProductOut])
-def get_product_list(
-    db: Session = Depends(get_db),
-    user_maybe: models.User = Depends(get_optional_user)
+async def get_product_list(
+    request: Request,
+    response: Response,
+    filters: schemas.ProductFilter = Depends(),
+    limit: int = Query(config.PAGE_SIZE, ge=1, le=config.MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None, alias="next"),
+    unpaginated: bool = Query(False, alias="all"),
+    db: AsyncSession = Depends(get_async_db),
+    user_maybe: schemas.UserOut = Depends(get_async_optional_user)
+):
+    """Retrieve products, one page at a time
+
+    Products can be filtered by `brand`, `min_price` and `max_price` and
+    sorted by `price`, `-price` or `name` (ID by default). The cursor for
+    the following page is returned in the `X-Next-Cursor` header,
+    `all=true` returns every product in a single response. Supports
+    conditional requests through `If-None-Match`.
+    """
+    sort_key = crud.PRODUCT_SORT_KEYS[filters.sort]
+    after = pagination.decode_keyset_cursor(cursor, **sort_key, id=int)
+
+    not_modified = conditional.catalog_not_modified(request, response)
+    if not_modified:
+        return not_modified
+
+    if unpaginated:
+        keys = await async_crud.get_product_list_keys(db, filters, None,
+                                                      None)
+    else:
+        keys = await async_crud.get_product_list_keys(db, filters, after,
+                                                      limit + 1)
+
+        if len(keys) > limit:
+            keys = keys[:limit]
+            next_cursor = pagination.encode_cursor(
+                dict(zip([*sort_key, "id"], keys[-1]))
+            )
+            pagination.add_next_page_headers(request, response, next_cursor)
+
+    product_ids = [key[-1] for key in keys]
+    return serialization.json_response(
+        await async_crud.get_product_list_json(db, product_ids), response
+    )
+
+
+@app.get("/products/export", response_class=StreamingResponse)
+def export_products(
+    export_format: schemas.ExportFormat = Query(schemas.ExportFormat.ndjson,
+                                                alias="format"),
+    db: Session = Depends(get_read_db),
+    user_maybe: schemas.UserOut = Depends(get_optional_user)
+):
+    """Stream the whole catalog as NDJSON (default) or CSV
+
+    Products are read from the DB in batches while the response is being
+    sent, so memory use doesn't depend on the size of the catalog.
+    """
+    rows = crud.iter_products(db, config.EXPORT_BATCH_SIZE)
+    return StreamingResponse(
+        export.iter_export(rows, export_format, config.EXPORT_BATCH_SIZE),
+        media_type=export.MEDIA_TYPES[export_format]
+    )
+
+
+@app.get("/products/trending", response_model=List[schemas.TrendingProduct])
+async def get_trending_products(
+    window: schemas.TrendingWindow = schemas.TrendingWindow.one_hour,
+    limit: int = Query(20, ge=1, le=100),
+    db: AsyncSession = Depends(get_async_db),
+    user_maybe: schemas.UserOut = Depends(get_async_optional_user),
+    tracker: trending.TrendingTracker = Depends(get_trending_tracker)
 ):
-    """Retrieve all products"""
-    return crud.get_all_products(db)
+    """Retrieve the products with the most recent anonymous views
+
+    Views are decayed exponentially with `window` as time constant
+    """
+    top = tracker.top(window, limit)
+    products = {
+        product.id: product
+        for product in await async_crud.get_products_by_ids(
+            db, [product_id for product_id, _ in top]
+        )
+    }
+
+    return [
+        schemas.TrendingProduct(
+            **schemas.ProductOut.from_orm(products[product_id]).dict(),
+            score=score
+        )
+        for product_id, score in top
+        if product_id in products
+    ]
+
+
+@app.get("/products/search", response_model=List[schemas.ProductOut])
+async def search_products(
+    request: Request,
+    response: Response,
+    q: str = Query(..., min_length=1),
+    limit: int = Query(config.PAGE_SIZE, ge=1, le=config.MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None, alias="next"),
+    db: AsyncSession = Depends(get_async_db),
+    user_maybe: schemas.UserOut = Depends(get_async_optional_user)
+):
+    """Full-text search over name, brand, description and SKU
+
+    Results are ranked by relevance and paginated like the product list.
+    """
+    after = pagination.decode_keyset_cursor(cursor, rank=(int, float),
+                                            id=int)
+    match_query = search.to_match_query(q)
+    if match_query is None:
+        return []
+
+    results = await async_crud.search_products(db, match_query, after,
+                                               limit + 1)
+
+    if len(results) > limit:
+        results = results[:limit]
+        last_product, last_rank = results[-1]
+        next_cursor = pagination.encode_cursor(
+            {"rank": last_rank, "id": last_product.id}
+        )
+        pagination.add_next_page_headers(request, response, next_cursor)
+
+    return [product for product, _ in results]
 
 
 @app.get("/products/{product_id}", response_model=schemas.ProductOutDetails)
-def get_product_detail(
+async def get_product_detail(
     product_id: int,
-    db: Session = Depends(get_db),
-    user_maybe: models.User = Depends(get_optional_user)
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_async_db),
+    user_maybe: schemas.UserOut = Depends(get_async_optional_user),
+    recorder: hits.HitRecorder = Depends(get_hit_recorder),
+    tracker: trending.TrendingTracker = Depends(get_trending_tracker)
 ):
-    """Retrieve a single product by ID"""
-    db_product = crud.get_single_product(db, product_id)
-    if db_product is None:
+    """Retrieve a single product by ID
+
+    Supports conditional requests through `If-None-Match`, a `304` still
+    counts as a hit since the client is looking at the product.
+    """
+    # The product is usually cached, making sure it exists first keeps
+    # unknown IDs out of the 304s and of the hit counts
+    body = await async_crud.get_product_details_json(db, product_id)
+    if body is None:
         raise HTTPException(status_code=404, detail="Product not found")
 
+    not_modified = conditional.catalog_not_modified(request, response)
+    result = not_modified or serialization.json_response(body, response)
+
     # This means, the user is anonymous
     if user_maybe is None:
-        crud.increment_product_hits(db, db_product)
+        recorder.record(product_id)
+        tracker.record(product_id)
 
-    return db_product
+    return result
 
 
-@app.get("/products/{product_id}/hits", response_model=schemas.ProductHits)
+@app.get("/products/{product_id}/hits", response_model=schemas.ProductHits,
+         response_model_exclude_none=True)
 def get_product_hits(
     product_id: int,
-    db: Session = Depends(get_db),
-    _: models.User = Depends(get_current_user)
+    start: Optional[datetime] = Query(None, alias="from"),
+    end: Optional[datetime] = Query(None, alias="to"),
+    granularity: Optional[schemas.HitGranularity] = None,
+    db: Session = Depends(get_read_db),
+    _: schemas.UserOut = Depends(get_current_user),
+    recorder: hits.HitRecorder = Depends(get_hit_recorder)
 ):
-    """Get the  of anonymous hits for this product"""
+    """Get the  of anonymous hits for this product
+
+    If any of `from`, `to` or `granularity` is given the hits are broken
+    down in hourly (default) or daily buckets. `to` defaults to now and
+    `from` to one day (hourly) or thirty days (daily) before `to`. Hits
+    still in the write buffer are only counted in the overall total.
+    """
     db_product = crud.get_single_product(db, product_id)
     if db_product is None:
         raise HTTPException(status_code=404, detail="Product not found")
 
-    count = crud.get_product_hits(db, db_product)
+    if start is None and end is None and granularity is None:
+        count = crud.get_product_hits(db, db_product)
 
-    count = 0 if count is None else count
-    return {"hits": count}
+        count = 0 if count is None else count
+        # Hits still waiting in the buffer haven't reached the DB yet
+        count += recorder.pending(db_product.id)
+        return {"hits": count}
+
+    granularity = granularity or schemas.HitGranularity.hour
+    end = naive_utc(end) if end else datetime.utcnow()
+    start = naive_utc(start) if start else None
+    if start is None:
+        days = 1 if granularity == schemas.HitGranularity.hour else 30
+        start = end - timedelta(days=days)
+
+    if start >= end:
+        raise HTTPException(status_code=400,
+                            detail="'from' must be earlier than 'to'")
+
+    buckets = crud.get_product_hit_buckets(
+        db, db_product, granularity,
+        crud.hit_bucket_start(start, granularity), end
+    )
+    return {
+        "hits": sum(bucket.hits for bucket in buckets),
+        "granularity": granularity,
+        "buckets": [
+            {"start": bucket.bucket_start, "hits": bucket.hits}
+            for bucket in buckets
+        ]
+    }
 
 
 @app.post("/products/", response_model=schemas.ProductOutDetails)
 def create_new_product(
     product_in: schemas.ProductIn,
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user),
-    ses_client=Depends(get_ses_client)
+    current_user: schemas.UserOut = Depends(get_current_user),
+    dispatcher: outbox.NotificationDispatcher = Depends(
+        get_notification_dispatcher
+    )
 ):
     """Create a new product from a JSON payload"""
     existing_product = crud.get_product_by_sku(db, product_in.sku)
@@ -249,59 +688,158 @@ def create_new_product(
     if existing_product:
         raise HTTPException(status_code=400, detail="SKU already exists")
 
-    product = crud.create_product(db, product_in)
+    notify = notify_other_admins(
+        db, background_tasks, dispatcher, current_user,
+        notification.ChangeAction.created,
+        lambda product_ids: f"Created product #{product_ids[0]}"
+    )
+    return crud.create_product(db, product_in, notify)
 
-    other_admins = crud.get_users_other_than(db, current_user)
-    if ses_client and other_admins:
-        for admin in other_admins:
-            notification.notify_via_email(ses_client, admin.email,
-                                          current_user.email,
-                                          f"Created product #{product.id}")
 
-    return product
+@app.post("/products/bulk", response_model=schemas.ProductImportResult)
+async def import_products(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_db),
+    current_user: schemas.UserOut = Depends(get_current_user),
+    dispatcher: outbox.NotificationDispatcher = Depends(
+        get_notification_dispatcher
+    )
+):
+    """Create products from a NDJSON (default) or CSV (`text/csv`) body
+
+    The body is read as a stream and the products are inserted in batches,
+    rows that fail validation or reuse an SKU are reported by row number.
+    Other admins get a notification for every batch, committed along
+    with it.
+    """
+    lines = bulk_import.iter_lines(request.stream())
+    if request.headers.get("content-type", "").startswith("text/csv"):
+        rows = bulk_import.iter_csv_rows(lines)
+    else:
+        rows = bulk_import.iter_ndjson_rows(lines)
+
+    notify = notify_other_admins(
+        db, background_tasks, dispatcher, current_user,
+        notification.ChangeAction.created,
+        lambda product_ids: f"Imported {len(product_ids)} products"
+    )
+    report = await bulk_import.import_products(db, rows,
+                                               before_commit=notify)
+    return report.dict()
+
+
+def bulk_results(
+    selection: schemas.ProductSelection,
+    product_ids: List[int],
+    status: schemas.ProductBulkStatus
+) -> List[dict]:
+    """Outcome for every requested ID, or every matched one for brands"""
+    if selection.ids is None:
+        return [{"id": product_id, "status": status}
+                for product_id in product_ids]
+
+    found = set(product_ids)
+    return [
+        {
+            "id": product_id,
+            "status": status if product_id in found
+            else schemas.ProductBulkStatus.not_found
+        }
+        for product_id in dict.fromkeys(selection.ids)
+    ]
+
+
+@app.patch("/products/bulk", response_model=List[schemas.ProductBulkResult])
+def update_products(
+    bulk_update: schemas.ProductBulkUpdate,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_db),
+    current_user: schemas.UserOut = Depends(get_current_user),
+    dispatcher: outbox.NotificationDispatcher = Depends(
+        get_notification_dispatcher
+    )
+):
+    """Apply the same changes to a list of products or a whole brand"""
+    notify = notify_other_admins(
+        db, background_tasks, dispatcher, current_user,
+        notification.ChangeAction.updated,
+        lambda product_ids: notification.describe_bulk_change(
+            "Updated", product_ids
+        )
+    )
+    product_ids = crud.update_products(db, bulk_update, bulk_update.changes,
+                                       notify)
+    return bulk_results(bulk_update, product_ids,
+                        schemas.ProductBulkStatus.updated)
+
+
+@app.delete("/products/bulk", response_model=List[schemas.ProductBulkResult])
+def delete_products(
+    selection: schemas.ProductSelection,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_db),
+    current_user: schemas.UserOut = Depends(get_current_user),
+    dispatcher: outbox.NotificationDispatcher = Depends(
+        get_notification_dispatcher
+    )
+):
+    """Delete a list of products or a whole brand"""
+    notify = notify_other_admins(
+        db, background_tasks, dispatcher, current_user,
+        notification.ChangeAction.deleted,
+        lambda product_ids: notification.describe_bulk_change(
+            "Deleted", product_ids
+        )
+    )
+    product_ids = crud.delete_products(db, selection, notify)
+    return bulk_results(selection, product_ids,
+                        schemas.ProductBulkStatus.deleted)
 
 
 @app.put("/products/{product_id}", response_model=schemas.ProductOutDetails)
 def update_product(
     product_id: int,
     product_in: schemas.ProductIn,
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user),
-    ses_client=Depends(get_ses_client)
+    current_user: schemas.UserOut = Depends(get_current_user),
+    dispatcher: outbox.NotificationDispatcher = Depends(
+        get_notification_dispatcher
+    )
 ):
     """Update an existing product from a JSON payload"""
     product_at_db = crud.get_single_product(db, product_id)
     if not product_at_db:
         raise HTTPException(status_code=404, detail="Product doesn't exist")
 
-    product = crud.update_product(db, product_at_db, product_in)
-    other_admins = crud.get_users_other_than(db, current_user)
-    if ses_client and other_admins:
-        for admin in other_admins:
-            notification.notify_via_email(ses_client, admin.email,
-                                          current_user.email,
-                                          f"Updated product #{product_id}")
-    return product
+    notify = notify_other_admins(
+        db, background_tasks, dispatcher, current_user,
+        notification.ChangeAction.updated,
+        lambda _: f"Updated product #{product_id}"
+    )
+    return crud.update_product(db, product_at_db, product_in, notify)
 
 
 @app.delete("/products/{product_id}", response_model=schemas.ProductDeleted)
 def delete_product(
     product_id: int,
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user),
-    ses_client=Depends(get_ses_client)
+    current_user: schemas.UserOut = Depends(get_current_user),
+    dispatcher: outbox.NotificationDispatcher = Depends(
+        get_notification_dispatcher
+    )
 ):
     """Delete product with the given ID"""
     product_at_db = crud.get_single_product(db, product_id)
     if not product_at_db:
         raise HTTPException(status_code=404, detail="Product doesn't exist")
 
-    crud.delete_product(db, product_at_db)
-
-    other_admins = crud.get_users_other_than(db, current_user)
-    if ses_client and other_admins:
-        for admin in other_admins:
-            notification.notify_via_email(ses_client, admin.email,
-                                          current_user.email,
-                                          f"Deleted product #{product_id}")
+    notify = notify_other_admins(
+        db, background_tasks, dispatcher, current_user,
+        notification.ChangeAction.deleted,
+        lambda _: f"Deleted product #{product_id}"
+    )
+    crud.delete_product(db, product_at_db, notify)
     return {"id": product_id}
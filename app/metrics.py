@@ -0,0 +1,380 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class RequestRecord:
+    """What is measured while a request is handled"""
+
+    __slots__ = ("scope", "phases", "queries", "statements")
+
+    def __init__(self, scope: dict):
+        self.scope = scope
+        # Seconds by phase name
+        self.phases: Dict[str, float] = {}
+        self.queries = 0
+        # Times each SQL statement ran
+        self.statements: Dict[str, int] = {}
+
+
+# The request being handled. Sync code run in the threadpool gets a copy of
+# the context that still points to the same record, so it's measured too.
+current_request: ContextVar[Optional[RequestRecord]] = ContextVar(
+    "current_request", default=None
+)
+
+# Endpoint -> path template, shared by every app
+_route_paths: Dict[Callable, str] = {}
+
+
+def route_of(scope: dict) -> str:
+    """Path template of the route that handles the request, "unmatched"
+    if there's none (yet)"""
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        return "unmatched"
+    route = _route_paths.get(endpoint)
+    if route is None:
+        _route_paths.update(
+            (route.endpoint, route.path) for route in scope["app"].routes
+            if hasattr(route, "endpoint")
+        )
+        route = _route_paths.get(endpoint, "unmatched")
+    return route
+
+
+class Phase:
+    """Adds the time spent in the block to a phase of the current request
+
+        with metrics.Phase("auth"):
+            ...
+
+    Outside of a request it does nothing.
+    """
+
+    __slots__ = ("name", "record", "started_at")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.record = current_request.get()
+        self.started_at = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        if self.record is not None:
+            phases = self.record.phases
+            phases[self.name] = (phases.get(self.name, 0.0) +
+                                 time.perf_counter() - self.started_at)
+
+
+class Histogram:
+    """Prometheus style histogram, the counts aren't cumulative until
+    rendered"""
+
+    __slots__ = ("buckets", "counts", "sum")
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        # One more for +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class RouteMetrics:
+    """Everything recorded for a method and route"""
+
+    __slots__ = ("statuses", "latency", "phases", "queries")
+
+    def __init__(self):
+        self.statuses: Dict[int, int] = {}
+        self.latency = Histogram()
+        self.phases: Dict[str, Histogram] = {}
+        self.queries = Histogram(QUERY_BUCKETS)
+
+
+class RequestMetrics:
+    """Per route request counts, latencies, phases and SQL statements
+
+    Everything is recorded from the event loop thread, so there's no lock
+    on the way of the requests, and labels are only built when rendering.
+    Gauges are callables read at scrape time that return {labels: value}.
+
+    It also holds the SQL debugging settings: whether responses tell how
+    many statements they took, the time above which a statement is logged
+    and how many runs of the same statement in a request get it logged
+    (0 never does).
+    """
+
+    def __init__(
+        self,
+        sql_debug_headers: bool = config.SQL_DEBUG_HEADERS,
+        slow_query_seconds: float = config.SLOW_QUERY_MS / 1000,
+        repeated_statement_threshold: int = (
+            config.REPEATED_STATEMENT_THRESHOLD
+        )
+    ):
+        self.sql_debug_headers = sql_debug_headers
+        self.slow_query_seconds = slow_query_seconds
+        self.repeated_statement_threshold = repeated_statement_threshold
+        self.routes: Dict[Tuple[str, str], RouteMetrics] = {}
+        self.gauges: Dict[str, Tuple[str, Callable[[], dict]]] = {}
+
+    def observe_request(
+        self,
+        method: str,
+        route: str,
+        status: int,
+        seconds: float,
+        phases: Dict[str, float],
+        queries: int
+    ):
+        route_metrics = self.routes.get((method, route))
+        if route_metrics is None:
+            route_metrics = self.routes[method, route] = RouteMetrics()
+        statuses = route_metrics.statuses
+        statuses[status] = statuses.get(status, 0) + 1
+        route_metrics.latency.observe(seconds)
+        route_metrics.queries.observe(queries)
+        for phase, phase_seconds in phases.items():
+            histogram = route_metrics.phases.get(phase)
+            if histogram is None:
+                histogram = route_metrics.phases[phase] = Histogram()
+            histogram.observe(phase_seconds)
+
+    def add_gauge(self, name: str, help_text: str, read: Callable[[], dict]):
+        self.gauges[name] = (help_text, read)
+
+    def clear(self):
+        self.routes.clear()
+
+    def render(self) -> str:
+        """Prometheus text exposition format"""
+        requests, latency, phases, queries = [], [], [], []
+        for (method, route), route_metrics in sorted(self.routes.items()):
+            labels = (("method", method), ("route", route))
+            for status, count in sorted(route_metrics.statuses.items()):
+                requests.append(
+                    f"http_requests_total"
+                    f"{format_labels(labels + (('status', str(status)),))} "
+                    f"{count}"
+                )
+            render_histogram(latency, "http_request_duration_seconds",
+                             labels, route_metrics.latency)
+            render_histogram(queries, "http_request_db_queries",
+                             labels, route_metrics.queries)
+            for phase, histogram in sorted(route_metrics.phases.items()):
+                render_histogram(phases, "http_request_phase_seconds",
+                                 labels + (("phase", phase),), histogram)
+
+        lines = [
+            "# HELP http_requests_total Requests by method, route and status",
+            "# TYPE http_requests_total counter",
+            *requests,
+            "# HELP http_request_duration_seconds Time until the response "
+            "is sent, by route",
+            "# TYPE http_request_duration_seconds histogram",
+            *latency,
+            "# HELP http_request_phase_seconds Time spent in auth, db "
+            "(statement execution) and serialization, by route",
+            "# TYPE http_request_phase_seconds histogram",
+            *phases,
+            "# HELP http_request_db_queries SQL statements run per request, "
+            "by route",
+            "# TYPE http_request_db_queries histogram",
+            *queries,
+        ]
+        for name, (help_text, read) in sorted(self.gauges.items()):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in sorted(read().items()):
+                lines.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(name, value.replace("\\", "\\\\")
+                         .replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    ) + "}"
+
+
+def render_histogram(
+    lines: List[str],
+    name: str,
+    labels: Labels,
+    histogram: Histogram
+):
+    bounds = [repr(bound) for bound in histogram.buckets] + ["+Inf"]
+    cumulative = 0
+    for bound, count in zip(bounds, histogram.counts):
+        cumulative += count
+        lines.append(f"{name}_bucket"
+                     f"{format_labels(labels + (('le', bound),))} "
+                     f"{cumulative}")
+    lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+    lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+
+
+class MetricsMiddleware:
+    """ASGI middleware feeding RequestMetrics
+
+    The latency ends when the last byte of the response is sent, so the
+    background tasks that run afterwards aren't part of it. Routes are
+    labeled with their path template, requests that matched none of them
+    with "unmatched".
+    """
+
+    def __init__(self, app, metrics: "RequestMetrics" = None):
+        self.app = app
+        self.metrics = metrics or request_metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        record = RequestRecord(scope)
+        token = current_request.set(record)
+        started_at = time.perf_counter()
+        status = 500
+        recorded = False
+
+        def finish():
+            nonlocal recorded
+            recorded = True
+            method, route = scope["method"], route_of(scope)
+            self.metrics.observe_request(
+                method, route, status, time.perf_counter() - started_at,
+                record.phases, record.queries
+            )
+            threshold = self.metrics.repeated_statement_threshold
+            if threshold:
+                for statement, count in record.statements.items():
+                    if count >= threshold:
+                        logger.warning(
+                            "Same statement run %d times for %s %s, N+1 "
+                            "queries? %s", count, method, route, statement
+                        )
+
+        async def send_with_metrics(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if self.metrics.sql_debug_headers:
+                    message = with_sql_headers(message, record)
+            await send(message)
+            if (message["type"] == "http.response.body"
+                    and not message.get("more_body", False)):
+                finish()
+
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            current_request.reset(token)
+            if not recorded:
+                finish()
+
+
+def with_sql_headers(message: dict, record: RequestRecord) -> dict:
+    """Response start message telling the statements run so far and the
+    time they took"""
+    headers = list(message.get("headers", []))
+    headers.append((b"x-sql-queries", str(record.queries).encode()))
+    headers.append((b"x-sql-time-ms",
+                    f"{1000 * record.phases.get('db', 0.0):.2f}".encode()))
+    return {**message, "headers": headers}
+
+
+class InstrumentedThreadPool(ThreadPoolExecutor):
+    """ThreadPoolExecutor that counts its running and queued jobs"""
+
+    def __init__(self, max_workers: int, thread_name_prefix: str = ""):
+        super().__init__(max_workers, thread_name_prefix)
+        self.max_workers = max_workers
+        self.submitted = 0
+        self.started = 0
+        self.finished = 0
+        self._counters_lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        with self._counters_lock:
+            self.submitted += 1
+        return super().submit(self._run, fn, args, kwargs)
+
+    def _run(self, fn, args, kwargs):
+        with self._counters_lock:
+            self.started += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._counters_lock:
+                self.finished += 1
+
+    def stats(self) -> dict:
+        with self._counters_lock:
+            return {
+                "max": self.max_workers,
+                "busy": self.started - self.finished,
+                "queued": self.submitted - self.started,
+            }
+
+
+def instrument_engine(engine: Engine, metrics: "RequestMetrics" = None):
+    """Time the statements run by the engine
+
+    Within a request they're counted, added to its "db" phase and checked
+    for repeats. Any statement slower than metrics.slow_query_seconds is
+    logged along with the route it ran for, without its parameters.
+    """
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        conn.info.setdefault("query_started_at", []).append(
+            time.perf_counter()
+        )
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        seconds = time.perf_counter() - conn.info["query_started_at"].pop()
+        record = current_request.get()
+        if record is not None:
+            record.queries += 1
+            phases, statements = record.phases, record.statements
+            phases["db"] = phases.get("db", 0.0) + seconds
+            statements[statement] = statements.get(statement, 0) + 1
+        if seconds >= (metrics or request_metrics).slow_query_seconds:
+            if record is None:
+                request = "no request"
+            else:
+                request = f"{record.scope['method']} {route_of(record.scope)}"
+            logger.warning("Slow query (%.1f ms) for %s: %s", 1000 * seconds,
+                           request, statement)
+
+
+request_metrics = RequestMetrics()
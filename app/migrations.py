@@ -0,0 +1,250 @@
+import argparse
+import time
+from typing import Callable, List, Tuple
+
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import Session
+
+from . import config, crud, hashing, models, schemas
+from .database import Base
+
+# The schema version is kept in SQLite's PRAGMA user_version, a DB at
+# version N still needs MIGRATIONS[N:]. pysqlite doesn't run DDL inside
+# transactions, so every migration has to be safe to run again if it's
+# interrupted before its version is recorded.
+#
+# Migrations are frozen: they spell out their own DDL instead of going
+# through the models, which keep changing after a migration is written.
+
+
+def run_script(conn: Connection, script: str):
+    for statement in script.split(";"):
+        if statement.strip():
+            conn.exec_driver_sql(statement)
+
+
+def baseline_schema(conn: Connection):
+    """Tables of the original release, DBs created by it already have them"""
+    run_script(conn, """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER NOT NULL,
+            email VARCHAR,
+            hashed_password VARCHAR,
+            is_admin BOOLEAN,
+            PRIMARY KEY (id)
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS ix_users_email ON users (email);
+        CREATE INDEX IF NOT EXISTS ix_users_id ON users (id);
+
+        CREATE TABLE IF NOT EXISTS products (
+            id INTEGER NOT NULL,
+            sku VARCHAR,
+            name VARCHAR,
+            price NUMERIC,
+            brand VARCHAR,
+            description VARCHAR,
+            PRIMARY KEY (id)
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS ix_products_sku ON products (sku);
+        CREATE INDEX IF NOT EXISTS ix_products_id ON products (id);
+
+        CREATE TABLE IF NOT EXISTS product_hits (
+            id INTEGER NOT NULL,
+            seen_at DATETIME,
+            product_id INTEGER,
+            PRIMARY KEY (id),
+            FOREIGN KEY(product_id) REFERENCES products (id)
+        );
+        CREATE INDEX IF NOT EXISTS ix_product_hits_id ON product_hits (id)
+    """)
+
+
+def hit_rollups(conn: Connection):
+    """Hit totals and hourly/daily buckets, rebuilt from the raw hits
+
+    The bucket starts use the text format SQLAlchemy stores DateTime
+    columns with, like crud.rebuild_product_hit_counts().
+    """
+    run_script(conn, """
+        CREATE INDEX IF NOT EXISTS ix_product_hits_product_id_seen_at
+            ON product_hits (product_id, seen_at);
+
+        CREATE TABLE IF NOT EXISTS product_hit_counts (
+            product_id INTEGER NOT NULL,
+            hits INTEGER NOT NULL,
+            PRIMARY KEY (product_id),
+            FOREIGN KEY(product_id) REFERENCES products (id)
+        );
+        CREATE TABLE IF NOT EXISTS product_hit_buckets (
+            product_id INTEGER NOT NULL,
+            granularity VARCHAR NOT NULL,
+            bucket_start DATETIME NOT NULL,
+            hits INTEGER NOT NULL,
+            PRIMARY KEY (product_id, granularity, bucket_start),
+            FOREIGN KEY(product_id) REFERENCES products (id)
+        );
+
+        DELETE FROM product_hit_counts;
+        INSERT INTO product_hit_counts (product_id, hits)
+            SELECT product_id, count(id) FROM product_hits
+            GROUP BY product_id;
+
+        DELETE FROM product_hit_buckets;
+        INSERT INTO product_hit_buckets
+            (product_id, granularity, bucket_start, hits)
+            SELECT product_id, 'hour',
+                   strftime('%Y-%m-%d %H:00:00.000000', seen_at), count(id)
+            FROM product_hits
+            GROUP BY product_id, strftime('%Y-%m-%d %H', seen_at);
+        INSERT INTO product_hit_buckets
+            (product_id, granularity, bucket_start, hits)
+            SELECT product_id, 'day',
+                   strftime('%Y-%m-%d 00:00:00.000000', seen_at), count(id)
+            FROM product_hits
+            GROUP BY product_id, strftime('%Y-%m-%d', seen_at)
+    """)
+
+
+def catalog_indexes_and_search(conn: Connection):
+    """Indexes of the product list filters and the FTS5 search index,
+    filled with the existing products"""
+    run_script(conn, """
+        CREATE INDEX IF NOT EXISTS ix_products_brand_price
+            ON products (brand, price);
+        CREATE INDEX IF NOT EXISTS ix_products_price ON products (price);
+        CREATE INDEX IF NOT EXISTS ix_products_name ON products (name);
+
+        CREATE VIRTUAL TABLE IF NOT EXISTS products_fts
+            USING fts5(name, brand, description, sku, prefix='2 3');
+        DELETE FROM products_fts;
+        INSERT INTO products_fts (rowid, name, brand, description, sku)
+            SELECT id, name, brand, description, sku FROM products
+    """)
+
+
+def notification_outbox(conn: Connection):
+    run_script(conn, """
+        CREATE TABLE IF NOT EXISTS notification_outbox (
+            id INTEGER NOT NULL,
+            addressee VARCHAR NOT NULL,
+            user VARCHAR NOT NULL,
+            change VARCHAR NOT NULL,
+            action VARCHAR NOT NULL,
+            product_ids VARCHAR NOT NULL,
+            created_at DATETIME,
+            attempts INTEGER NOT NULL,
+            claimed_by VARCHAR,
+            claimed_until DATETIME,
+            PRIMARY KEY (id)
+        );
+        CREATE INDEX IF NOT EXISTS ix_notification_outbox_id
+            ON notification_outbox (id);
+        CREATE INDEX IF NOT EXISTS ix_notification_outbox_claimed_by
+            ON notification_outbox (claimed_by);
+        CREATE INDEX IF NOT EXISTS ix_notification_outbox_created_at
+            ON notification_outbox (created_at);
+        CREATE INDEX IF NOT EXISTS ix_notification_outbox_claimed_until
+            ON notification_outbox (claimed_until)
+    """)
+
+
+# Version 1 used to be a create_all() of the models, which left DBs from
+# the original release without the search index and the newer indexes on
+# their existing tables. The steps after it bring those DBs up to date too.
+MIGRATIONS: List[Callable[[Connection], None]] = [
+    baseline_schema,
+    hit_rollups,
+    catalog_indexes_and_search,
+    notification_outbox,
+]
+
+LATEST_VERSION = len(MIGRATIONS)
+
+
+def schema_version(conn: Connection) -> int:
+    return conn.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def migrate(engine: Engine) -> Tuple[int, int]:
+    """Apply the pending migrations, returns the versions before and after"""
+    with engine.connect() as conn:
+        initial_version = schema_version(conn)
+
+    for version in range(initial_version, LATEST_VERSION):
+        with engine.begin() as conn:
+            MIGRATIONS[version](conn)
+            conn.exec_driver_sql(f"PRAGMA user_version = {version + 1}")
+
+    return initial_version, max(initial_version, LATEST_VERSION)
+
+
+def reset(engine: Engine):
+    """Drop every table, the next migrate() starts from scratch
+
+    The outbox survives, notifications queued before the reset still have
+    to go out.
+    """
+    Base.metadata.drop_all(bind=engine, tables=[
+        table for table in Base.metadata.sorted_tables
+        if table.name != models.NotificationOutbox.__tablename__
+    ])
+    with engine.begin() as conn:
+        conn.exec_driver_sql("PRAGMA user_version = 0")
+
+
+def seed(db: Session) -> dict:
+    """Demo users and products for a fresh DB
+
+    Only empty tables are seeded, so running it again changes nothing and
+    doesn't hash any password. Returns the number of seeded rows.
+    """
+    seeded = {"users": 0, "products": 0}
+
+    if db.query(models.User.id).first() is None:
+        for email, password in [
+            (config.FIRST_USER_EMAIL, config.FIRST_USER_PASSWORD),
+            (config.SECOND_USER_EMAIL, config.SECOND_USER_PASSWORD),
+        ]:
+            crud.create_user(db, schemas.UserIn(email=email,
+                                                password=password,
+                                                is_admin=True))
+            seeded["users"] += 1
+
+    # Going through crud also indexes them for search
+    if db.query(models.Product.id).first() is None:
+        seeded["products"] = len(crud.create_products(db, [
+            schemas.ProductIn(**product)
+            for product in config.INITIAL_PRODUCTS
+        ]))
+
+    return seeded
+
+
+if __name__ == "__main__":  # pragma: no cover
+    from .database import SessionLocal, engine
+
+    parser = argparse.ArgumentParser(
+        description="Bring the DB schema up to date and seed a fresh DB"
+    )
+    parser.add_argument("--reset", action="store_true",
+                        help="drop every table (but the notification "
+                             "outbox) first")
+    parser.add_argument("--no-seed", action="store_true",
+                        help="don't add the demo users and products")
+    args = parser.parse_args()
+
+    started_at = time.perf_counter()
+    if args.reset:
+        reset(engine)
+
+    initial_version, version = migrate(engine)
+    print(f"Schema at version {version} (was {initial_version})")
+
+    if not args.no_seed:
+        with SessionLocal() as db:
+            seeded = seed(db)
+        hashing.password_pool.shutdown()
+        print(f"Seeded {seeded['users']} users and "
+              f"{seeded['products']} products")
+
+    print(f"Done in {1000 * (time.perf_counter() - started_at):.0f} ms")
@@ -1,6 +1,6 @@
 from sqlalchemy import (
     Boolean, Column, Integer, String, Numeric,
-    DateTime, ForeignKey
+    DateTime, ForeignKey, Index, MetaData, Table, DDL, event
 )
 from sqlalchemy.sql import func
 
@@ -26,6 +26,38 @@ class Product(Base):
     brand = Column(String)
     description = Column(String)
 
+    # Back the filters and sort orders of the product list, sqlite adds
+    # the ID (rowid) to every index so they also resolve ties in order
+    __table_args__ = (
+        Index("ix_products_brand_price", "brand", "price"),
+        Index("ix_products_price", "price"),
+        Index("ix_products_name", "name"),
+    )
+
+
+# FTS5 index over the searchable product fields, the rowid of every entry
+# is the ID of the product. It lives in its own MetaData since create_all()
+# can't create virtual tables, its DDL is hooked to the products table
+# instead so that both are always created and dropped together.
+products_fts = Table(
+    "products_fts", MetaData(),
+    Column("rowid", Integer, primary_key=True),
+    Column("name", String),
+    Column("brand", String),
+    Column("description", String),
+    Column("sku", String),
+)
+
+event.listen(
+    Product.__table__, "after_create",
+    DDL("CREATE VIRTUAL TABLE IF NOT EXISTS products_fts "
+        "USING fts5(name, brand, description, sku, prefix='2 3')")
+)
+event.listen(
+    Product.__table__, "before_drop",
+    DDL("DROP TABLE IF EXISTS products_fts")
+)
+
 
 class ProductHit(Base):
     __tablename__ = "product_hits"
@@ -33,3 +65,47 @@ class ProductHit(Base):
     id = Column(Integer, primary_key=True, index=True)
     seen_at = Column(DateTime, default=func.now())
     product_id = Column(Integer, ForeignKey('products.id'))
+
+    __table_args__ = (
+        Index("ix_product_hits_product_id_seen_at", "product_id", "seen_at"),
+    )
+
+
+class ProductHitCount(Base):
+    """Running total of product_hits per product, kept by crud"""
+    __tablename__ = "product_hit_counts"
+
+    product_id = Column(Integer, ForeignKey('products.id'), primary_key=True)
+    hits = Column(Integer, nullable=False, default=0)
+
+
+class ProductHitBucket(Base):
+    """Hits per product per hour/day, kept by crud next to the totals"""
+    __tablename__ = "product_hit_buckets"
+
+    product_id = Column(Integer, ForeignKey('products.id'), primary_key=True)
+    granularity = Column(String, primary_key=True)
+    bucket_start = Column(DateTime, primary_key=True)
+    hits = Column(Integer, nullable=False, default=0)
+
+
+class NotificationOutbox(Base):
+    """Emails waiting to be sent by the notification dispatcher
+
+    A dispatcher claims rows by setting `claimed_by` until `claimed_until`,
+    rows whose claim expired (e.g. after a crash) are claimed again. One
+    row per addressee and change, `product_ids` is a JSON list.
+    """
+    __tablename__ = "notification_outbox"
+
+    id = Column(Integer, primary_key=True, index=True)
+    addressee = Column(String, nullable=False)
+    user = Column(String, nullable=False)
+    change = Column(String, nullable=False)
+    # What happened to which products, for the digests
+    action = Column(String, nullable=False)
+    product_ids = Column(String, nullable=False)
+    created_at = Column(DateTime, default=func.now(), index=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    claimed_by = Column(String, index=True)
+    claimed_until = Column(DateTime, index=True)
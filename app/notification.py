@@ -1,6 +1,7 @@
 import sys
 import json
 import logging
+from enum import Enum
 
 import boto3
 
@@ -23,32 +24,114 @@ NOTIFICATION_TEMPLATE = {
     """
 }
 
+DIGEST_TEMPLATE_NAME = "catalog-demo-digest-template"
+DIGEST_SUBJECT = "Fellow admins modified the catalog"
 
-def notify_via_email(ses_client, addressee, user, change):
-    template_data = {
-        "user": user,
-        "change": change
-    }
+DIGEST_TEMPLATE = {
+    "TemplateName": DIGEST_TEMPLATE_NAME,
+    "SubjectPart": DIGEST_SUBJECT,
+    "HtmlPart": """
+        <h3>Fellow admins made {{changes}} changes to the catalog</h3>
+        <dl>
+            <dt>Users</dt>
+            <dd>{{users}}</dd>
+            {{#if created}}
+            <dt>Created products</dt>
+            <dd>{{created}}</dd>
+            {{/if}}
+            {{#if updated}}
+            <dt>Updated products</dt>
+            <dd>{{updated}}</dd>
+            {{/if}}
+            {{#if deleted}}
+            <dt>Deleted products</dt>
+            <dd>{{deleted}}</dd>
+            {{/if}}
+        </dl>
+    """
+}
+
+
+class ChangeAction(str, Enum):
+    created = "created"
+    updated = "updated"
+    deleted = "deleted"
+
+
+def _send(ses_client, addressees, template_name, template_data):
     response = ses_client.send_templated_email(
         Source=NOTIFICATION_SOURCE,
         Destination={
-            "ToAddresses": [addressee],
+            "BccAddresses": list(addressees),
         },
-        Template=NOTIFICATION_TEMPLATE_NAME,
+        Template=template_name,
         TemplateData=json.dumps(template_data)
     )
 
     logging.info(response)
 
 
+def notify_via_email(ses_client, addressees, user, change):
+    """Send the same notification to several addressees at once
+
+    They all get the same template data, so a single message with every
+    addressee in Bcc (SES allows up to 50) does the job of a bulk send
+    without them seeing each other's address.
+    """
+    template_data = {
+        "user": user,
+        "change": change
+    }
+    _send(ses_client, addressees, NOTIFICATION_TEMPLATE_NAME, template_data)
+
+
+def list_product_ids(product_ids, max_ids=20):
+    """Product IDs as "#1, #2", listing at most `max_ids` of them"""
+    listed = ", ".join(f"#{product_id}"
+                       for product_id in product_ids[:max_ids])
+    if len(product_ids) > max_ids:
+        listed += f" and {len(product_ids) - max_ids} more"
+    return listed
+
+
+def digest_template_data(changes, max_ids=20):
+    """Merge several (user, action, product_ids) changes into a digest"""
+    users = []
+    product_ids_by_action = {action: set() for action in ChangeAction}
+    for user, action, product_ids in changes:
+        if user not in users:
+            users.append(user)
+        product_ids_by_action[ChangeAction(action)].update(product_ids)
+
+    template_data = {"users": ", ".join(users), "changes": len(changes)}
+    for action, product_ids in product_ids_by_action.items():
+        template_data[action.value] = list_product_ids(
+            sorted(product_ids), max_ids
+        )
+    return template_data
+
+
+def notify_digest_via_email(ses_client, addressees, template_data):
+    """Send the same digest (see digest_template_data) to the addressees"""
+    _send(ses_client, addressees, DIGEST_TEMPLATE_NAME, template_data)
+
+
+def describe_bulk_change(action, product_ids, max_ids=20):
+    """Single line summary of a change made to several products"""
+    listed = list_product_ids(product_ids, max_ids)
+    noun = "product" if len(product_ids) == 1 else "products"
+    return f"{action} {len(product_ids)} {noun}: {listed}"
+
+
 if __name__ == "__main__":  # pragma: no cover
     if len(sys.argv) < 2 or sys.argv[1] != "--upload-template":
         print("Usage: python notification.py --upload-template")
     else:
         # Create SES client
         ses = boto3.client('ses')
-        response = ses.create_template(
-            Template=NOTIFICATION_TEMPLATE
-        )
+        for template in [NOTIFICATION_TEMPLATE, DIGEST_TEMPLATE]:
+            response = ses.create_template(
+                Template=template
+            )
 
-        print(response)
+            print(response)
@@ -0,0 +1,166 @@
+import json
+import logging
+import threading
+import uuid
+from datetime import datetime, timedelta
+from functools import partial
+from typing import Callable, Dict, List, Tuple
+
+from sqlalchemy.orm import Session
+
+from . import config, crud, models, notification
+
+
+class NotificationDispatcher:
+    """Sends the notifications waiting in the outbox table
+
+    Endpoints only insert the notifications and schedule dispatch() to run
+    after the response is sent, so they don't wait for SES. A background
+    thread also dispatches every `interval` seconds to pick up whatever was
+    left behind by a restart or a failed send.
+
+    Notifications are held for `digest_window` seconds, so that everything
+    queued for an admin in the meantime goes out in a single digest.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        ses_client_factory: Callable,
+        batch_size: int = config.NOTIFICATION_BATCH_SIZE,
+        retry_delay: float = config.NOTIFICATION_RETRY_DELAY,
+        max_attempts: int = config.NOTIFICATION_MAX_ATTEMPTS,
+        interval: float = config.NOTIFICATION_DISPATCH_INTERVAL,
+        digest_window: float = config.NOTIFICATION_DIGEST_WINDOW,
+    ):
+        self.session_factory = session_factory
+        self.ses_client_factory = ses_client_factory
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self.interval = interval
+        self.digest_window = digest_window
+
+        # Counters
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+        self._ses_client = None
+        self._dispatch_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def _get_ses_client(self):
+        if self._ses_client is None:
+            self._ses_client = self.ses_client_factory()
+        return self._ses_client
+
+    def dispatch(self) -> int:
+        """Send every notification that's due, returns how many emails
+
+        Every SES call covers up to `batch_size` addressees.
+        """
+        ses_client = self._get_ses_client()
+        if ses_client is None:
+            return 0
+
+        with self._dispatch_lock:
+            db = self.session_factory()
+            try:
+                return self._dispatch(db, ses_client)
+            finally:
+                db.close()
+
+    def _emails(self, claimed: List[models.NotificationOutbox]):
+        """Group the claimed notifications into the emails to send
+
+        Addressees with a single notification get it as is, the ones with
+        several get a digest. Returns (send, {addressee: notification IDs})
+        for every email, addressees getting the very same email go together.
+        """
+        items_by_addressee: Dict[str, list] = {}
+        for item in claimed:
+            items_by_addressee.setdefault(item.addressee, []).append(item)
+
+        emails: Dict[str, Tuple[Callable, Dict[str, List[int]]]] = {}
+        for addressee, items in items_by_addressee.items():
+            if len(items) == 1:
+                item = items[0]
+                key = json.dumps(["change", item.user, item.change])
+                send = partial(notification.notify_via_email,
+                               user=item.user, change=item.change)
+            else:
+                template_data = notification.digest_template_data([
+                    (item.user, item.action, json.loads(item.product_ids))
+                    for item in items
+                ])
+                key = json.dumps(["digest", template_data], sort_keys=True)
+                send = partial(notification.notify_digest_via_email,
+                               template_data=template_data)
+            _, ids_by_addressee = emails.setdefault(key, (send, {}))
+            ids_by_addressee[addressee] = [item.id for item in items]
+
+        return list(emails.values())
+
+    def _dispatch(self, db: Session, ses_client) -> int:
+        sent = 0
+        # A claim must outlast the sends it covers, the lease is generous
+        lease = max(self.retry_delay, 60)
+
+        limit = self.batch_size * 20
+        while True:
+            ready_before = datetime.utcnow() - timedelta(
+                seconds=self.digest_window
+            )
+            claimed = crud.claim_notifications(db, uuid.uuid4().hex, lease,
+                                               limit, ready_before)
+            emails = self._emails(claimed)
+
+            for send, ids_by_addressee in emails:
+                addressees = list(ids_by_addressee)
+                for start in range(0, len(addressees), self.batch_size):
+                    batch = addressees[start:start + self.batch_size]
+                    ids = [notification_id for addressee in batch
+                           for notification_id in ids_by_addressee[addressee]]
+                    try:
+                        send(ses_client, batch)
+                    except Exception as e:
+                        logging.exception(e)
+                        self.failed += len(batch)
+                        self.dropped += crud.release_notifications(
+                            db, ids, self.retry_delay, self.max_attempts
+                        )
+                        continue
+                    crud.delete_notifications(db, ids)
+                    self.sent += len(batch)
+                    sent += len(batch)
+
+            # Anything left now was queued after we started, or failed
+            if sum(len(ids) for _, ids in emails) < limit:
+                return sent
+
+    # --------------------------------------------------------------
+    # Background dispatching
+    # --------------------------------------------------------------
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name="notification-dispatcher",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):  # pragma: no cover
+        while not self._stopping.wait(self.interval):
+            try:
+                self.dispatch()
+            except Exception as e:
+                logging.exception(e)
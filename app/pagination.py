@@ -0,0 +1,62 @@
+import base64
+import json
+from typing import Optional
+
+from fastapi import HTTPException, Request, Response
+
+
+def encode_cursor(position: dict) -> str:
+    """Opaque cursor pointing right after the given position"""
+    raw = json.dumps(position, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[dict]:
+    if cursor is None:
+        return None
+
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        position = json.loads(base64.urlsafe_b64decode(cursor + padding))
+    except ValueError:
+        position = None
+
+    if not isinstance(position, dict):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return position
+
+
+def decode_keyset_cursor(cursor: Optional[str], **types) -> Optional[tuple]:
+    """Values of the keys of the last item of the previous page
+
+    The values are returned in the order the keys are given, each one must
+    be an instance of its type(s).
+    """
+    position = decode_cursor(cursor)
+    if position is None:
+        return None
+
+    values = tuple(position.get(key) for key in types)
+    for value, expected_type in zip(values, types.values()):
+        if not isinstance(value, expected_type):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+
+def decode_id_cursor(cursor: Optional[str]) -> Optional[int]:
+    """ID of the last item of the previous page"""
+    position = decode_keyset_cursor(cursor, id=int)
+    return None if position is None else position[0]
+
+
+def add_next_page_headers(
+    request: Request,
+    response: Response,
+    cursor: Optional[str]
+):
+    """Tell the client how to fetch the next page, if there is one"""
+    if cursor is None:
+        return
+    response.headers["X-Next-Cursor"] = cursor
+    next_url = request.url.include_query_params(next=cursor)
+    response.headers["Link"] = f'<{next_url}>; rel="next"'
@@ -1,6 +1,11 @@
+from datetime import datetime
 from decimal import Decimal
+from enum import Enum
+from typing import Dict, List, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, conlist, condecimal, root_validator
+
+from . import config
 
 
 # ==================================================================
@@ -12,6 +17,41 @@ class Token(BaseModel):
     token_type: str
 
 
+class CacheStats(BaseModel):
+    """Counters of an in-memory cache"""
+    size: int
+    hits: int
+    misses: int
+    evictions: int
+
+
+class HitRecorderStats(BaseModel):
+    """Counters of the product hit write buffer"""
+    buffered: int
+    flushed: int
+    dropped: int
+    pending: int
+
+
+class HashingPoolStats(BaseModel):
+    """Queue depth and latency of the password hashing pool"""
+    workers: int
+    pending: int
+    completed: int
+    failed: int
+    rejected: int
+    timed_out: int
+    avg_latency_ms: float
+    max_latency_ms: float
+
+
+class Stats(BaseModel):
+    """Counters of the in-process caches and buffers"""
+    caches: Dict[str, CacheStats]
+    hit_recorder: HitRecorderStats
+    hashing_pool: HashingPoolStats
+
+
 # ==================================================================
 # User Schemas
 # ==================================================================
@@ -68,11 +108,126 @@ class ProductOutDetails(ProductOut):
     description: str
 
 
+class ProductSort(str, Enum):
+    """Sort orders of the product list, `-` means descending"""
+    id = "id"
+    price = "price"
+    price_desc = "-price"
+    name = "name"
+
+
+class ProductFilter(BaseModel):
+    """Query parameters to filter and sort the product list"""
+    brand: Optional[str]
+    min_price: Optional[Decimal]
+    max_price: Optional[Decimal]
+    sort: ProductSort = ProductSort.id
+
+    def is_default(self) -> bool:
+        return self == ProductFilter()
+
+
+class ExportFormat(str, Enum):
+    """Formats the catalog can be exported to"""
+    ndjson = "ndjson"
+    csv = "csv"
+
+
+class TrendingWindow(str, Enum):
+    """Time constant used to decay the views of trending products"""
+    five_minutes = "5m"
+    one_hour = "1h"
+    one_day = "24h"
+
+
+class TrendingProduct(ProductOut):
+    """A product along with its (decayed) number of recent views"""
+    score: float
+
+
+class ProductImportError(BaseModel):
+    """A row of a bulk import that couldn't be created"""
+    row: int
+    detail: str
+
+
+class ProductImportResult(BaseModel):
+    """Summary of a bulk import, `errors` may be truncated"""
+    created: int
+    failed: int
+    errors: List[ProductImportError]
+
+
 class ProductDeleted(BaseModel):
     """DELETE endpoint gets only the ID"""
     id: int
 
 
+class ProductSelection(BaseModel):
+    """Bulk operations target either a list of IDs or a whole brand"""
+    ids: Optional[conlist(int, min_items=1, max_items=config.BULK_MAX_IDS)]
+    brand: Optional[str]
+
+    @root_validator(skip_on_failure=True)
+    def ids_or_brand(cls, values):
+        if (values.get("ids") is None) == (values.get("brand") is None):
+            raise ValueError("Provide either 'ids' or 'brand'")
+        return values
+
+
+class ProductChanges(BaseModel):
+    """Fields a bulk update can set, `price_factor` scales the price"""
+    name: Optional[str]
+    price: Optional[Decimal]
+    price_factor: Optional[condecimal(gt=0)]
+    brand: Optional[str]
+    description: Optional[str]
+
+    @root_validator(skip_on_failure=True)
+    def price_or_factor(cls, values):
+        if all(value is None for value in values.values()):
+            raise ValueError("Provide at least one field to change")
+        if values.get("price") is not None and \
+                values.get("price_factor") is not None:
+            raise ValueError("Provide either 'price' or 'price_factor'")
+        return values
+
+
+class ProductBulkUpdate(ProductSelection):
+    """PATCH /products/bulk payload"""
+    changes: ProductChanges
+
+
+class ProductBulkStatus(str, Enum):
+    updated = "updated"
+    deleted = "deleted"
+    not_found = "not_found"
+
+
+class ProductBulkResult(BaseModel):
+    """Outcome of a bulk operation for a single product"""
+    id: int
+    status: ProductBulkStatus
+
+
+class HitGranularity(str, Enum):
+    """Size of the buckets in a hit time series"""
+    hour = "hour"
+    day = "day"
+
+
+class ProductHitBucket(BaseModel):
+    """Hits that happened in [start, start + granularity)"""
+    start: datetime
+    hits: int
+
+
 class ProductHits(BaseModel):
-    """Ad hoc schema to show product hit count"""
+    """Ad hoc schema to show product hit count
+
+    When a time window is requested `hits` is the total for the window
+    and `buckets` has its breakdown, empty buckets are left out.
+    """
     hits: int
+    granularity: Optional[HitGranularity]
+    buckets: Optional[List[ProductHitBucket]]
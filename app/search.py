@@ -0,0 +1,115 @@
+import re
+from typing import Iterable, List, Optional, Tuple
+
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import func, literal_column, select
+
+from . import models
+from .models import products_fts
+
+# bm25() weights, in the same order as the columns of the index
+COLUMN_WEIGHTS = (10.0, 5.0, 1.0, 10.0)
+
+_fts = literal_column("products_fts")
+_rank = func.bm25(_fts, *COLUMN_WEIGHTS)
+
+
+def to_match_query(text: str) -> Optional[str]:
+    """Turn free text into a safe FTS5 query
+
+    Every word must be present, the last one can be a prefix so results
+    show up while the user is still typing. Returns None if there are no
+    words to look for.
+    """
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+# ==================================================================
+# Index maintenance, called by crud before committing product writes
+# ==================================================================
+def unindex_products(db: Session, product_ids: Iterable[int]):
+    db.execute(products_fts.delete().where(
+        products_fts.c.rowid.in_(list(product_ids))
+    ))
+
+
+def index_products(db: Session, criteria):
+    """(Re)index the products that match the given criteria"""
+    product_ids = select(models.Product.id).where(criteria)
+    db.execute(products_fts.delete().where(
+        products_fts.c.rowid.in_(product_ids)
+    ))
+    db.execute(products_fts.insert().from_select(
+        ["rowid", "name", "brand", "description", "sku"],
+        select(
+            models.Product.id,
+            models.Product.name,
+            models.Product.brand,
+            models.Product.description,
+            models.Product.sku,
+        ).where(criteria)
+    ))
+
+
+def rebuild_index(db: Session) -> int:
+    """Reindex every product, returns the number of indexed products"""
+    db.execute(products_fts.delete())
+    index_products(db, models.Product.id.isnot(None))
+    db.commit()
+    return db.query(func.count(products_fts.c.rowid)).scalar()
+
+
+# ==================================================================
+# Search
+# ==================================================================
+def search_statement(
+    match_query: str,
+    after: Optional[Tuple[float, int]],
+    limit: int
+):
+    """SELECT of the products matching the query with their bm25 rank,
+    best first
+
+    `after` is the (rank, id) of the last result of the previous page.
+    """
+    statement = select(models.Product, _rank).join(
+        products_fts, products_fts.c.rowid == models.Product.id
+    ).where(_fts.op("MATCH")(match_query))
+
+    if after is not None:
+        rank, product_id = after
+        statement = statement.where(or_(
+            _rank > rank,
+            and_(_rank == rank, models.Product.id > product_id)
+        ))
+
+    return statement.order_by(_rank, models.Product.id).limit(limit)
+
+
+def search_products(
+    db: Session,
+    match_query: str,
+    after: Optional[Tuple[float, int]],
+    limit: int
+) -> List[Tuple[models.Product, float]]:
+    """Products matching the query with their bm25 rank, best first"""
+    return db.execute(search_statement(match_query, after, limit)).all()
+
+
+if __name__ == "__main__":  # pragma: no cover
+    import sys
+
+    from .database import SessionLocal
+
+    if len(sys.argv) < 2 or sys.argv[1] != "--rebuild":
+        print("Usage: python -m app.search --rebuild")
+    else:
+        with SessionLocal() as db:
+            products = rebuild_index(db)
+        print(f"Indexed {products} products")
@@ -1,11 +1,11 @@
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Tuple
 
 from passlib.context import CryptContext
 from jose import jwt
 from fastapi.security import OAuth2PasswordBearer
 
-from . import config
+from . import config, hashing
 
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -16,14 +16,32 @@ optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token",
                                               auto_error=False)
 
 
-def get_password_hash(password: str) -> str:
+# Run by the workers of the hashing pool
+def _hash(password: str) -> str:
     return pwd_context.hash(password)
 
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
+def _verify(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
 
+def get_password_hash(password: str) -> str:
+    return hashing.password_pool.run(_hash, password)
+
+
+def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return hashing.password_pool.run(_verify, plain_password,
+                                     hashed_password)
+
+
+async def verify_password_async(
+    plain_password: str,
+    hashed_password: str
+) -> bool:
+    return await hashing.password_pool.run_async(_verify, plain_password,
+                                                 hashed_password)
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -36,8 +54,10 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 
-def get_email_from_token(token: str):
+def decode_access_token(token: str) -> Tuple[str, float]:
+    """Email and expiration timestamp of a valid token"""
     payload = jwt.decode(token, config.SECRET_KEY,
                          algorithms=[config.ALGORITHM])
     email: str = payload.get("sub")
-    return email
+    expires_at: float = payload.get("exp", 0)
+    return email, expires_at
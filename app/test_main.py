@@ -1,16 +1,34 @@
+import os
 import json
+import argparse
+import logging
+import asyncio
+import time
+import sqlite3
 from copy import copy
+from datetime import datetime
 
 import pytest
 import boto3
+from fastapi import FastAPI
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool, QueuePool
 from moto import mock_ses
 from moto.ses import ses_backend
 
-from . import security, config, notification
-from .main import app, get_db, get_ses_client
+from . import (
+    security, config, notification, hits, models, crud, trending, export,
+    schemas, bulk_import, cache, search, pagination, hashing, outbox,
+    database, migrations, bench, datagen, metrics
+)
+from .main import (
+    app, get_db, get_read_db, get_async_db, get_hit_recorder,
+    get_trending_tracker, get_notification_dispatcher
+)
 from .database import Base
 
 
@@ -18,6 +36,7 @@ from .database import Base
 # Configuration and initialization
 # ==================================================================
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
+ASYNC_SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///./test.db"
 TEST_USER_EMAIL = "test@example.com"
 TEST_USER_EMAIL_SECOND = "test2@example.com"
 TEST_USER_PASSWORD = "pwd"
@@ -29,6 +48,29 @@ engine = create_engine(
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False,
                                    bind=engine)
 
+# Read-only connections for the GET endpoints, like the app ones
+read_engine = create_engine(
+    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+)
+database.apply_pragmas(read_engine, {"query_only": "ON"})
+
+TestingReadSessionLocal = sessionmaker(autocommit=False, autoflush=False,
+                                       bind=read_engine)
+
+# Not pooled, pooled aiosqlite connections keep their threads (and the
+# interpreter) alive until the engine is disposed
+async_engine = create_async_engine(
+    ASYNC_SQLALCHEMY_DATABASE_URL, poolclass=NullPool
+)
+database.apply_pragmas(async_engine.sync_engine, {"query_only": "ON"})
+
+TestingAsyncSessionLocal = sessionmaker(async_engine, class_=AsyncSession,
+                                        autoflush=False,
+                                        expire_on_commit=False)
+
+for instrumented_engine in (engine, read_engine, async_engine.sync_engine):
+    metrics.instrument_engine(instrumented_engine)
+
 
 # ==================================================================
 # Mock SES client
@@ -37,6 +79,7 @@ mock = mock_ses()
 mock.start()
 ses = boto3.client("ses")
 ses.create_template(Template=notification.NOTIFICATION_TEMPLATE)
+ses.create_template(Template=notification.DIGEST_TEMPLATE)
 ses.verify_email_identity(
   EmailAddress=notification.NOTIFICATION_SOURCE
 )
@@ -46,7 +89,7 @@ def assert_email_sent(addressee, data):  # pragma: no cover
     for message in ses_backend.sent_messages:
         if message.template_data != [json.dumps(data)]:
             continue
-        if addressee not in message.destinations["ToAddresses"]:
+        if addressee not in message.destinations["BccAddresses"]:
             continue
 
         # Found the message
@@ -65,12 +108,53 @@ def override_get_db():
         db.close()
 
 
+def override_get_read_db():
+    try:
+        db = TestingReadSessionLocal()
+        yield db
+    finally:
+        db.close()
+
+
+async def override_get_async_db():
+    async with TestingAsyncSessionLocal() as db:
+        yield db
+
+
 def override_get_ses():
     return ses
 
 
+hit_recorder = hits.HitRecorder(TestingSessionLocal)
+
+
+def override_get_hit_recorder():
+    return hit_recorder
+
+
+trending_tracker = trending.TrendingTracker()
+
+
+notification_dispatcher = outbox.NotificationDispatcher(
+    TestingSessionLocal, override_get_ses, digest_window=0
+)
+
+
+def override_get_notification_dispatcher():
+    return notification_dispatcher
+
+
+def override_get_trending_tracker():
+    return trending_tracker
+
+
 app.dependency_overrides[get_db] = override_get_db
-app.dependency_overrides[get_ses_client] = override_get_ses
+app.dependency_overrides[get_read_db] = override_get_read_db
+app.dependency_overrides[get_async_db] = override_get_async_db
+app.dependency_overrides[get_hit_recorder] = override_get_hit_recorder
+app.dependency_overrides[get_trending_tracker] = override_get_trending_tracker
+app.dependency_overrides[get_notification_dispatcher] = \
+    override_get_notification_dispatcher
 
 client = TestClient(app)
 
@@ -125,7 +209,22 @@ def test_db():
                 product
             )
 
+        # The seeds don't go through crud, so they're indexed here
+        conn.execute(
+            """
+                INSERT INTO
+                    products_fts(rowid, name, brand, description, sku)
+                    SELECT id, name, brand, description, sku FROM products
+            """
+        )
+
     yield
+    hit_recorder.clear()
+    trending_tracker.clear()
+    cache.product_cache.clear()
+    cache.product_list_cache.clear()
+    cache.product_query_cache.clear()
+    cache.principal_cache.clear()
     Base.metadata.drop_all(bind=engine)
 
 
@@ -141,6 +240,205 @@ def auth_headers(test_db):
 # ==================================================================
 # General Purpose Tests
 # ==================================================================
+def test_migrations_and_seeding(tmp_path, monkeypatch):
+    migrations_engine = create_engine(f"sqlite:///{tmp_path}/migrated.db")
+    MigrationsSession = sessionmaker(bind=migrations_engine)
+    try:
+        assert migrations.migrate(migrations_engine) == (
+            0, migrations.LATEST_VERSION
+        )
+        # The frozen migrations end up with the schema of the models
+        models_engine = create_engine("sqlite://")
+        Base.metadata.create_all(bind=models_engine)
+        schema_query = "SELECT type, name, tbl_name FROM sqlite_master"
+        with migrations_engine.connect() as migrated, \
+                models_engine.connect() as created:
+            assert set(migrated.exec_driver_sql(schema_query)) == set(
+                created.exec_driver_sql(schema_query)
+            )
+
+        with MigrationsSession() as db:
+            assert migrations.seed(db) == {"users": 2, "products": 2}
+            crud.enqueue_notifications(db, [TEST_USER_EMAIL], TEST_USER_EMAIL,
+                                       "Deleted product #9", "deleted", [9])
+            db.commit()
+            assert [product.sku for product, _ in search.search_products(
+                db, "catan", None, 10
+            )] == ["B00U26V4VQ"]
+
+        # Running it all again is a no-op, without hashing any password
+        monkeypatch.setattr(security, "get_password_hash", None)
+        assert migrations.migrate(migrations_engine) == (
+            migrations.LATEST_VERSION, migrations.LATEST_VERSION
+        )
+        with MigrationsSession() as db:
+            assert migrations.seed(db) == {"users": 0, "products": 0}
+            assert db.query(models.User).count() == 2
+
+        # A reset keeps the notifications that didn't go out yet
+        migrations.reset(migrations_engine)
+        migrations.migrate(migrations_engine)
+        with MigrationsSession() as db:
+            assert db.query(models.Product).count() == 0
+            assert db.query(models.NotificationOutbox).count() == 1
+    finally:
+        migrations_engine.dispose()
+
+
+def test_migrations_upgrade_a_baseline_db(tmp_path):
+    migrations_engine = create_engine(f"sqlite:///{tmp_path}/baseline.db")
+    MigrationsSession = sessionmaker(bind=migrations_engine)
+    try:
+        # The schema and data of the original release, before migrations
+        with migrations_engine.begin() as conn:
+            migrations.baseline_schema(conn)
+            conn.exec_driver_sql(
+                "INSERT INTO products(id, sku, name, brand, price, "
+                "description) VALUES (1, 'B00U26V4VQ', 'Catan classic', "
+                "'Catan Studio', 1140.26, 'Classic board game')"
+            )
+            for seen_at in ["2021-09-01 10:15:00.000000",
+                            "2021-09-01 10:45:00.000000",
+                            "2021-09-02 08:00:00.000000"]:
+                conn.exec_driver_sql(
+                    "INSERT INTO product_hits(product_id, seen_at) "
+                    "VALUES (1, ?)", (seen_at,)
+                )
+
+        assert migrations.migrate(migrations_engine) == (
+            0, migrations.LATEST_VERSION
+        )
+        with migrations_engine.connect() as conn:
+            indexes = {name for name, in conn.exec_driver_sql(
+                "SELECT name FROM sqlite_master WHERE type = 'index'"
+            )}
+        assert {"ix_products_brand_price", "ix_products_price",
+                "ix_products_name",
+                "ix_product_hits_product_id_seen_at"} <= indexes
+
+        with MigrationsSession() as db:
+            # Existing products are searchable and new ones get indexed
+            assert [product.id for product, _ in search.search_products(
+                db, "catan", None, 10
+            )] == [1]
+            crud.create_product(db, schemas.ProductIn(
+                sku="B07G2CJLNN", name="Catan seafarers", price=530.64,
+                brand="Catan Studio", description="Expansion"
+            ))
+            assert len(search.search_products(db, "catan", None, 10)) == 2
+
+            # The rollups match the hits already there
+            product = db.query(models.Product).get(1)
+            assert crud.get_product_hits(db, product) == 3
+            assert [(bucket.bucket_start, bucket.hits)
+                    for bucket in crud.get_product_hit_buckets(
+                        db, product, schemas.HitGranularity.hour,
+                        datetime(2021, 9, 1), datetime(2021, 9, 3)
+                    )] == [(datetime(2021, 9, 1, 10), 2),
+                           (datetime(2021, 9, 2, 8), 1)]
+            assert [bucket.hits for bucket in crud.get_product_hit_buckets(
+                db, product, schemas.HitGranularity.day,
+                datetime(2021, 9, 1), datetime(2021, 9, 3)
+            )] == [2, 1]
+    finally:
+        migrations_engine.dispose()
+
+
+def test_database_profile(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "DB_CACHE_SIZE", "-2000")
+    pragmas = database.profile_pragmas("wal")
+    assert pragmas["cache_size"] == "-2000"
+    assert pragmas["journal_mode"] == "WAL"
+    with pytest.raises(ValueError):
+        database.profile_pragmas("fastest")
+
+    profile_engine = create_engine(f"sqlite:///{tmp_path}/profile.db",
+                                   poolclass=QueuePool,
+                                   **database.pool_options)
+    database.apply_pragmas(profile_engine, pragmas)
+    try:
+        settings = database.engine_settings(profile_engine,
+                                            database.pool_options)
+    finally:
+        profile_engine.dispose()
+    assert settings["journal_mode"] == "wal"
+    assert settings["synchronous"] == 1  # NORMAL
+    assert settings["cache_size"] == -2000
+    assert settings["busy_timeout"] == 5000
+    assert settings["temp_store"] == 2  # MEMORY
+    assert settings["pool_size"] == config.DB_POOL_SIZE
+    assert settings["max_overflow"] == config.DB_MAX_OVERFLOW
+
+
+def test_burst_of_sync_requests(test_db, auth_headers, monkeypatch):
+    # Pools as configured, but smaller than the burst
+    burst_engine = create_engine(
+        SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False},
+        poolclass=QueuePool, **dict(database.pool_options, pool_size=2)
+    )
+    burst_read_engine = create_engine(
+        SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False},
+        poolclass=QueuePool, **dict(database.read_pool_options, pool_size=2)
+    )
+    BurstSession = sessionmaker(bind=burst_engine)
+    BurstReadSession = sessionmaker(bind=burst_read_engine)
+
+    def burst_get_db():
+        db = BurstSession()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def burst_get_read_db():
+        db = BurstReadSession()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    monkeypatch.setitem(app.dependency_overrides, get_db, burst_get_db)
+    monkeypatch.setitem(app.dependency_overrides, get_read_db,
+                        burst_get_read_db)
+
+    update_headers = dict(auth_headers, **{
+        "Content-Type": "application/json"
+    })
+    update_body = json.dumps(dict(
+        sku="B079XC5PVV", name="SSD Disk 500GB", price=1630.02,
+        brand="Kingston", description="Fast storage solution"
+    )).encode()
+
+    async def burst():
+        # Sessions are closed on the threadpool once the responses are
+        # out, behind the jobs of the requests that came after them
+        asyncio.get_running_loop().set_default_executor(
+            metrics.InstrumentedThreadPool(4)
+        )
+        return await asyncio.wait_for(asyncio.gather(*[
+            bench.asgi_request(app, method, path, headers, body)
+            for _ in range(12)
+            for method, path, headers, body in [
+                ("GET", "/users/1", auth_headers, b""),
+                ("PUT", "/products/1", update_headers, update_body),
+            ]
+        ]), timeout=10)
+
+    try:
+        statuses = asyncio.run(burst())
+    finally:
+        burst_engine.dispose()
+        burst_read_engine.dispose()
+    assert statuses == [200] * 24
+
+
+def test_read_sessions_are_read_only():
+    with database.ReadSessionLocal() as db:
+        assert db.execute(text("SELECT 1")).scalar() == 1
+        with pytest.raises(OperationalError, match="readonly"):
+            db.execute(text("CREATE TABLE readers(id INTEGER)"))
+
+
 def test_read_home():
     response = client.get("/")
     assert response.status_code == 200
@@ -185,6 +483,135 @@ def test_token_with_wrong_credentials(test_db):
     assert {'detail': "Could not validate credentials"}
 
 
+def test_token_when_hashing_pool_is_busy(test_db, monkeypatch):
+    monkeypatch.setattr(hashing, "password_pool",
+                        hashing.HashingPool(workers=0, max_pending=0))
+    login_data = {
+        "username": TEST_USER_EMAIL,
+        "password": TEST_USER_PASSWORD
+    }
+
+    response = client.post('/token', data=login_data)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert hashing.password_pool.stats()["rejected"] == 1
+
+
+def test_hashing_pool():
+    pool = hashing.HashingPool(workers=1, max_pending=1, timeout=30)
+    try:
+        hashed = pool.run(security._hash, "secret")
+        assert pool.run(security._verify, "secret", hashed)
+        assert not pool.run(security._verify, "wrong", hashed)
+
+        # Jobs that raise are failures, not completions
+        with pytest.raises(ValueError):
+            pool.run(int, "not a number")
+
+        # The slow job holds the only slot until it's done, even after
+        # its caller gave up waiting
+        pool.timeout = 0.1
+        with pytest.raises(hashing.HashingPoolBusy):
+            pool.run(time.sleep, 1)
+        with pytest.raises(hashing.HashingPoolBusy):
+            pool.run(security._hash, "secret")
+
+        stats = pool.stats()
+        assert stats["completed"] == 3
+        assert stats["failed"] == 1
+        assert stats["pending"] == 1
+        assert stats["rejected"] == 1
+        assert stats["timed_out"] == 1
+        assert stats["max_latency_ms"] > 0
+    finally:
+        pool.shutdown()
+
+
+def test_hashing_pool_recovers_from_dead_workers():
+    pool = hashing.HashingPool(workers=1, max_pending=1, timeout=30)
+    try:
+        with pytest.raises(hashing.HashingPoolBusy):
+            pool.run(os._exit, 1)
+
+        # The broken executor is replaced on the next job
+        hashed = pool.run(security._hash, "secret")
+        assert pool.run(security._verify, "secret", hashed)
+        stats = pool.stats()
+        assert stats["pending"] == 0
+        assert stats["completed"] == 2
+        assert stats["failed"] == 1
+    finally:
+        pool.shutdown()
+
+
+def test_hashing_pool_async():
+    pool = hashing.HashingPool(workers=1, max_pending=1, timeout=30)
+
+    async def jobs():
+        hashed = await pool.run_async(security._hash, "secret")
+        assert await pool.run_async(security._verify, "secret", hashed)
+        pool.timeout = 0.1
+        with pytest.raises(hashing.HashingPoolBusy):
+            await pool.run_async(time.sleep, 1)
+
+    try:
+        asyncio.run(jobs())
+        stats = pool.stats()
+        assert stats["completed"] == 2
+        assert stats["timed_out"] == 1
+    finally:
+        pool.shutdown()
+
+    # Jobs the executor didn't take are failures too
+    class RefusingExecutor:
+        def submit(self, fn, *args):
+            raise RuntimeError("cannot schedule new futures after shutdown")
+
+    pool = hashing.HashingPool(workers=1)
+    pool._get_executor = RefusingExecutor
+    with pytest.raises(RuntimeError):
+        pool.run(security._hash, "secret")
+    assert pool.stats()["failed"] == 1
+    assert pool.stats()["completed"] == pool.stats()["pending"] == 0
+
+
+def test_logins_dont_hold_threads(test_db, auth_headers, monkeypatch):
+    monkeypatch.setattr(hashing, "password_pool",
+                        hashing.HashingPool(workers=1, max_pending=10,
+                                            timeout=30))
+    login_body = (f"username={TEST_USER_EMAIL}&"
+                  f"password={TEST_USER_PASSWORD}").encode()
+    login_headers = {"Content-Type": "application/x-www-form-urlencoded"}
+
+    async def burst():
+        threadpool = metrics.InstrumentedThreadPool(1)
+        asyncio.get_running_loop().set_default_executor(threadpool)
+        logins = [asyncio.ensure_future(bench.asgi_request(
+            app, "POST", "/token", login_headers, login_body
+        )) for _ in range(4)]
+        while hashing.password_pool.stats()["pending"] < len(logins):
+            await asyncio.sleep(0.001)
+
+        # Every login is waiting for its hash, the only thread is free
+        busy = threadpool.stats()["busy"]
+        user_status = await bench.asgi_request(app, "GET", "/users/1",
+                                               auth_headers)
+        still_pending = hashing.password_pool.stats()["pending"]
+        return (busy, user_status, still_pending,
+                await asyncio.gather(*logins))
+
+    try:
+        busy, user_status, still_pending, login_statuses = asyncio.run(
+            asyncio.wait_for(burst(), timeout=60)
+        )
+    finally:
+        hashing.password_pool.shutdown()
+    assert busy == 0
+    assert user_status == 200
+    assert still_pending > 0
+    assert login_statuses == [200] * 4
+
+
 def test_authentication_with_bad_token(test_db):
     headers = {"Authorization": "Bearer complete_n0n_s3ns3"}
 
@@ -211,6 +638,32 @@ def test_authentication_error_with_deleted_user(test_db, auth_headers):
     assert {'detail': "Could not validate credentials"}
 
 
+def test_authentication_is_cached(test_db, auth_headers):
+    client.get("/users/", headers=auth_headers)
+    cache_hits = cache.principal_cache.hits
+    for _ in range(3):
+        response = client.get("/users/", headers=auth_headers)
+        assert response.status_code == 200
+    assert cache.principal_cache.hits == cache_hits + 3
+
+    # Changing the email invalidates the cached user, so the old token
+    # (issued for the old email) stops working right away
+    response = client.put("/users/1", headers=auth_headers, json={
+        "email": "new@example.com",
+        "password": TEST_USER_PASSWORD,
+        "is_admin": True,
+    })
+    assert response.status_code == 200
+    response = client.get("/users/", headers=auth_headers)
+    assert response.status_code == 401
+
+    # Cached users don't outlive their token
+    with TestingSessionLocal() as db:
+        user = crud.get_principal(db, TEST_USER_EMAIL_SECOND, time.time())
+    assert user.id == 2
+    assert cache.principal_cache.get(TEST_USER_EMAIL_SECOND) is cache.MISSING
+
+
 # ==================================================================
 # User-related Tests
 # ==================================================================
@@ -223,6 +676,23 @@ def test_get_all_users(test_db, auth_headers):
     ]
 
 
+def test_get_users_paginated(test_db, auth_headers):
+    response = client.get("/users/?limit=1", headers=auth_headers)
+    assert response.status_code == 200
+    assert [user["id"] for user in response.json()] == [1]
+
+    cursor = response.headers["X-Next-Cursor"]
+    assert cursor in response.headers["Link"]
+
+    response = client.get(f"/users/?limit=1&next={cursor}",
+                          headers=auth_headers)
+    assert [user["id"] for user in response.json()] == [2]
+    assert "X-Next-Cursor" not in response.headers
+
+    response = client.get("/users/?all=true", headers=auth_headers)
+    assert len(response.json()) == 2
+
+
 def test_user_get_by_id(test_db, auth_headers):
     response = client.get("/users/1", headers=auth_headers)
     assert response.status_code == 200
@@ -362,6 +832,200 @@ def test_product_get_all(test_db, auth_headers):
     assert len(response.json()) == 2
 
 
+def test_product_get_all_paginated(test_db, auth_headers):
+    response = client.get("/products/?limit=1")
+    assert response.status_code == 200
+    assert [product["id"] for product in response.json()] == [1]
+
+    response = client.get(response.headers["Link"].split(";")[0][1:-1])
+    assert [product["id"] for product in response.json()] == [2]
+    assert "Link" not in response.headers
+
+    response = client.get("/products/?all=true")
+    assert len(response.json()) == 2
+
+    response = client.get("/products/?limit=0")
+    assert response.status_code == 422
+
+    for cursor in ["not-a-cursor", "e30"]:  # e30 is {}
+        response = client.get(f"/products/?next={cursor}")
+        assert response.status_code == 400
+        assert response.json() == {"detail": "Invalid cursor"}
+
+
+def test_product_get_all_filtered_and_sorted(test_db, auth_headers):
+    rows = [
+        dict(sku=sku, name=name, price=price, brand="Kingston",
+             description="Storage")
+        for sku, name, price in [("K1", "SSD B", 300), ("K2", "SSD A", 100),
+                                 ("K3", "SSD D", 200), ("K4", "SSD C", 200)]
+    ]
+    client.post("/products/bulk", headers=auth_headers,
+                data="\n".join(json.dumps(row) for row in rows))
+
+    def skus(url):
+        response = client.get(url)
+        assert response.status_code == 200
+        return [p["sku"] for p in response.json()]
+
+    assert skus("/products/?brand=Kingston&sort=price") == [
+        "K2", "K3", "K4", "K1", "B079XC5PVV"
+    ]
+    assert skus("/products/?brand=Catan%20Studio") == ["B00U26V4VQ"]
+    assert skus("/products/?min_price=150&max_price=300&sort=-price") == [
+        "K1", "K4", "K3"
+    ]
+    assert skus("/products/?brand=Kingston&sort=name") == [
+        "K2", "K1", "K4", "K3", "B079XC5PVV"
+    ]
+
+    # Keyset pagination over ties in the sort column
+    url = "/products/?brand=Kingston&sort=-price&limit=2"
+    response = client.get(url)
+    assert [p["sku"] for p in response.json()] == ["B079XC5PVV", "K1"]
+    response = client.get(f"{url}&next={response.headers['X-Next-Cursor']}")
+    assert [p["sku"] for p in response.json()] == ["K4", "K3"]
+    response = client.get(f"{url}&next={response.headers['X-Next-Cursor']}")
+    assert [p["sku"] for p in response.json()] == ["K2"]
+
+    # A cursor for a different sort order is rejected
+    cursor = pagination.encode_cursor({"id": 1})
+    response = client.get(f"/products/?sort=name&next={cursor}")
+    assert response.status_code == 400
+
+    # Updates reorder the (cached) sorted lists
+    client.patch("/products/bulk", headers=auth_headers,
+                 json={"ids": [4], "changes": {"price": 250}})
+    assert skus("/products/?brand=Kingston&sort=price")[0] == "K3"
+
+
+def test_product_list_uses_indexes(test_db):
+    queries = {
+        "ix_products_brand_price": schemas.ProductFilter(
+            brand="Kingston", min_price=100, sort="price"
+        ),
+        "ix_products_price": schemas.ProductFilter(
+            min_price=100, max_price=200, sort="-price"
+        ),
+        "ix_products_name": schemas.ProductFilter(sort="name"),
+    }
+
+    with TestingSessionLocal() as db:
+        for index, filters in queries.items():
+            statement = crud.product_list_statement(filters, None, 20)
+            sql = statement.compile(
+                dialect=engine.dialect,
+                compile_kwargs={"literal_binds": True}
+            )
+            plan = " ".join(
+                str(row[-1]) for row in
+                db.execute(text(f"EXPLAIN QUERY PLAN {sql}"))
+            )
+            assert f"INDEX {index}" in plan
+            assert "TEMP B-TREE" not in plan
+
+
+def test_product_export(test_db):
+    expected = [copy(product) for product in config.INITIAL_PRODUCTS]
+    for product in expected:
+        product["price"] = float(product["price"])
+
+    response = client.get("/products/export")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert [
+        json.loads(line) for line in response.text.splitlines()
+    ] == expected
+
+    response = client.get("/products/export?format=csv")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    lines = response.text.splitlines()
+    assert lines[0] == "id,sku,name,price,brand,description"
+    assert lines[1] == "1,B079XC5PVV,SSD Disk 1TB,2012.5,Kingston," \
+                       "Fast storage solution"
+    assert len(lines) == 3
+
+
+def test_product_export_in_chunks(test_db):
+    with TestingSessionLocal() as db:
+        rows = crud.iter_products(db, batch_size=1)
+        chunks = list(export.iter_export(rows, schemas.ExportFormat.csv, 1))
+
+    # Header + one product per chunk
+    assert len(chunks) == 2
+    assert chunks[0].count("\n") == 2
+    assert chunks[1].count("\n") == 1
+
+
+def test_product_search(test_db, auth_headers):
+    response = client.get("/products/search?q=catan")
+    assert response.status_code == 200
+    assert [p["id"] for p in response.json()] == [2]
+
+    # Prefix match on the last word and on the SKU
+    response = client.get("/products/search?q=Kingst")
+    assert [p["id"] for p in response.json()] == [1]
+    response = client.get("/products/search?q=B079XC5PVV")
+    assert [p["id"] for p in response.json()] == [1]
+
+    # Query syntax is not interpreted
+    response = client.get('/products/search?q=" OR "')
+    assert response.json() == []
+    response = client.get("/products/search?q=")
+    assert response.status_code == 422
+
+    with TestingSessionLocal() as db:
+        assert search.rebuild_index(db) == 2
+    response = client.get("/products/search?q=catan")
+    assert [p["id"] for p in response.json()] == [2]
+
+
+def test_product_search_ranking_and_pagination(test_db, auth_headers):
+    rows = [
+        dict(sku="G01", name="Board game", price=10, brand="ACME",
+             description="A game"),
+        dict(sku="G02", name="Puzzle", price=10, brand="ACME",
+             description="Not a game, more of a game-like puzzle"),
+        dict(sku="G03", name="Game of games", price=10, brand="Games Inc",
+             description="Game"),
+    ]
+    client.post("/products/bulk", headers=auth_headers,
+                data="\n".join(json.dumps(row) for row in rows))
+
+    # The seeded "Catan classic" is a "Classic board game"
+    response = client.get("/products/search?q=game")
+    assert [p["sku"] for p in response.json()] == [
+        "G03", "G01", "G02", "B00U26V4VQ"
+    ]
+
+    response = client.get("/products/search?q=game&limit=2")
+    assert [p["sku"] for p in response.json()] == ["G03", "G01"]
+    cursor = response.headers["X-Next-Cursor"]
+    response = client.get(f"/products/search?q=game&limit=2&next={cursor}")
+    assert [p["sku"] for p in response.json()] == ["G02", "B00U26V4VQ"]
+
+
+def test_product_search_index_follows_writes(test_db, auth_headers):
+    payload = dict(sku="B07G2CJLNN", name="The Big Lebowski", price=530.64,
+                   brand="Universal Pictures", description="Remastered")
+    client.post("/products/", headers=auth_headers, json=payload)
+    response = client.get("/products/search?q=lebowski")
+    assert [p["id"] for p in response.json()] == [3]
+
+    client.put("/products/3", headers=auth_headers,
+               json=payload | {"name": "Fargo"})
+    assert client.get("/products/search?q=lebowski").json() == []
+    assert len(client.get("/products/search?q=fargo").json()) == 1
+
+    client.patch("/products/bulk", headers=auth_headers,
+                 json={"ids": [3], "changes": {"description": "Coen"}})
+    assert len(client.get("/products/search?q=coen").json()) == 1
+
+    client.delete("/products/3", headers=auth_headers)
+    assert client.get("/products/search?q=fargo").json() == []
+
+
 def test_product_get_one(test_db, auth_headers):
     response = client.get("/products/1", headers=auth_headers)
     expected_product = copy(config.INITIAL_PRODUCTS[0])
@@ -375,6 +1039,275 @@ def test_product_get_one(test_db, auth_headers):
     assert response.json() == expected_product
 
 
+def test_product_reads_are_cached(test_db, auth_headers):
+    cache_hits = cache.product_cache.hits
+    client.get("/products/1")
+    client.get("/products/")
+
+    # Changes made behind crud's back aren't seen ...
+    with TestingSessionLocal() as db:
+        db.query(models.Product).update({"name": "Changed"})
+        db.commit()
+    assert client.get("/products/1").json()["name"] == "SSD Disk 1TB"
+    assert client.get("/products/").json()[1]["name"] == "Catan classic"
+
+    # ... but cache hits still count as product hits
+    response = client.get("/products/1/hits", headers=auth_headers)
+    assert response.json() == {"hits": 2}
+
+    # Writes through the API invalidate only the written product
+    payload = dict(sku="B079XC5PVV", name="SSD Disk 500GB", price=1630.02,
+                   brand="Kingston", description="Fast storage solution")
+    client.put("/products/1", headers=auth_headers, json=payload)
+    assert client.get("/products/1").json()["name"] == "SSD Disk 500GB"
+    assert [p["name"] for p in client.get("/products/").json()] == [
+        "SSD Disk 500GB", "Catan classic"
+    ]
+
+    client.delete("/products/2", headers=auth_headers)
+    assert client.get("/products/2").status_code == 404
+
+    response = client.get("/stats", headers=auth_headers)
+    assert response.status_code == 200
+    assert response.json()["caches"]["product"]["hits"] > cache_hits
+    assert response.json()["hit_recorder"]["pending"] == 3
+
+
+def test_product_responses_are_pre_serialized(test_db, auth_headers):
+    anonymous = client.get("/products/1").content
+    authenticated = client.get("/products/1", headers=auth_headers).content
+    # Same bytes FastAPI would have produced from the schema
+    expected = copy(config.INITIAL_PRODUCTS[0])
+    expected["price"] = float(expected["price"])
+    assert anonymous == authenticated == json.dumps(
+        {key: expected[key] for key in
+         ["sku", "name", "price", "brand", "id", "description"]},
+        separators=(",", ":")
+    ).encode()
+
+    list_body = client.get("/products/?limit=1").content
+    assert json.loads(list_body) == [
+        {key: expected[key] for key in ["sku", "name", "price", "brand", "id"]}
+    ]
+
+    # A new product only needs its own item serialized
+    payload = dict(sku="B07G2CJLNN", name="The Big Lebowski", price=530.64,
+                   brand="Universal Pictures", description="Remastered")
+    client.post("/products/", headers=auth_headers, json=payload)
+    response = client.get("/products/?all=true")
+    assert response.headers["content-type"] == "application/json"
+    assert response.json()[2] == {"id": 3, "sku": "B07G2CJLNN",
+                                  "name": "The Big Lebowski",
+                                  "price": 530.64,
+                                  "brand": "Universal Pictures"}
+
+
+def test_metrics(test_db, auth_headers):
+    metrics.request_metrics.clear()
+    client.get("/products/1", headers=auth_headers)
+    client.get("/products/1")
+    client.get("/products/999")
+    client.get("/products/", headers=auth_headers)
+    client.get("/users/", headers=auth_headers)
+    client.get("/nowhere")
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith(
+        "text/plain; version=0.0.4"
+    )
+    samples = {}
+    for line in response.text.splitlines():
+        if not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+
+    def sample(name, **labels):
+        return samples[name + metrics.format_labels(tuple(labels.items()))]
+
+    route = "/products/{product_id}"
+    assert sample("http_requests_total", method="GET", route=route,
+                  status="200") == 2
+    assert sample("http_requests_total", method="GET", route=route,
+                  status="404") == 1
+    assert sample("http_requests_total", method="GET", route="unmatched",
+                  status="404") == 1
+    assert sample("http_request_duration_seconds_count", method="GET",
+                  route=route) == 3
+    assert sample("http_request_duration_seconds_bucket", method="GET",
+                  route=route, le="+Inf") == 3
+    assert sample("http_request_duration_seconds_sum", method="GET",
+                  route=route) > 0
+
+    # Only the authenticated request spent time authenticating, and the
+    # cached product didn't need the DB nor serializing
+    for phase, count in [("auth", 1), ("db", 2), ("serialization", 1)]:
+        assert sample("http_request_phase_seconds_count", method="GET",
+                      route=route, phase=phase) == count
+    # The cached product took no statements at all
+    assert sample("http_request_db_queries_bucket", method="GET",
+                  route=route, le="0") == 1
+    assert sample("http_request_db_queries_count", method="GET",
+                  route=route) == 3
+
+    # Sync endpoints too, their phases happen on the threadpool
+    for route in ["/products/", "/users/"]:
+        assert sample("http_request_phase_seconds_count", method="GET",
+                      route=route, phase="auth") == 1
+        assert sample("http_request_phase_seconds_count", method="GET",
+                      route=route, phase="db") == 1
+
+    for state in ["busy", "queued", "max"]:
+        assert ("threadpool_jobs" +
+                metrics.format_labels((("state", state),))) in samples
+    assert sample("db_pool_checked_out_connections", engine="writer") == 0
+
+
+def test_sql_instrumentation(test_db, auth_headers, monkeypatch, caplog):
+    monkeypatch.setattr(metrics.request_metrics, "sql_debug_headers", True)
+    caplog.set_level(logging.WARNING, logger=metrics.__name__)
+
+    # Reading the product, writing it, reading it back and looking up who
+    # to notify
+    payload = dict(sku="B079XC5PVV", name="SSD Disk 500GB", price=1630.02,
+                   brand="Kingston", description="Fast storage solution")
+    response = client.put("/products/1", headers=auth_headers, json=payload)
+    assert response.status_code == 200
+    assert int(response.headers["X-SQL-Queries"]) >= 4
+    assert float(response.headers["X-SQL-Time-Ms"]) > 0
+    assert not caplog.records
+
+    # Cached
+    response = client.get("/products/2")
+    client.get("/products/2")
+    response = client.get("/products/2")
+    assert response.headers["X-SQL-Queries"] == "0"
+    assert response.headers["X-SQL-Time-Ms"] == "0.00"
+
+    monkeypatch.setattr(metrics.request_metrics, "slow_query_seconds", 0)
+    client.get("/products/?all=true")
+    assert any(
+        record.getMessage().startswith("Slow query") and
+        "for GET /products/: SELECT" in record.getMessage()
+        for record in caplog.records
+    )
+
+    monkeypatch.setattr(metrics.request_metrics, "sql_debug_headers", False)
+    assert "X-SQL-Queries" not in client.get("/products/1").headers
+
+
+def test_repeated_statements_are_logged(caplog):
+    caplog.set_level(logging.WARNING, logger=metrics.__name__)
+    repeating_app = FastAPI()
+    repeating_app.add_middleware(
+        metrics.MetricsMiddleware,
+        metrics=metrics.RequestMetrics(sql_debug_headers=True,
+                                       repeated_statement_threshold=3)
+    )
+
+    @repeating_app.get("/repeat/{times}")
+    def repeat(times: int):
+        with engine.connect() as conn:
+            for number in range(times):
+                conn.execute(text("SELECT :number"), number=number)
+
+    repeating_client = TestClient(repeating_app)
+    response = repeating_client.get("/repeat/2")
+    assert response.headers["X-SQL-Queries"] == "2"
+    assert not caplog.records
+
+    response = repeating_client.get("/repeat/5")
+    assert response.headers["X-SQL-Queries"] == "5"
+    assert [record.getMessage() for record in caplog.records] == [
+        "Same statement run 5 times for GET /repeat/{times}, N+1 queries? "
+        "SELECT ?"
+    ]
+
+
+def test_product_conditional_requests(test_db, auth_headers):
+    response = client.get("/products/")
+    etag = response.headers["ETag"]
+    last_modified = response.headers["Last-Modified"]
+
+    response = client.get("/products/", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["ETag"] == etag
+
+    response = client.get("/products/1", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    # A revalidated anonymous view is still a hit
+    assert hit_recorder.pending(1) == 1
+
+    # ... but unknown products are never "not modified" nor counted
+    for if_none_match in [etag, "*"]:
+        response = client.get("/products/999999",
+                              headers={"If-None-Match": if_none_match})
+        assert response.status_code == 404
+    assert hit_recorder.pending(999999) == 0
+    assert [
+        product_id for product_id, _
+        in trending_tracker.top(schemas.TrendingWindow.one_hour, 10)
+    ] == [1]
+
+    response = client.get("/products/",
+                          headers={"If-Modified-Since": last_modified})
+    assert response.status_code == 304
+
+    # Any product write changes the validators
+    client.delete("/products/2", headers=auth_headers)
+
+    response = client.get("/products/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert len(response.json()) == 1
+    assert response.headers["ETag"] != etag
+
+    response = client.get("/products/1",
+                          headers={"If-None-Match": 'W/"other", ' + etag})
+    assert response.status_code == 200
+
+
+def test_catalog_version_rolls_over_with_ttl():
+    now = [1200.0]
+    version = cache.CatalogVersion(ttl=60, clock=lambda: now[0])
+
+    etag, modified_at = version.validators()
+    now[0] += 30
+    assert version.validators() == (etag, modified_at)
+
+    version.bump()
+    assert version.validators() == (etag.replace("-0-", "-1-"), 1230)
+
+    # Writes made by other processes are picked up after the TTL
+    now[0] += 60
+    assert version.validators()[0] != etag.replace("-0-", "-1-")
+
+
+def test_lru_cache_eviction_and_ttl():
+    now = [0.0]
+    lru = cache.LRUCache(max_size=2, ttl=10, clock=lambda: now[0])
+
+    lru.set("a", 1)
+    lru.set("b", 2)
+    assert lru.get("a") == 1
+    lru.set("c", 3)  # "b" is the least recently used one
+
+    assert lru.get("b") is cache.MISSING
+    assert lru.get("c") == 3
+
+    now[0] = 10
+    assert lru.get("a") is cache.MISSING
+
+    # A value loaded before an invalidation isn't cached
+    generation = lru.generation
+    lru.invalidate("d")
+    lru.set("d", 4, generation=generation)
+    assert lru.get("d") is cache.MISSING
+
+    assert lru.stats() == {"size": 1, "hits": 2, "misses": 3,
+                           "evictions": 1}
+
+
 def test_product_get_unknown_product(test_db, auth_headers):
     response = client.get("/products/1111111", headers=auth_headers)
 
@@ -401,6 +1334,147 @@ def test_product_hits(test_db, auth_headers):
     assert response.json() == {"hits": 2}
 
 
+def test_product_hits_are_written_in_batches(test_db, auth_headers):
+    flushed = hit_recorder.flushed
+
+    for _ in range(3):
+        client.get("/products/1")
+    client.get("/products/2")
+
+    # Nothing has been written yet, but the hits are already counted
+    assert hit_recorder.pending(1) == 3
+    with TestingSessionLocal() as db:
+        assert db.query(models.ProductHit).count() == 0
+
+    response = client.get("/products/1/hits", headers=auth_headers)
+    assert response.json() == {"hits": 3}
+
+    assert hit_recorder.flush() == 4
+    assert hit_recorder.pending(1) == 0
+    assert hit_recorder.flushed == flushed + 4
+    with TestingSessionLocal() as db:
+        assert db.query(models.ProductHit).count() == 4
+
+    response = client.get("/products/1/hits", headers=auth_headers)
+    assert response.json() == {"hits": 3}
+
+
+def test_product_hits_dropped_when_buffer_is_full(test_db):
+    recorder = hits.HitRecorder(TestingSessionLocal, max_buffer=2)
+
+    for _ in range(5):
+        recorder.record(1)
+
+    assert recorder.stats() == {
+        "buffered": 2, "flushed": 0, "dropped": 3, "pending": 2
+    }
+
+    recorder.stop()
+    assert recorder.stats()["flushed"] == 2
+
+
+def test_product_hit_counts_backfill(test_db, auth_headers):
+    with TestingSessionLocal() as db:
+        db.execute(
+            models.ProductHit.__table__.insert(),
+            [{"product_id": 1}, {"product_id": 1}, {"product_id": 2}]
+        )
+        db.commit()
+
+        # Raw rows inserted behind crud's back aren't counted ...
+        response = client.get("/products/1/hits", headers=auth_headers)
+        assert response.json() == {"hits": 0}
+
+        # ... until the counts are rebuilt
+        assert crud.rebuild_product_hit_counts(db) == 2
+
+    response = client.get("/products/1/hits", headers=auth_headers)
+    assert response.json() == {"hits": 2}
+    response = client.get("/products/2/hits", headers=auth_headers)
+    assert response.json() == {"hits": 1}
+
+
+def test_product_hits_time_series(test_db, auth_headers):
+    with TestingSessionLocal() as db:
+        crud.create_product_hits(db, [
+            (1, datetime(2021, 10, 1, 9, 15)),
+            (1, datetime(2021, 10, 1, 9, 45)),
+            (1, datetime(2021, 10, 1, 11, 5)),
+            (1, datetime(2021, 10, 2, 8, 0)),
+            (2, datetime(2021, 10, 1, 9, 30)),
+        ])
+
+    response = client.get(
+        "/products/1/hits",
+        params={"from": "2021-10-01T09:30:00", "to": "2021-10-01T12:00:00"},
+        headers=auth_headers
+    )
+    assert response.status_code == 200
+    assert response.json() == {
+        "hits": 3,
+        "granularity": "hour",
+        "buckets": [
+            {"start": "2021-10-01T09:00:00", "hits": 2},
+            {"start": "2021-10-01T11:00:00", "hits": 1},
+        ]
+    }
+
+    response = client.get(
+        "/products/1/hits",
+        params={"from": "2021-10-01T00:00:00Z", "to": "2021-10-03T00:00:00Z",
+                "granularity": "day"},
+        headers=auth_headers
+    )
+    assert response.json() == {
+        "hits": 4,
+        "granularity": "day",
+        "buckets": [
+            {"start": "2021-10-01T00:00:00", "hits": 3},
+            {"start": "2021-10-02T00:00:00", "hits": 1},
+        ]
+    }
+
+    # The overall total is still available
+    response = client.get("/products/1/hits", headers=auth_headers)
+    assert response.json() == {"hits": 4}
+
+
+def test_product_hits_time_series_rebuilt(test_db, auth_headers):
+    with TestingSessionLocal() as db:
+        db.execute(
+            models.ProductHit.__table__.insert(),
+            [{"product_id": 1, "seen_at": datetime(2021, 10, 1, 9, 15)},
+             {"product_id": 1, "seen_at": datetime(2021, 10, 1, 9, 45)}]
+        )
+        db.commit()
+        crud.rebuild_product_hit_counts(db)
+
+        # Buckets written afterwards must land on the rebuilt ones
+        crud.create_product_hits(db, [(1, datetime(2021, 10, 1, 9, 50))])
+
+    response = client.get(
+        "/products/1/hits",
+        params={"from": "2021-10-01T00:00:00", "to": "2021-10-02T00:00:00"},
+        headers=auth_headers
+    )
+    assert response.json()["buckets"] == [
+        {"start": "2021-10-01T09:00:00", "hits": 3}
+    ]
+
+
+def test_product_hits_time_series_bad_window(test_db, auth_headers):
+    response = client.get(
+        "/products/1/hits",
+        params={"from": "2021-10-02T00:00:00", "to": "2021-10-01T00:00:00"},
+        headers=auth_headers
+    )
+    assert response.status_code == 400
+
+    response = client.get("/products/1/hits?granularity=week",
+                          headers=auth_headers)
+    assert response.status_code == 422
+
+
 def test_product_get_hits_for_unknown_product(test_db, auth_headers):
     response = client.get("/products/1111111/hits", headers=auth_headers)
 
@@ -408,6 +1482,57 @@ def test_product_get_hits_for_unknown_product(test_db, auth_headers):
     assert response.json() == {"detail": "Product not found"}
 
 
+def test_product_trending(test_db, auth_headers):
+    response = client.get("/products/trending")
+    assert response.status_code == 200
+    assert response.json() == []
+
+    for _ in range(3):
+        client.get("/products/2")
+    client.get("/products/1")
+    # Authenticated views don't count
+    for _ in range(5):
+        client.get("/products/1", headers=auth_headers)
+
+    response = client.get("/products/trending?window=5m&limit=20")
+    assert response.status_code == 200
+    assert [p["id"] for p in response.json()] == [2, 1]
+    assert response.json()[0]["score"] == pytest.approx(3, rel=0.01)
+
+    response = client.get("/products/trending?limit=1")
+    assert [p["id"] for p in response.json()] == [2]
+
+    response = client.get("/products/trending?window=1y")
+    assert response.status_code == 422
+
+
+def test_product_trending_sketch_decay_and_capacity():
+    now = [0.0]
+    sketch = trending.DecayedTopK(time_constant=10, capacity=3,
+                                  clock=lambda: now[0])
+
+    for _ in range(4):
+        sketch.record("old")
+    now[0] = 30.0
+    sketch.record("new")
+    sketch.record("new")
+
+    # 4 views 3 time constants ago weigh less than 2 fresh ones
+    assert [key for key, _ in sketch.top(2)] == ["new", "old"]
+    assert sketch.top(1)[0][1] == pytest.approx(2)
+
+    # Memory is bounded, the lowest key gets replaced
+    for key in ["a", "b", "c", "d"]:
+        now[0] += 1
+        sketch.record(key)
+    assert len(sketch.top(10)) == 3
+
+    # Landmark renormalization keeps the scores intact
+    now[0] += 10 * trending.MAX_EXPONENT
+    sketch.record("late")
+    assert sketch.top(1) == [("late", pytest.approx(1))]
+
+
 def test_product_creation(test_db, auth_headers):
     payload = dict(
         sku="B07G2CJLNN",
@@ -445,6 +1570,127 @@ def test_product_creation_duplicate_sku(test_db, auth_headers):
     assert response.json() == {"detail": "SKU already exists"}
 
 
+def test_product_bulk_import_ndjson(test_db, auth_headers):
+    rows = [
+        dict(sku="B01", name="Product 1", price=10.5, brand="ACME",
+             description="First"),
+        dict(sku="B02", name="Product 2", price=20, brand="ACME",
+             description="Second"),
+        # Already at the DB
+        dict(sku="B079XC5PVV", name="SSD Disk 500GB", price=1630.02,
+             brand="Kingston", description="Fast storage solution"),
+        # Repeated in the same import
+        dict(sku="B01", name="Product 1 again", price=10.5, brand="ACME",
+             description="First"),
+        # Missing fields
+        dict(sku="B03", name="Product 3"),
+    ]
+    body = "\n".join(json.dumps(row) for row in rows) + "\n\nnot json\n"
+
+    response = client.post("/products/bulk", headers=auth_headers,
+                           data=body)
+    assert response.status_code == 200
+
+    result = response.json()
+    assert result["created"] == 2
+    assert result["failed"] == 4
+    assert [error["row"] for error in result["errors"]] == [3, 4, 5, 6]
+    assert result["errors"][0]["detail"] == "SKU already exists"
+    assert result["errors"][1]["detail"] == "SKU repeated in this import"
+    assert result["errors"][2]["detail"].startswith("price: ")
+    assert result["errors"][3]["detail"] == "Invalid JSON"
+
+    response = client.get("/products/?all=true")
+    assert len(response.json()) == 4
+
+    assert_email_sent(TEST_USER_EMAIL_SECOND, {
+        "user": TEST_USER_EMAIL,
+        "change": "Imported 2 products"
+    })
+
+
+def test_product_bulk_import_csv_in_batches(test_db, auth_headers):
+    body = (
+        "sku,name,price,brand,description\r\n"
+        "C01,Chair,99.90,IKEA,\"Wooden chair,\nmultiline description\"\r\n"
+        "C02,Table,199,IKEA,Table\r\n"
+        "C03,Lamp,not-a-price,IKEA,Lamp\r\n"
+    )
+
+    with TestingSessionLocal() as db:
+        lines = bulk_import.iter_lines(
+            chunks(body.encode(), size=7)
+        )
+        report = asyncio.run(bulk_import.import_products(
+            db, bulk_import.iter_csv_rows(lines), batch_size=1
+        ))
+
+    assert report.created == 2
+    assert report.errors == [
+        {"row": 3, "detail": "price: value is not a valid decimal"}
+    ]
+
+    response = client.get("/products/3")
+    assert response.json()["description"] == \
+        "Wooden chair,\nmultiline description"
+
+    response = client.post("/products/bulk", data=body,
+                           headers={"Content-Type": "text/csv"} |
+                           auth_headers)
+    assert response.json()["failed"] == 3
+
+
+def test_product_bulk_import_with_conflicting_batch(test_db, auth_headers,
+                                                    monkeypatch):
+    # The first check of every SKU misses it, as if it had been taken
+    # between the check and the insert
+    get_existing_skus = crud.get_existing_skus
+    checked_skus = set()
+
+    def racing_get_existing_skus(db, skus):
+        skus = list(skus)
+        rechecked = [sku for sku in skus if sku in checked_skus]
+        checked_skus.update(skus)
+        return get_existing_skus(db, rechecked)
+
+    monkeypatch.setattr(crud, "get_existing_skus", racing_get_existing_skus)
+    rows = [
+        dict(sku=sku, name="Product", price=10, brand="ACME",
+             description="Product")
+        for sku in ["D01", "B079XC5PVV", "D02", "D03"]
+    ]
+
+    async def iter_rows():
+        for row_number, row in enumerate(rows, 1):
+            yield row_number, row
+
+    # Only the conflicting rows of the batch are rejected
+    with TestingSessionLocal() as db:
+        report = asyncio.run(bulk_import.import_products(
+            db, iter_rows(), batch_size=3
+        ))
+    assert report.created == 3
+    assert len(report.product_ids) == 3
+    assert report.errors == [
+        {"row": 2, "detail": "Conflicts with a product created meanwhile"}
+    ]
+
+    body = (json.dumps(dict(rows[0], sku="E01")) + "\n" +
+            json.dumps(dict(rows[0], sku="B00U26V4VQ")))
+    response = client.post("/products/bulk", headers=auth_headers,
+                           data=body)
+    assert response.status_code == 200
+    assert response.json()["created"] == 1
+    assert response.json()["errors"] == [
+        {"row": 2, "detail": "Conflicts with a product created meanwhile"}
+    ]
+
+
+async def chunks(data: bytes, size: int):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
 def test_product_update(test_db, auth_headers):
     payload = dict(
         sku="B079XC5PVV",
@@ -464,6 +1710,99 @@ def test_product_update(test_db, auth_headers):
     })
 
 
+def test_product_changes_and_notifications_commit_together(
+    test_db, auth_headers, monkeypatch
+):
+    def broken_enqueue(*args):
+        raise RuntimeError("Outbox unavailable")
+
+    monkeypatch.setattr(crud, "enqueue_notifications", broken_enqueue)
+    payload = dict(sku="B079XC5PVV", name="SSD Disk 500GB", price=1630.02,
+                   brand="Kingston", description="Fast storage solution")
+    with pytest.raises(RuntimeError):
+        client.put("/products/1", headers=auth_headers, json=payload)
+    with pytest.raises(RuntimeError):
+        client.delete("/products/2", headers=auth_headers)
+
+    # Neither the changes nor their notifications were saved
+    with TestingSessionLocal() as db:
+        assert db.query(models.Product.name).order_by(
+            models.Product.id
+        ).all() == [("SSD Disk 1TB",), ("Catan classic",)]
+        assert db.query(models.NotificationOutbox).count() == 0
+
+
+def test_product_bulk_update(test_db, auth_headers):
+    response = client.patch("/products/bulk", headers=auth_headers, json={
+        "ids": [1, 2, 1111],
+        "changes": {"description": "On sale"}
+    })
+    assert response.status_code == 200
+    assert response.json() == [
+        {"id": 1, "status": "updated"},
+        {"id": 2, "status": "updated"},
+        {"id": 1111, "status": "not_found"},
+    ]
+    assert client.get("/products/2").json()["description"] == "On sale"
+
+    assert_email_sent(TEST_USER_EMAIL_SECOND, {
+        "user": TEST_USER_EMAIL,
+        "change": "Updated 2 products: #1, #2"
+    })
+
+    response = client.patch("/products/bulk", headers=auth_headers, json={
+        "brand": "Kingston",
+        "changes": {"price_factor": 0.5}
+    })
+    assert response.json() == [{"id": 1, "status": "updated"}]
+    assert client.get("/products/1").json()["price"] == 1006.25
+    assert client.get("/products/2").json()["price"] == 1140.26
+
+    # Scaled prices are rounded to cents
+    client.patch("/products/bulk", headers=auth_headers, json={
+        "ids": [2],
+        "changes": {"price_factor": 1.1}
+    })
+    with TestingSessionLocal() as db:
+        price, = db.execute(text("SELECT price FROM products WHERE id = 2")
+                            ).one()
+    assert price == 1254.29
+    assert client.get("/products/2").json()["price"] == 1254.29
+
+
+def test_product_bulk_update_validation(test_db, auth_headers):
+    for payload in [
+        {"ids": [1], "brand": "Kingston", "changes": {"name": "x"}},
+        {"changes": {"name": "x"}},
+        {"ids": [], "changes": {"name": "x"}},
+        {"ids": [1], "changes": {}},
+        {"ids": [1], "changes": {"price": 1, "price_factor": 2}},
+    ]:
+        response = client.patch("/products/bulk", headers=auth_headers,
+                                json=payload)
+        assert response.status_code == 422
+
+
+def test_product_bulk_deletion(test_db, auth_headers):
+    response = client.delete("/products/bulk", headers=auth_headers,
+                             json={"brand": "Nobody"})
+    assert response.json() == []
+
+    response = client.delete("/products/bulk", headers=auth_headers,
+                             json={"ids": [2, 3]})
+    assert response.status_code == 200
+    assert response.json() == [
+        {"id": 2, "status": "deleted"},
+        {"id": 3, "status": "not_found"},
+    ]
+    assert len(client.get("/products/").json()) == 1
+
+    assert_email_sent(TEST_USER_EMAIL_SECOND, {
+        "user": TEST_USER_EMAIL,
+        "change": "Deleted 1 product: #2"
+    })
+
+
 def test_user_update_unknown_product(test_db, auth_headers):
     payload = dict(
         sku="B079XC5PVV",
@@ -497,3 +1836,226 @@ def test_user_delete_unknown_product(test_db, auth_headers):
 
     assert response.status_code == 404
     assert response.json() == {"detail": "Product doesn't exist"}
+
+
+def test_notifications_are_sent_in_batches_from_the_outbox(test_db):
+    class BrokenSES:
+        def send_templated_email(self, **kwargs):
+            raise RuntimeError("SES is down")
+
+    addressees = [f"admin{i}@example.com" for i in range(120)]
+    with TestingSessionLocal() as db:
+        crud.enqueue_notifications(db, addressees, TEST_USER_EMAIL,
+                                   "Deleted product #9", "deleted", [9])
+        db.commit()
+
+    # Failed sends stay in the outbox for a later retry
+    broken = outbox.NotificationDispatcher(TestingSessionLocal, BrokenSES,
+                                           retry_delay=0, digest_window=0)
+    assert broken.dispatch() == 0
+    assert broken.failed == 120
+    with TestingSessionLocal() as db:
+        assert db.query(models.NotificationOutbox).count() == 120
+
+    sent_messages = len(ses_backend.sent_messages)
+    dispatcher = outbox.NotificationDispatcher(TestingSessionLocal,
+                                               override_get_ses,
+                                               digest_window=0)
+    assert dispatcher.dispatch() == 120
+    messages = ses_backend.sent_messages[sent_messages:]
+    assert [len(m.destinations["BccAddresses"]) for m in messages] == [
+        50, 50, 20
+    ]
+    assert_email_sent("admin119@example.com", {
+        "user": TEST_USER_EMAIL,
+        "change": "Deleted product #9"
+    })
+    with TestingSessionLocal() as db:
+        assert db.query(models.NotificationOutbox).count() == 0
+
+    # ... up to a maximum number of attempts
+    with TestingSessionLocal() as db:
+        crud.enqueue_notifications(db, addressees[:1], TEST_USER_EMAIL,
+                                   "Deleted product #9", "deleted", [9])
+        db.commit()
+    broken.max_attempts = 1
+    broken.dispatch()
+    assert broken.dropped == 1
+    with TestingSessionLocal() as db:
+        assert db.query(models.NotificationOutbox).count() == 0
+
+
+def test_notifications_are_merged_into_digests(test_db, auth_headers,
+                                               monkeypatch):
+    dispatcher = outbox.NotificationDispatcher(TestingSessionLocal,
+                                               override_get_ses,
+                                               digest_window=300)
+    dispatched = []
+    monkeypatch.setattr(dispatcher, "dispatch",
+                        lambda: dispatched.append(True))
+    app.dependency_overrides[get_notification_dispatcher] = lambda: dispatcher
+    try:
+        client.put("/products/1", headers=auth_headers, json=dict(
+            config.INITIAL_PRODUCTS[0], name="SSD Disk 2TB"
+        ))
+        client.post("/products/bulk", headers=auth_headers, data="\n".join(
+            json.dumps(dict(sku=sku, name="SSD", price=10, brand="Kingston",
+                            description="Storage"))
+            for sku in ["K1", "K2"]
+        ))
+        client.delete("/products/2", headers=auth_headers)
+    finally:
+        app.dependency_overrides[get_notification_dispatcher] = \
+            override_get_notification_dispatcher
+    monkeypatch.undo()
+
+    # Held back until the window is over, nothing is dispatched after the
+    # responses...
+    assert dispatched == []
+    assert dispatcher.dispatch() == 0
+    with TestingSessionLocal() as db:
+        assert db.query(models.NotificationOutbox).count() == 3
+
+    # ... then sent as a single email
+    sent_messages = len(ses_backend.sent_messages)
+    dispatcher.digest_window = 0
+    assert dispatcher.dispatch() == 1
+    assert len(ses_backend.sent_messages) == sent_messages + 1
+    assert_email_sent(TEST_USER_EMAIL_SECOND, {
+        "users": TEST_USER_EMAIL,
+        "changes": 3,
+        "created": "#3, #4",
+        "updated": "#1",
+        "deleted": "#2",
+    })
+
+
+def test_digest_lists_a_limited_number_of_products():
+    template_data = notification.digest_template_data([
+        (TEST_USER_EMAIL, "created", list(range(30, 0, -1))),
+        (TEST_USER_EMAIL_SECOND, "deleted", [40]),
+    ])
+    assert template_data == {
+        "users": f"{TEST_USER_EMAIL}, {TEST_USER_EMAIL_SECOND}",
+        "changes": 2,
+        "created": ", ".join(f"#{i}" for i in range(1, 21)) + " and 10 more",
+        "updated": "",
+        "deleted": "#40",
+    }
+
+
+def test_bench_suite(tmp_path):
+    args = argparse.Namespace(
+        db=str(tmp_path / "bench.db"), transport="asgi", products=[60],
+        concurrency=[2], requests=5, token_requests=2, scenarios=None,
+        seed=0, verbose=False
+    )
+    report = asyncio.run(bench.run_suite(args))
+
+    results = report["results"]
+    assert [result["scenario"] for result in results] == list(
+        bench.SCENARIOS
+    )
+    assert all(result["errors"] == 0 for result in results)
+    assert all(result["p50_ms"] <= result["p99_ms"] for result in results)
+
+    assert bench.compare_to_baseline(results, results, 0.2) == []
+    baseline = [dict(result, rps=2 * result["rps"]) for result in results]
+    regressions = bench.compare_to_baseline(results, baseline, 0.2)
+    assert len(regressions) == len(results)
+    assert regressions[0].startswith("list products=60 concurrency=2")
+
+
+def test_bench_sessions(tmp_path):
+    max_size = cache.product_cache.max_size
+    args = argparse.Namespace(
+        db=str(tmp_path / "bench.db"), products=20, requests=10,
+        concurrency=2, seed=0
+    )
+    results = asyncio.run(bench.compare(args))
+
+    assert set(results) == {"sync", "async"}
+    assert all(rps > 0 for rps in results.values())
+    # The product cache is turned off only while comparing
+    assert cache.product_cache.max_size == max_size
+
+
+def test_datagen_is_deterministic(tmp_path):
+    tables = {}
+    for run in ["first", "second"]:
+        datagen_engine = create_engine(f"sqlite:///{tmp_path}/{run}.db")
+        try:
+            migrations.migrate(datagen_engine)
+            datagen.generate(datagen_engine, products=200, users=5,
+                             hits=5000, seed=7, until=datetime(2024, 1, 1),
+                             days=2, batch_size=64)
+            with datagen_engine.connect() as conn:
+                tables[run] = {
+                    table: conn.execute(text(
+                        f"SELECT * FROM {table} ORDER BY 1, 2"
+                    )).all()
+                    for table in ["products", "users", "product_hits",
+                                  "product_hit_counts", "products_fts"]
+                }
+        finally:
+            datagen_engine.dispose()
+
+    assert tables["first"] == tables["second"]
+    generated = tables["first"]
+    assert len(generated["products"]) == 200
+    assert len(generated["products_fts"]) == 200
+    assert len(generated["users"]) == 5
+    assert len(generated["product_hits"]) == 5000
+    assert generated["product_hits"][0][1] >= "2023-12-30 00:00:00.000000"
+    assert generated["product_hits"][0][1] < "2024-01-01 00:00:00.000000"
+
+    # A few products get most of the hits
+    hits = sorted((count for _, count in generated["product_hit_counts"]),
+                  reverse=True)
+    assert sum(hits) == 5000
+    assert sum(hits[:20]) > 2500
+
+    # Every generated user can log in
+    assert security.verify_password("datagen", generated["users"][0][2])
+
+
+def test_datagen_adds_to_an_existing_db(tmp_path):
+    datagen_engine = create_engine(f"sqlite:///{tmp_path}/datagen.db")
+    try:
+        migrations.migrate(datagen_engine)
+        datagen.generate(datagen_engine, products=10, users=3, hits=0,
+                         seed=1, until=datetime(2024, 1, 1))
+        with datagen_engine.begin() as conn:
+            conn.execute(text(
+                "DELETE FROM users WHERE email = 'user1@datagen.example.com'"
+            ))
+
+        # Numbering goes on after the highest user left
+        datagen.generate(datagen_engine, products=10, users=2, hits=0,
+                         seed=2, until=datetime(2024, 1, 1))
+        with datagen_engine.connect() as conn:
+            emails = conn.execute(text(
+                "SELECT email FROM users ORDER BY id"
+            )).scalars().all()
+            assert emails == [f"user{number}@datagen.example.com"
+                              for number in [2, 3, 4, 5]]
+
+        # SKUs stay unique while the products are loaded
+        with pytest.raises(sqlite3.IntegrityError):
+            datagen.without_indexes(
+                datagen_engine, models.Product.__table__,
+                lambda: datagen.insert_rows(
+                    datagen_engine,
+                    "INSERT INTO products(sku, name, brand, price, "
+                    "description) VALUES (?, ?, ?, ?, ?)",
+                    [("GEN1-0000000001", "Dup", "ACME", 1.0, "Dup")], 10
+                )
+            )
+        with datagen_engine.connect() as conn:
+            indexes = conn.execute(text(
+                "SELECT name FROM sqlite_master WHERE type = 'index' "
+                "AND tbl_name = 'products'"
+            )).scalars().all()
+        assert "ix_products_sku" in indexes
+    finally:
+        datagen_engine.dispose()
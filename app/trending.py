@@ -0,0 +1,126 @@
+import heapq
+import math
+import threading
+import time
+from typing import Callable, Dict, Hashable, List, Tuple
+
+from . import config, schemas
+
+# Time constant of the exponential decay for each trending window
+WINDOW_SECONDS = {
+    schemas.TrendingWindow.five_minutes: 5 * 60,
+    schemas.TrendingWindow.one_hour: 60 * 60,
+    schemas.TrendingWindow.one_day: 24 * 60 * 60,
+}
+
+# Scores are renormalized before exp() gets anywhere near overflowing
+MAX_EXPONENT = 200.0
+
+
+class DecayedTopK:
+    """Approximate top-k of a stream with exponentially decayed counts
+
+    This is a space-saving sketch: at most `capacity` keys are tracked and
+    a new key replaces the one with the lowest score, inheriting it. The
+    counts use forward decay, each event weighs exp(age / time_constant)
+    relative to a landmark, so older events lose weight without having to
+    touch every tracked key on each update.
+    """
+
+    def __init__(
+        self,
+        time_constant: float,
+        capacity: int,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        self.time_constant = time_constant
+        self.capacity = capacity
+        self.clock = clock
+
+        self._landmark = clock()
+        self._scores: Dict[Hashable, float] = {}
+        # Min-heap of (score, key), entries whose score doesn't match
+        # self._scores are stale and skipped when popping
+        self._heap: List[Tuple[float, Hashable]] = []
+        self._lock = threading.Lock()
+
+    def record(self, key: Hashable):
+        with self._lock:
+            exponent = (self.clock() - self._landmark) / self.time_constant
+            if exponent > MAX_EXPONENT:
+                self._renormalize(exponent)
+                exponent = 0.0
+            weight = math.exp(exponent)
+
+            score = self._scores.get(key)
+            if score is None:
+                score = 0.0
+                if len(self._scores) >= self.capacity:
+                    score = self._evict_min()
+
+            score += weight
+            self._scores[key] = score
+            heapq.heappush(self._heap, (score, key))
+
+            if len(self._heap) > 2 * self.capacity:
+                self._compact()
+
+    def top(self, limit: int) -> List[Tuple[Hashable, float]]:
+        """The `limit` keys with the highest decayed count right now"""
+        with self._lock:
+            exponent = (self.clock() - self._landmark) / self.time_constant
+            items = heapq.nlargest(limit, self._scores.items(),
+                                   key=lambda item: item[1])
+        scale = math.exp(-exponent)
+        return [(key, score * scale) for key, score in items]
+
+    def clear(self):
+        with self._lock:
+            self._landmark = self.clock()
+            self._scores.clear()
+            self._heap.clear()
+
+    def _evict_min(self) -> float:
+        while True:
+            score, key = heapq.heappop(self._heap)
+            if self._scores.get(key) == score:
+                del self._scores[key]
+                return score
+
+    def _compact(self):
+        self._heap = [(score, key) for key, score in self._scores.items()]
+        heapq.heapify(self._heap)
+
+    def _renormalize(self, exponent: float):
+        scale = math.exp(-exponent)
+        self._landmark = self.clock()
+        self._scores = {
+            key: score * scale for key, score in self._scores.items()
+        }
+        self._compact()
+
+
+class TrendingTracker:
+    """One DecayedTopK per trending window, fed with anonymous hits"""
+
+    def __init__(self, capacity: int = config.TRENDING_CAPACITY,
+                 clock: Callable[[], float] = time.monotonic):
+        self.sketches = {
+            window: DecayedTopK(seconds, capacity, clock)
+            for window, seconds in WINDOW_SECONDS.items()
+        }
+
+    def record(self, product_id: int):
+        for sketch in self.sketches.values():
+            sketch.record(product_id)
+
+    def top(
+        self,
+        window: schemas.TrendingWindow,
+        limit: int
+    ) -> List[Tuple[int, float]]:
+        return self.sketches[window].top(limit)
+
+    def clear(self):
+        for sketch in self.sketches.values():
+            sketch.clear()